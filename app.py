@@ -1,17 +1,31 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_from_directory, stream_with_context
 from flask_cors import CORS
 import requests
 import json
 import logging
+import math
 import os
-from datetime import datetime, timedelta
 import urllib3
-import base64
-import uuid
 import threading
 import time
-from queue import Queue
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from dotenv import load_dotenv
+from embedding_store import text_hash
+from library import Book, Library, hash_file
+from job_queue import JobQueue
+from ingestion import EmbeddingPipeline, TokenBucket
+from gigachat_client import RateLimitError, get_client
+from embedding_providers import create_provider
+from cache import TTLCache, make_key, normalize_question
+from semantic_cache import SemanticCache
+import metrics
+from singleflight import FlightTimeout, SingleFlight
+from scheduler import BULK, Overloaded, priority
+from context_builder import assemble_context
+from lifecycle import Lifecycle
+from batch import BatchRunner, parse_questions
+from compression import compress_response
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
@@ -24,6 +38,14 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Ограничение размера загружаемой книги
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 * 1024
+# Компактный JSON: без отступов и без \uXXXX для кириллицы (вдвое-втрое меньше байт в ответах)
+app.json.compact = True
+app.json.ensure_ascii = False
+# Сжатие ответов gzip или brotli (если установлен пакет Brotli) по Accept-Encoding клиента;
+# ответы короче COMPRESS_MIN_SIZE байт не сжимаются
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
 CORS(app, resources={
     r"/*": {
         "origins": "*",
@@ -33,293 +55,729 @@ CORS(app, resources={
 })
 
 # Глобальные переменные для хранения данных
-embeddings = []
-text = ""
-access_token = None
-token_expiry = None
-embeddings_queue = Queue()
-processing_complete = False
-
-# Константы из переменных окружения
-GIGACHAT_API_URL = "https://gigachat.devices.sberbank.ru/api/v1"
-CLIENT_ID = os.getenv('CLIENT_ID')
-AUTH_KEY = os.getenv('AUTH_KEY')
-AUTH_URL = "https://ngw.devices.sberbank.ru:9443/api/v2/oauth"
-
-# Путь к файлу для сохранения эмбеддингов
-EMBEDDINGS_FILE = "embeddings.json"
+# Книги и их индексы эмбеддингов; /analyze работает с активной книгой
+library = Library(os.getenv('BOOKS_DIR', 'books'))
+# Постоянная очередь задач индексации: переживает перезапуск, общая для всех процессов
+job_queue = JobQueue(os.getenv('JOBS_DB', 'jobs.db'))
+
+# Эмбеддинги хранятся в непрерывной матрице float32 с нормированными строками.
+# VECTOR_INDEX=flat — точный поиск, ivf — приближенный поиск для больших корпусов,
+# float16 и int8 — поиск по сжатой копии векторов с точной переоценкой RESCORE_CANDIDATES лучших
+# (float16 только экономит память, поиск по нему медленнее flat)
+VECTOR_INDEX = os.getenv('VECTOR_INDEX', 'flat')
+if VECTOR_INDEX == 'ivf':
+    INDEX_PARAMS = {'nprobe': int(os.getenv('IVF_NPROBE', '8'))}
+elif VECTOR_INDEX in ('float16', 'int8'):
+    INDEX_PARAMS = {'rescore': int(os.getenv('RESCORE_CANDIDATES', '64'))}
+else:
+    INDEX_PARAMS = {}
+
+# Реплика: книги без готовых эмбеддингов при запуске загружаются с основного узла INDEX_PRIMARY_URL
+# (GET /export_index) вместо запросов к API; INDEX_EXPORT_DTYPE=float16 вдвое уменьшает объем передачи
+INDEX_PRIMARY_URL = os.getenv('INDEX_PRIMARY_URL')
+INDEX_EXPORT_DTYPE = os.getenv('INDEX_EXPORT_DTYPE', 'float32')
+
+# Общий клиент GigaChat API: пул соединений и кэш токена на весь процесс
+client = get_client()
+
+# Этапы запуска: сервер отвечает на /healthz сразу, на /readyz — после загрузки и прогрева
+lifecycle = Lifecycle()
+
+# Книга, загружаемая при запуске, ее бинарное хранилище эмбеддингов и старый JSON-файл для миграции
+BOOK_FILE = "book.txt"
+EMBEDDINGS_FILE = "embeddings.bin"
+LEGACY_EMBEDDINGS_FILE = "embeddings.json"
+
+# Размер чанка в токенах и перекрытие соседних чанков
+CHUNK_TOKENS = int(os.getenv('CHUNK_TOKENS', '160'))
+CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', '32'))
+# Размер чанка в символах в старом embeddings.json
+LEGACY_CHUNK_SIZE = 150
+
+# Поставщик эмбеддингов: gigachat — GigaChat API, local — модель sentence-transformers на CPU.
+# Метка поставщика хранится вместе с векторами, при смене поставщика книги индексируются заново
+EMBEDDING_PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'gigachat')
+if EMBEDDING_PROVIDER == 'local':
+    embedder = create_provider(
+        'local',
+        model_name=os.getenv('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'),
+        batch_size=int(os.getenv('LOCAL_EMBEDDING_BATCH_SIZE', '32')),
+        threads=int(os.getenv('LOCAL_EMBEDDING_THREADS', '0')) or None
+    )
+else:
+    embedder = create_provider(EMBEDDING_PROVIDER)
+
+# Параметры пакетного создания эмбеддингов; локальная модель считает пакеты по одному,
+# параллельность у нее внутри (потоки torch)
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', '16' if embedder.remote else '64'))
+EMBEDDING_WORKERS = int(os.getenv('EMBEDDING_WORKERS', '4')) if embedder.remote else 1
+EMBEDDING_RATE = float(os.getenv('EMBEDDING_RATE', '2'))
+
+# INGESTION_MODE=thread — индексация в фоновом потоке веб-процесса,
+# worker — только отдельными процессами worker.py, веб-процесс лишь читает готовый индекс
+INGESTION_MODE = os.getenv('INGESTION_MODE', 'thread')
+# Количество чанков в одной задаче очереди
+JOB_SIZE = int(os.getenv('JOB_SIZE', '64'))
+# Аренда задачи: если воркер не продлил ее за это время (упал), задачу получит другой
+JOB_LEASE = int(os.getenv('JOB_LEASE', '120'))
+# Как часто воркер проверяет очередь и веб-процесс подхватывает новые строки индекса (секунды)
+WORKER_POLL_INTERVAL = 2
+INDEX_REFRESH_INTERVAL = 5
+# Процесс, в котором уже работает поток обновления индексов
+_refresh_pid = None
+_refresh_lock = threading.Lock()
+
+# Поиск контекста: hybrid — BM25 и эмбеддинги, vector — только эмбеддинги, lexical — только BM25.
+# HYBRID_ALPHA — вес векторной близости при слиянии оценок
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'hybrid')
+HYBRID_ALPHA = float(os.getenv('HYBRID_ALPHA', '0.6'))
+# Контекст промпта: до CONTEXT_CANDIDATES найденных чанков, слитых в непрерывные фрагменты
+# без повторов, не больше CONTEXT_TOKEN_BUDGET токенов
+CONTEXT_CANDIDATES = int(os.getenv('CONTEXT_CANDIDATES', '12'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '600'))
+# Если эмбеддинг вопроса не получен за это время или API ответил 429, отвечаем по BM25
+QUERY_EMBEDDING_TIMEOUT = float(os.getenv('QUERY_EMBEDDING_TIMEOUT', '3'))
+query_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="query-embedding")
+# До этого времени эмбеддинги вопросов не запрашиваются (после ответа 429)
+_embedding_backoff_until = 0.0
+
+# Кэши эмбеддингов вопросов и готовых ответов (CACHE_DB — файл SQLite для хранения между перезапусками)
+CACHE_DB = os.getenv('CACHE_DB')
+CACHE_TTL = int(os.getenv('CACHE_TTL', '86400'))
+query_cache = TTLCache("query_embeddings", maxsize=int(os.getenv('QUERY_CACHE_SIZE', '2048')), ttl=CACHE_TTL, db_path=CACHE_DB)
+answer_cache = TTLCache("answers", maxsize=int(os.getenv('ANSWER_CACHE_SIZE', '512')), ttl=CACHE_TTL, db_path=CACHE_DB)
+# Семантический кэш: перефразированный вопрос (косинусная близость эмбеддингов не ниже
+# SEMANTIC_CACHE_THRESHOLD) получает найденный ранее контекст, не ниже SEMANTIC_ANSWER_THRESHOLD —
+# готовый ответ. Хранится в памяти процесса; SEMANTIC_CACHE_SIZE=0 отключает его
+semantic_cache = SemanticCache(
+    "semantic",
+    maxsize=int(os.getenv('SEMANTIC_CACHE_SIZE', '512')),
+    threshold=float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92')),
+    answer_threshold=float(os.getenv('SEMANTIC_ANSWER_THRESHOLD', '0.97'))
+)
+
+# Одновременные одинаковые вопросы разделяют один запрос эмбеддинга и один запрос ответа;
+# остальные ждут результат не дольше SINGLE_FLIGHT_TIMEOUT секунд
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', '120'))
+query_flight = SingleFlight("query_embeddings", timeout=SINGLE_FLIGHT_TIMEOUT)
+answer_flight = SingleFlight("answers", timeout=SINGLE_FLIGHT_TIMEOUT)
+
+# Пакетные прогоны (/analyze_batch, batch.py): результаты хранятся в BATCH_DIR для продолжения
+# после перезапуска; ответы генерируются не более чем BATCH_CONCURRENCY запросами одновременно
+BATCH_DIR = os.getenv('BATCH_DIR', 'batches')
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', '64'))
+
+# Параметры генерации ответа (входят в ключ кэша ответов)
+COMPLETION_PARAMS = {"model": "GigaChat", "temperature": 0.7, "max_tokens": 1000}
+
+SYSTEM_PROMPT = """Ты - эксперт по альтернативной истории и литературному анализу. 
+Твоя задача - на основе предоставленного контекста из книги создать правдоподобный 
+сценарий развития событий. Используй стиль и атмосферу оригинального текста, 
+сохраняй характерные особенности повествования. Ответ должен быть в том же стиле, 
+что и книга, с похожими описаниями и атмосферой."""
+
+# Общий ограничитель: подстраивается под ответы 429 между запусками конвейера (только для API)
+embedding_limiter = TokenBucket(rate=EMBEDDING_RATE) if embedder.remote else None
+
+# Метрики запросов; трассировка этапов включается заголовком запроса X-Trace: 1
+TRACE_HEADER = 'X-Trace'
+REQUEST_SECONDS = metrics.Histogram(
+    "http_request_duration_seconds", "Время обработки запроса по маршруту", ["route", "method", "status"]
+)
+RETRIEVALS = metrics.Counter("retrieval_total", "Поиски контекста по фактическому режиму", ["mode"])
+CHUNKS_REUSED = metrics.Counter("embedding_chunks_reused_total", "Чанки, эмбеддинги которых взяты из других книг")
+CONTEXT_TOKENS = metrics.Histogram(
+    "context_tokens", "Токены контекста в промпте", buckets=(64, 128, 256, 384, 512, 768, 1024, 1536, 2048, 4096)
+)
+
+def collect_state_metrics():
+    """Состояние кэшей, книг и очереди: считается только при запросе /metrics"""
+    caches = {"query_embeddings": query_cache.stats(), "answers": answer_cache.stats(), "semantic": semantic_cache.stats()}
+    books = list(library.books.values())
+    upstream = client.scheduler.stats()
+    return [
+        ("cache_hits_total", "counter", "Попадания в кэш",
+         {(("cache", name),): stats["hits"] for name, stats in caches.items()}),
+        ("cache_misses_total", "counter", "Промахи кэша",
+         {(("cache", name),): stats["misses"] for name, stats in caches.items()}),
+        ("cache_entries", "gauge", "Записей в кэше",
+         {(("cache", name),): stats["size"] for name, stats in caches.items()}),
+        ("completions_saved_total", "counter", "Ответы, выданные из кэша без запроса к модели",
+         {(("cache", "answers"),): caches["answers"]["hits"], (("cache", "semantic"),): caches["semantic"]["answer_hits"]}),
+        ("book_chunks_indexed", "gauge", "Проиндексированные чанки книги",
+         {(("book", book.book_id),): book.chunks_indexed for book in books}),
+        ("book_chunks_total", "gauge", "Всего чанков в книге",
+         {(("book", book.book_id),): book.chunks_total for book in books}),
+        ("indexing_jobs", "gauge", "Задачи индексации по состоянию",
+         {(("state", state),): count for state, count in job_queue.progress().items()}),
+        ("upstream_in_flight", "gauge", "Запросы к API, выполняемые сейчас", {(): upstream["in_flight"]}),
+        ("upstream_waiting", "gauge", "Запросы к API в очереди планировщика", {(): upstream["waiting"]})
+    ]
+
+metrics.register_collector(collect_state_metrics)
 
 def get_access_token():
-    """Получение токена доступа от GigaChat API"""
-    global access_token, token_expiry
-    
-    # Проверяем, не истек ли текущий токен
-    if access_token and token_expiry and datetime.now() < token_expiry:
-        return access_token
-    
+    """Получение токена доступа от GigaChat API (кэшируется общим клиентом)"""
     try:
-        # Запрос токена
-        headers = {
-            "Authorization": f"Bearer {AUTH_KEY}",
-            "RqUID": CLIENT_ID,
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-        
-        data = "scope=GIGACHAT_API_PERS"
-        
-        response = requests.post(
-            AUTH_URL, 
-            headers=headers, 
-            data=data, 
-            verify=False
-        )
-        
-        if response.status_code == 401:
-            logger.error("Неверные учетные данные")
-            raise Exception("Неверные учетные данные")
-        
-        response.raise_for_status()
-        data = response.json()
-        
-        access_token = data["access_token"]
-        token_expiry = datetime.now() + timedelta(seconds=3600 - 60)  # Токен живет 1 час
-        logger.info("Токен успешно получен")
-        
-        return access_token
+        return client.tokens.get_token()
     except Exception as e:
         logger.error(f"Ошибка при получении токена: {str(e)}")
         raise
 
-def load_book_from_file(file_path="book.txt"):
-    """Загрузка книги из файла"""
-    global text
+def new_book(book_id, text_path, store_path, title=None):
+    """Создание книги с параметрами разбиения и индекса из конфигурации"""
+    return Book(
+        book_id,
+        text_path,
+        store_path,
+        title=title,
+        chunk_tokens=CHUNK_TOKENS,
+        chunk_overlap=CHUNK_OVERLAP,
+        index_kind=VECTOR_INDEX,
+        index_params=INDEX_PARAMS,
+        provider=embedder.tag
+    )
+
+def open_book(book):
+    """Загрузка текста и эмбеддингов книги; без эмбеддингов книга заново разбивается на чанки"""
+    book.load_text()
+    if book.load_embeddings():
+        return True
+    book.plan_chunks()
+    return False
+
+def load_uploaded_books():
+    """Регистрация ранее загруженных книг из каталога библиотеки"""
+    for book_id, title in library.uploaded_books():
+        if library.get(book_id):
+            continue
+        text_path, store_path, _ = library.book_paths(book_id)
+        book = new_book(book_id, text_path, store_path, title)
+        try:
+            open_book(book)
+            library.add(book)
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке книги {book_id}: {str(e)}")
+
+def embed_texts(texts):
+    """Получение эмбеддингов для списка текстов одним запросом"""
+    return embedder.embed(texts)
+
+def embed_book_chunks(book):
+    """Функция эмбеддинга чанков книги с повторным использованием векторов других книг"""
+    def embed(texts):
+        found = library.reusable_vectors(texts, exclude=book.book_id, provider=book.provider)
+        missing = [t for t, vector in zip(texts, found) if vector is None]
+        CHUNKS_REUSED.inc(len(texts) - len(missing))
+        # Индексация уступает слоты планировщика запросам пользователей
+        with priority(BULK):
+            fresh = iter(embed_texts(missing) if missing else [])
+        return [vector if vector is not None else next(fresh) for vector in found]
+    return embed
+
+def create_pipeline(book, commit):
+    """Конвейер создания эмбеддингов чанков книги с параметрами из конфигурации"""
+    return EmbeddingPipeline(
+        embed_book_chunks(book),
+        commit,
+        embedding_limiter,
+        batch_size=EMBEDDING_BATCH_SIZE,
+        workers=EMBEDDING_WORKERS,
+        profile=book.profile
+    )
+
+def load_library():
+    """Регистрация книги по умолчанию и загруженных книг; возвращает книгу по умолчанию"""
+    if not os.path.exists(BOOK_FILE):
+        logger.error(f"Файл {BOOK_FILE} не найден")
+        return None
     
     try:
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"Файл {file_path} не найден")
-        
-        with open(file_path, "r", encoding="utf-8") as file:
-            text = file.read()
-        
-        logger.info(f"Книга успешно загружена из {file_path}")
-        return True
+        book = new_book(hash_file(BOOK_FILE), BOOK_FILE, EMBEDDINGS_FILE)
+        book.load_text()
     except Exception as e:
         logger.error(f"Ошибка при загрузке книги: {str(e)}")
-        return False
+        return None
+    
+    # Пробуем загрузить существующие эмбеддинги и продолжить с места остановки
+    if book.load_embeddings(legacy_json=LEGACY_EMBEDDINGS_FILE, legacy_chunk_size=LEGACY_CHUNK_SIZE):
+        logger.info("Используем существующие эмбеддинги")
+    else:
+        logger.info("Существующие эмбеддинги не найдены, создаем новые")
+        book.plan_chunks()
+    library.add(book, activate=True)
+    load_uploaded_books()
+    # Книга, выбранная загрузкой до перезапуска, остается активной
+    library.load_active()
+    return book
 
-def save_embeddings():
-    """Сохранение эмбеддингов в файл"""
-    try:
-        with open(EMBEDDINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(embeddings, f)
-        logger.info(f"Эмбеддинги успешно сохранены в файл {EMBEDDINGS_FILE}")
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении эмбеддингов: {str(e)}")
-        return False
+def pull_indexes(primary_url=INDEX_PRIMARY_URL, dtype=INDEX_EXPORT_DTYPE):
+    """Загрузка эмбеддингов непроиндексированных книг с основного узла"""
+    for book in list(library.books.values()):
+        if book.complete:
+            continue
+        try:
+            with requests.get(
+                f"{primary_url.rstrip('/')}/export_index",
+                params={"book_id": book.book_id, "dtype": dtype},
+                stream=True,
+                timeout=(10, 300)
+            ) as response:
+                if response.status_code == 404:
+                    logger.info(f"Эмбеддингов книги {book.book_id} нет на {primary_url}")
+                    continue
+                response.raise_for_status()
+                response.raw.decode_content = True
+                rows = book.import_index(response.raw)
+            # Контрольные точки и задачи относились к собственной индексации книги
+            job_queue.reset_book(book.book_id)
+            logger.info(f"Книга {book.book_id}: получено {rows} из {book.chunks_total} эмбеддингов с {primary_url}")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке индекса книги {book.book_id} с {primary_url}: {str(e)}")
 
-def load_embeddings():
-    """Загрузка эмбеддингов из файла"""
-    global embeddings
-    try:
-        if os.path.exists(EMBEDDINGS_FILE):
-            with open(EMBEDDINGS_FILE, 'r', encoding='utf-8') as f:
-                embeddings = json.load(f)
-            logger.info(f"Эмбеддинги успешно загружены из файла {EMBEDDINGS_FILE}")
-            return True
-        return False
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке эмбеддингов: {str(e)}")
-        return False
+def prepare_library():
+    """Этапы запуска: загрузка книг и индексов, получение токена, прогрев отображенных в память страниц"""
+    with lifecycle.phase("library"):
+        if load_library() is None:
+            raise RuntimeError("Не удалось загрузить книгу")
+    if INDEX_PRIMARY_URL:
+        with lifecycle.phase("pull", required=False):
+            pull_indexes()
+    # Без токена сервер может отвечать из кэша и искать по BM25, поэтому этап необязательный
+    with lifecycle.phase("token", required=False):
+        get_access_token()
+    with lifecycle.phase("warmup", required=False):
+        for book in list(library.books.values()):
+            book.warm()
+    with lifecycle.phase("queue"):
+        enqueue_incomplete_books()
+
+def initialize_book():
+    """Инициализация книг и запуск индексации (вызывается в фоне, пока сервер уже принимает запросы)"""
+    prepare_library()
+    # Все непроиндексированные чанки, включая первые, обрабатываются через очередь задач;
+    # пока эмбеддингов нет, поиск идет по BM25
+    if INGESTION_MODE == 'thread':
+        threading.Thread(target=run_indexing_worker, args=(f"web-{os.getpid()}",), daemon=True).start()
+    else:
+        start_index_refresh()
+    return True
+
+def create_app(start_refresh=True):
+    """Фабрика приложения для многопроцессного WSGI-сервера (wsgi.py, gunicorn.conf.py)
+    
+    Книги загружаются один раз, векторы отображаются в память только для чтения:
+    воркеры, созданные fork после загрузки, делят одни и те же страницы. Эмбеддинги
+    веб-процессы не создают, этим заняты процессы worker.py.
+    start_refresh=False — поток подхвата новых строк запустит сам сервер после fork.
+    """
+    if library.active() is None and not lifecycle.run(prepare_library):
+        raise RuntimeError("Не удалось загрузить книгу")
+    if start_refresh:
+        start_index_refresh()
+    return app
+
+def enqueue_incomplete_books():
+    for book in list(library.books.values()):
+        if not book.complete:
+            enqueue_book(book)
 
-def create_embeddings_with_gigachat(text_chunks):
-    """Создание эмбеддингов с помощью GigaChat API"""
-    global embeddings, processing_complete
+def start_index_refresh():
+    """Запуск потока обновления индексов (один на процесс, в том числе после fork)"""
+    global _refresh_pid
+    with _refresh_lock:
+        if _refresh_pid == os.getpid():
+            return
+        _refresh_pid = os.getpid()
+    threading.Thread(target=refresh_indexes, daemon=True).start()
+
+def wait_until_ready(timeout):
+    """Ожидание индекса активной книги (BM25 или первых эмбеддингов от процессов worker.py)"""
+    deadline = time.time() + timeout
+    while not book_ready():
+        if time.time() > deadline:
+            return False
+        for book in list(library.books.values()):
+            book.refresh()
+        time.sleep(1)
+    return True
+
+def enqueue_book(book):
+    """Постановка непроиндексированных чанков книги в очередь задач"""
+    if book.reindex:
+        # Готовые задачи и контрольные точки относятся к векторам, которые нельзя использовать
+        job_queue.reset_book(book.book_id)
+        semantic_cache.invalidate(book.book_id)
+        book.reindex = False
+    job_queue.enqueue_book(book.book_id, book.chunks_total, JOB_SIZE, start=book.chunks_indexed)
+    book.status = "queued"
+
+def run_indexing_worker(worker_name, exit_when_idle=False):
+    """Цикл воркера: берет задачи из очереди, пока они есть"""
+    logger.info(f"Воркер индексации {worker_name} запущен")
+    while True:
+        job = job_queue.claim(worker_name, lease=JOB_LEASE)
+        if job is None:
+            # Занятые задачи упавших воркеров вернутся в очередь после окончания аренды
+            if exit_when_idle and not job_queue.has_work():
+                return
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        process_job(job)
+
+def process_job(job):
+    """Создание эмбеддингов для диапазона чанков с контрольной точкой после каждого пакета"""
+    job_id, book_id, start, end = job
+    book = library.get(book_id)
+    if book is None:
+        # Книгу могли загрузить через другой веб-процесс
+        load_uploaded_books()
+        book = library.get(book_id)
+    if book is None:
+        job_queue.fail(job_id, f"Книга {book_id} не найдена")
+        return
     
     try:
-        token = get_access_token()
-        
-        for i, chunk in enumerate(text_chunks, 1):
-            logger.info(f"Обработка чанка {i}/{len(text_chunks)}")
-            
-            # Добавляем задержку между запросами, чтобы избежать ошибки 429
-            if i > 1:
-                time.sleep(1)  # Задержка 1 секунда между запросами
-            
-            headers = {
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                f"{GIGACHAT_API_URL}/embeddings",
-                headers=headers,
-                json={
-                    "model": "Embeddings",
-                    "input": chunk,
-                    "encoding_type": "float"
-                },
-                verify=False
-            )
-            
-            if response.status_code == 401:
-                # Если токен истек, получаем новый
-                token = get_access_token()
-                response = requests.post(
-                    f"{GIGACHAT_API_URL}/embeddings",
-                    headers={**headers, "Authorization": f"Bearer {token}"},
-                    json={
-                        "model": "Embeddings",
-                        "input": chunk,
-                        "encoding_type": "float"
-                    },
-                    verify=False
-                )
-            
-            if response.status_code == 429:
-                # Если превышен лимит запросов, ждем 5 секунд и пробуем снова
-                logger.warning("Превышен лимит запросов. Ожидание 5 секунд...")
-                time.sleep(5)
-                i -= 1  # Повторяем этот чанк
-                continue
-                
-            response.raise_for_status()
-            data = response.json()
+        book.status = "indexing"
+        book.refresh()
+        # Продолжаем с первого чанка, для которого нет ни строки в хранилище, ни контрольной точки
+        first = job_queue.checkpointed_until(book_id, max(start, book.chunks_indexed), end)
+        if first < end:
+            def checkpoint(start_index, vectors):
+                job_queue.save_vectors(book_id, start_index, vectors)
+                job_queue.heartbeat(job_id, lease=JOB_LEASE)
             
-            embeddings.append(data["data"][0]["embedding"])
-            logger.info(f"Успешно создан эмбеддинг для чанка {i}")
-            
-            # Сохраняем эмбеддинги каждые 10 чанков
-            if i % 10 == 0:
-                save_embeddings()
-        
-        logger.info("Эмбеддинги успешно созданы")
-        save_embeddings()  # Сохраняем финальный результат
-        return True
+            pipeline = create_pipeline(book, checkpoint)
+            pipeline.run(book.get_chunks(first, end), start_index=first)
+        job_queue.complete(job_id)
+        commit_book(book)
+        logger.info(f"Книга {book_id}: обработаны чанки {start}-{end}, в индексе {book.chunks_indexed} из {book.chunks_total}")
+        if book.complete:
+            logger.info(book.profile.report())
     except Exception as e:
-        logger.error(f"Ошибка при создании эмбеддингов: {str(e)}")
-        return False
+        logger.error(f"Ошибка при обработке задачи {job_id} (книга {book_id}, чанки {start}-{end}): {str(e)}")
+        job_queue.fail(job_id, e)
+        book.status = "failed"
 
-def initialize_book():
-    """Инициализация книги и создание эмбеддингов при запуске сервера"""
-    global processing_complete
-    
-    if not load_book_from_file():
-        logger.error("Не удалось загрузить книгу")
-        return False
-    
-    # Пробуем загрузить существующие эмбеддинги
-    if load_embeddings():
-        logger.info("Используем существующие эмбеддинги")
-        processing_complete = True
-        return True
-    
-    # Если эмбеддинги не найдены, создаем новые
-    logger.info("Существующие эмбеддинги не найдены, создаем новые")
-    
-    # Разбиваем текст на чанки по 150 символов
-    chunks = [text[i:i+150] for i in range(0, len(text), 150)]
-    
-    # Ограничиваем количество чанков для быстрого запуска
-    # Полностью обработаем только первые 50 чанков
-    initial_chunks = chunks[:50]
-    logger.info(f"Запуск сервера с обработкой {len(initial_chunks)} из {len(chunks)} чанков")
-    
-    if not create_embeddings_with_gigachat(initial_chunks):
-        logger.error("Не удалось создать эмбеддинги")
-        return False
+def commit_book(book):
+    """Перенос готовых контрольных точек книги в хранилище эмбеддингов"""
+    def get_start():
+        book.refresh()
+        return book.chunks_indexed
     
-    # Запускаем фоновую задачу для обработки остальных чанков
-    threading.Thread(target=process_remaining_chunks, args=(chunks[50:],), daemon=True).start()
-    
-    return True
+    if job_queue.commit_ready(book.book_id, get_start, book.save_embeddings):
+        book.save_index()
+    if book.complete:
+        book.status = "ready"
 
-def process_remaining_chunks(remaining_chunks):
-    """Обработка оставшихся чанков в фоновом режиме"""
-    global processing_complete
-    
-    if not remaining_chunks:
-        processing_complete = True
-        return
+def refresh_indexes():
+    """Подхват книг, строк индекса и активной книги, измененных другими процессами"""
+    while True:
+        try:
+            load_uploaded_books()
+            library.load_active()
+            for book in list(library.books.values()):
+                book.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении индексов: {str(e)}")
+        time.sleep(INDEX_REFRESH_INTERVAL)
+
+def indexing_complete():
+    """Все книги проиндексированы или в очереди не осталось задач"""
+    books = list(library.books.values())
+    return all(book.complete for book in books) or not job_queue.has_work()
+
+def question_key(question):
+    """Ключ кэша эмбеддинга вопроса: векторы разных поставщиков не смешиваются"""
+    return make_key(embedder.tag, normalize_question(question))
+
+def embed_question(question):
+    """Эмбеддинг вопроса с кэшированием по нормализованному тексту"""
+    key = question_key(question)
+    with metrics.span("embed_query"):
+        question_embedding = query_cache.get(key)
+        if question_embedding is None:
+            def fetch():
+                vector = [float(x) for x in embed_texts([question])[0]]
+                query_cache.set(key, vector)
+                return vector
+            question_embedding = query_flight.do(key, fetch)
+    return question_embedding
+
+def embed_question_or_none(question):
+    """Эмбеддинг вопроса или None, если API ограничивает частоту или отвечает слишком долго"""
+    global _embedding_backoff_until
+    if time.time() < _embedding_backoff_until:
+        return query_cache.get(question_key(question))
     
-    logger.info(f"Начало фоновой обработки {len(remaining_chunks)} оставшихся чанков")
+    # Запрос продолжается в фоне и после таймаута: результат попадет в кэш
+    future = query_executor.submit(contextvars.copy_context().run, embed_question, question)
     try:
-        # Обрабатываем чанки небольшими партиями, чтобы избежать ошибки 429
-        batch_size = 20
-        for i in range(0, len(remaining_chunks), batch_size):
-            batch = remaining_chunks[i:i+batch_size]
-            logger.info(f"Обработка партии {i//batch_size + 1}/{(len(remaining_chunks) + batch_size - 1)//batch_size}")
-            create_embeddings_with_gigachat(batch)
-            # Делаем паузу между партиями
-            time.sleep(5)
-        
-        logger.info("Фоновая обработка чанков завершена")
-        processing_complete = True
+        return future.result(timeout=QUERY_EMBEDDING_TIMEOUT)
+    except FutureTimeoutError:
+        logger.warning(f"Эмбеддинг вопроса не получен за {QUERY_EMBEDDING_TIMEOUT} с, используем только BM25")
+    except RateLimitError as e:
+        _embedding_backoff_until = time.time() + (e.retry_after or 5)
+        logger.warning("Превышен лимит запросов эмбеддингов, используем только BM25")
+    except Overloaded:
+        logger.warning("Очередь запросов к API переполнена, используем только BM25")
     except Exception as e:
-        logger.error(f"Ошибка при фоновой обработке чанков: {str(e)}")
-        processing_complete = True
+        logger.error(f"Ошибка при создании эмбеддинга вопроса: {str(e)}")
+    return None
 
-def find_relevant_contexts(question, max_contexts=5):
-    """Поиск всех релевантных контекстов в книге"""
+def embed_questions(questions):
+    """Эмбеддинги списка вопросов пакетными запросами; найденные в кэше не запрашиваются"""
+    keys = [question_key(question) for question in questions]
+    vectors = [query_cache.get(key) for key in keys]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    with metrics.span("embed_query_batch"):
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+            for i, vector in zip(batch, embed_texts([questions[i] for i in batch])):
+                vectors[i] = [float(x) for x in vector]
+                query_cache.set(keys[i], vectors[i])
+    return vectors
+
+def find_batch_contexts(questions, book=None, max_contexts=CONTEXT_CANDIDATES, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Контексты для списка вопросов: пакетные эмбеддинги и один поиск на весь список (по умолчанию в активной книге)"""
+    book = book or library.active()
+    question_embeddings = None
+    if RETRIEVAL_MODE != 'lexical' and book.chunks_indexed:
+        question_embeddings = embed_questions(questions)
+    alpha = {'vector': 1.0, 'lexical': 0.0}.get(RETRIEVAL_MODE, HYBRID_ALPHA)
+    contexts = [None] * len(questions)
+    if question_embeddings is not None:
+        contexts = [semantic_lookup(book, vector) for vector in question_embeddings]
+        RETRIEVALS.inc(sum(context is not None for context in contexts), mode='cache')
+    missing = [i for i, context in enumerate(contexts) if context is None]
+    RETRIEVALS.inc(len(missing), mode='lexical' if question_embeddings is None else RETRIEVAL_MODE)
+    if missing:
+        vectors = [question_embeddings[i] for i in missing] if question_embeddings is not None else None
+        with metrics.span("search_batch"):
+            ids_list = book.search_batch([questions[i] for i in missing], vectors, max_contexts, alpha=alpha)
+        with metrics.span("context"):
+            for i, ids in zip(missing, ids_list):
+                contexts[i] = assemble_context(book.text, book.offsets, ids, token_budget)
+                if question_embeddings is not None:
+                    contexts[i] = semantic_remember(book, question_embeddings[i], contexts[i])
+    for context in contexts:
+        CONTEXT_TOKENS.observe(context.tokens)
+    return contexts
+
+def create_batch_runner(book=None, concurrency=BATCH_CONCURRENCY, batch_size=BATCH_SIZE):
+    """Пакетный прогон вопросов по книге (по умолчанию активной) с поиском и генерацией ответов этого процесса"""
+    return BatchRunner(
+        lambda questions: find_batch_contexts(questions, book),
+        answer_question,
+        concurrency=concurrency,
+        batch_size=batch_size
+    )
+
+def build_messages(question, relevant_context):
+    """Сообщения для чат-модели"""
+    with metrics.span("prompt"):
+        return _build_messages(question, relevant_context)
+
+def _build_messages(question, relevant_context):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": f"""Контекст из книги:
+{relevant_context}
+
+Вопрос: {question}
+
+Пожалуйста, опиши альтернативный сценарий развития событий, сохраняя стиль и атмосферу книги."""
+        }
+    ]
+
+def generate_alternative_history(question, relevant_context):
+    """Генерация ответа с кэшированием по (вопрос, контекст, параметры модели)"""
+    key = make_key(normalize_question(question), text_hash(relevant_context), COMPLETION_PARAMS)
+    alternative_history = answer_cache.get(key)
+    if alternative_history is None:
+        def fetch():
+            answer = client.chat_completion(build_messages(question, relevant_context), **COMPLETION_PARAMS)
+            answer_cache.set(key, answer)
+            return answer
+        alternative_history = answer_flight.do(key, fetch)
+    else:
+        logger.info("Ответ взят из кэша")
+    return alternative_history
+
+def stream_alternative_history(question, relevant_context):
+    """Потоковая генерация ответа; полный ответ сохраняется в кэш после завершения"""
+    key = make_key(normalize_question(question), text_hash(relevant_context), COMPLETION_PARAMS)
+    alternative_history = answer_cache.get(key)
+    if alternative_history is not None:
+        logger.info("Ответ взят из кэша")
+        yield alternative_history
+        return
+    
+    parts = []
+    for part in client.chat_completion_stream(build_messages(question, relevant_context), **COMPLETION_PARAMS):
+        parts.append(part)
+        yield part
+    answer_cache.set(key, "".join(parts))
+
+def semantic_lookup(book, question_embedding):
+    """Контекст (и, может быть, ответ) из семантического кэша для близкого вопроса или None"""
+    hit = semantic_cache.lookup(book.book_id, question_embedding, version=book.chunks_indexed)
+    if hit is None:
+        return None
+    key, context, answer, similarity = hit
+    logger.info(f"Контекст взят из семантического кэша (близость {similarity:.3f}, ответ: {'да' if answer else 'нет'})")
+    return context.cached(key, answer)
+
+def semantic_remember(book, question_embedding, context):
+    """Сохранение найденного контекста в семантический кэш
+
+    Пока книга индексируется, результаты поиска меняются, поэтому
+    сохраняются только контексты полностью проиндексированных книг.
+    """
+    if not context or not book.complete:
+        return context
+    return context.cached(semantic_cache.add(book.book_id, question_embedding, context, version=book.chunks_indexed))
+
+def answer_question(question, context):
+    """Ответ по найденному контексту: готовый из семантического кэша или сгенерированный"""
+    if context.answer is not None:
+        return context.answer
+    answer = generate_alternative_history(question, context.text)
+    if context.cache_key is not None:
+        semantic_cache.set_answer(context.cache_key, answer)
+    return answer
+
+def stream_answer(question, context):
+    """Потоковый ответ по найденному контексту; готовый ответ из кэша отдается одной частью"""
+    if context.answer is not None:
+        yield context.answer
+        return
+    parts = []
+    for part in stream_alternative_history(question, context.text):
+        parts.append(part)
+        yield part
+    if context.cache_key is not None:
+        semantic_cache.set_answer(context.cache_key, "".join(parts))
+
+def sse_event(event, data):
+    """Форматирование события Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def find_relevant_contexts(question, book=None, max_contexts=CONTEXT_CANDIDATES, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Контекст из книги (по умолчанию активной) для вопроса (AssembledContext) или None при ошибке
+
+    Пустой контекст — BM25 не нашел слов вопроса, а векторный поиск недоступен:
+    эмбеддингов еще нет или эмбеддинг вопроса не получен (429, таймаут).
+    """
     try:
         logger.info("Поиск релевантных контекстов")
-        # Создаем эмбеддинг для вопроса
-        token = get_access_token()
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(
-            f"{GIGACHAT_API_URL}/embeddings",
-            headers=headers,
-            json={
-                "model": "Embeddings",
-                "input": question,
-                "encoding_type": "float"
-            },
-            verify=False
-        )
-        
-        if response.status_code == 401:
-            token = get_access_token()
-            headers["Authorization"] = f"Bearer {token}"
-            response = requests.post(
-                f"{GIGACHAT_API_URL}/embeddings",
-                headers=headers,
-                json={
-                    "model": "Embeddings",
-                    "input": question,
-                    "encoding_type": "float"
-                },
-                verify=False
-            )
+        book = book or library.active()
+        # Создаем эмбеддинг для вопроса (или берем из кэша); без него ищем только по BM25
+        question_embedding = None
+        if RETRIEVAL_MODE != 'lexical' and book.chunks_indexed:
+            question_embedding = embed_question_or_none(question)
+        alpha = {'vector': 1.0, 'lexical': 0.0}.get(RETRIEVAL_MODE, HYBRID_ALPHA)
         
-        response.raise_for_status()
-        question_embedding = response.json()["data"][0]["embedding"]
+        # Перефразированный вопрос, заданный раньше: поиск не нужен
+        if question_embedding is not None:
+            context = semantic_lookup(book, question_embedding)
+            if context is not None:
+                RETRIEVALS.inc(mode='cache')
+                CONTEXT_TOKENS.observe(context.tokens)
+                return context
         
-        # Находим все релевантные контексты
-        similarities = []
-        for i, embedding in enumerate(embeddings):
-            similarity = sum(a * b for a, b in zip(question_embedding, embedding))
-            start_idx = i * 150
-            end_idx = min(start_idx + 150, len(text))
-            context = text[start_idx:end_idx]
-            similarities.append((similarity, context))
+        if question_embedding is None:
+            RETRIEVALS.inc(mode='lexical')
+        else:
+            RETRIEVALS.inc(mode=RETRIEVAL_MODE)
         
-        # Сортируем по релевантности и берем top-N
-        similarities.sort(reverse=True)
-        relevant_contexts = [ctx for _, ctx in similarities[:max_contexts]]
+        # Находим top-N релевантных чанков: BM25 и матрично-векторное произведение
+        with metrics.span("search"):
+            ids = book.search(question, question_embedding, max_contexts, alpha=alpha)
+            if len(ids) == 0 and question_embedding is None and RETRIEVAL_MODE == 'lexical' and book.chunks_indexed:
+                # В вопросе нет слов из книги: эмбеддинг нужен и в лексическом режиме
+                question_embedding = embed_question_or_none(question)
+                if question_embedding is not None:
+                    ids = book.search(question, question_embedding, max_contexts, alpha=alpha)
         
-        # Объединяем контексты
-        combined_context = "\n\n".join(relevant_contexts)
-        logger.info(f"Найдено {len(relevant_contexts)} релевантных контекстов")
-        return combined_context
+        # Сливаем соседние чанки по их смещениям в книге и укладываемся в бюджет токенов
+        with metrics.span("context"):
+            context = assemble_context(book.text, book.offsets, ids, token_budget)
+        if question_embedding is not None:
+            context = semantic_remember(book, question_embedding, context)
+        CONTEXT_TOKENS.observe(context.tokens)
+        logger.info(
+            f"Найдено {len(ids)} релевантных чанков, в контекст вошло {context.hits} "
+            f"({len(context.spans)} фрагментов, {context.tokens} токенов)"
+        )
+        return context
         
     except Exception as e:
         logger.error(f"Ошибка при поиске релевантных контекстов: {str(e)}")
         return None
 
+def overloaded_response(retry_after, message="Сервис перегружен. Повторите запрос позже."):
+    """Ответ 503 с Retry-After: API перегружен или ограничивает частоту запросов"""
+    response = jsonify({"error": message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after or 1)))
+    return response
+
+def no_context_message(book):
+    """Причина пустого контекста для ответа 503"""
+    if not book.complete:
+        return "Книга еще индексируется, контекст для этого вопроса пока не найден. Повторите запрос позже."
+    return "Поиск по смыслу временно недоступен, контекст для этого вопроса не найден. Повторите запрос позже."
+
+def book_ready(book=None):
+    """Книга (по умолчанию активная) загружена и для нее есть BM25-индекс или хотя бы часть эмбеддингов"""
+    book = book or library.active()
+    return bool(book and book.text and (book.lexical or book.chunks_indexed))
+
+def requested_book(data=None):
+    """Книга из параметра book_id (в теле JSON или в строке запроса) или активная книга
+
+    Возвращает (книга, ответ с ошибкой); для неизвестного book_id — 404.
+    """
+    book_id = (data or {}).get('book_id') or request.args.get('book_id')
+    if not book_id:
+        return library.active(), None
+    book = library.get(book_id)
+    if book is None:
+        return None, (jsonify({"error": f"Книга {book_id} не найдена"}), 404)
+    return book, None
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    # Потоки сервера переиспользуются, поэтому трассировку сбрасываем на каждом запросе
+    if request.headers.get(TRACE_HEADER):
+        g.trace = metrics.start_trace()
+    else:
+        g.trace = None
+        metrics.stop_trace()
+
+@app.after_request
+def finish_request_metrics(response):
+    if g.get('trace'):
+        response.headers['Server-Timing'] = metrics.server_timing(g.trace)
+    if metrics.ENABLED and 'request_started' in g:
+        started = g.request_started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method, status = request.method, response.status_code
+        # Потоковый ответ завершается после after_request: время фиксируем при закрытии
+        response.call_on_close(
+            lambda: REQUEST_SECONDS.observe(time.perf_counter() - started, route=route, method=method, status=status)
+        )
+    return response
+
+@app.after_request
+def compress(response):
+    return compress_response(response, request.accept_encodings, min_size=COMPRESS_MIN_SIZE)
+
 @app.route('/')
 def index():
     """Отдача главной страницы"""
@@ -341,116 +799,283 @@ def analyze_text():
         question = data['text']
         logger.info(f"Вопрос для анализа: {question[:50]}...")
         
+        book, error = requested_book(data)
+        if error:
+            return error
+        
         # Проверяем, загружена ли книга и созданы ли эмбеддинги
-        if not text or not embeddings:
+        if not book_ready(book):
             logger.error("Книга не загружена или эмбеддинги не созданы")
             return jsonify({"error": "Сервер не готов к обработке запросов. Пожалуйста, подождите."}), 503
         
+        # Если очередь к API не уложится в бюджет задержки, отказываем сразу, не занимая поток
+        try:
+            client.scheduler.admit()
+        except Overloaded as e:
+            logger.warning(str(e))
+            return overloaded_response(e.retry_after)
+        
         # Получаем расширенный контекст
-        relevant_context = find_relevant_contexts(question)
-        if not relevant_context:
+        relevant_context = find_relevant_contexts(question, book)
+        if relevant_context is None:
             return jsonify({"error": "Ошибка при поиске контекста"}), 500
+        if not relevant_context:
+            logger.warning("Контекст для вопроса не найден: BM25 без совпадений, векторный поиск недоступен")
+            return overloaded_response(INDEX_REFRESH_INTERVAL, no_context_message(book))
         
         # Генерируем альтернативную историю
         try:
             logger.info("Генерация альтернативной истории")
-            token = get_access_token()
-            headers = {
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(
-                f"{GIGACHAT_API_URL}/chat/completions",
-                headers=headers,
-                json={
-                    "model": "GigaChat",
-                    "messages": [
-                        {
-                            "role": "system", 
-                            "content": """Ты - эксперт по альтернативной истории и литературному анализу. 
-                            Твоя задача - на основе предоставленного контекста из книги создать правдоподобный 
-                            сценарий развития событий. Используй стиль и атмосферу оригинального текста, 
-                            сохраняй характерные особенности повествования. Ответ должен быть в том же стиле, 
-                            что и книга, с похожими описаниями и атмосферой."""
-                        },
-                        {
-                            "role": "user", 
-                            "content": f"""Контекст из книги:
-                            {relevant_context}
-                            
-                            Вопрос: {question}
-                            
-                            Пожалуйста, опиши альтернативный сценарий развития событий, сохраняя стиль и атмосферу книги."""
-                        }
-                    ],
-                    "temperature": 0.7,
-                    "max_tokens": 1000
-                },
-                verify=False
-            )
-            
-            if response.status_code == 401:
-                token = get_access_token()
-                headers["Authorization"] = f"Bearer {token}"
-                response = requests.post(
-                    f"{GIGACHAT_API_URL}/chat/completions",
-                    headers=headers,
-                    json={
-                        "model": "GigaChat",
-                        "messages": [
-                            {
-                                "role": "system", 
-                                "content": """Ты - эксперт по альтернативной истории и литературному анализу. 
-                                Твоя задача - на основе предоставленного контекста из книги создать правдоподобный 
-                                сценарий развития событий. Используй стиль и атмосферу оригинального текста, 
-                                сохраняй характерные особенности повествования. Ответ должен быть в том же стиле, 
-                                что и книга, с похожими описаниями и атмосферой."""
-                            },
-                            {
-                                "role": "user", 
-                                "content": f"""Контекст из книги:
-                                {relevant_context}
-                                
-                                Вопрос: {question}
-                                
-                                Пожалуйста, опиши альтернативный сценарий развития событий, сохраняя стиль и атмосферу книги."""
-                            }
-                        ],
-                        "temperature": 0.7,
-                        "max_tokens": 1000
-                    },
-                    verify=False
-                )
-            
-            response.raise_for_status()
-            alternative_history = response.json()["choices"][0]["message"]["content"]
+            alternative_history = answer_question(question, relevant_context)
             logger.info("Альтернативная история успешно сгенерирована")
+        except FlightTimeout as e:
+            logger.error(f"Ошибка при генерации альтернативной истории: {str(e)}")
+            return jsonify({"error": "Превышено время ожидания ответа"}), 504
+        except (Overloaded, RateLimitError) as e:
+            logger.warning(f"Ответ не сгенерирован: {str(e)}")
+            return overloaded_response(e.retry_after)
         except Exception as e:
             logger.error(f"Ошибка при генерации альтернативной истории: {str(e)}")
             return jsonify({"error": "Ошибка при генерации ответа"}), 500
         
         return jsonify({
             "question": question,
-            "alternative_history": alternative_history
+            "book_id": book.book_id,
+            "alternative_history": alternative_history,
+            "context_tokens": relevant_context.tokens
         })
     
     except Exception as e:
         logger.error(f"Необработанная ошибка при анализе текста: {str(e)}")
         return jsonify({"error": f"Внутренняя ошибка сервера: {str(e)}"}), 500
 
+@app.route('/analyze_stream', methods=['POST', 'OPTIONS'])
+def analyze_text_stream():
+    """Анализ текста с потоковой передачей ответа через Server-Sent Events"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    data = request.get_json(silent=True)
+    if not data or 'text' not in data:
+        logger.error("Текст не предоставлен в запросе")
+        return jsonify({"error": "Текст не предоставлен"}), 400
+    
+    question = data['text']
+    logger.info(f"Вопрос для потокового анализа: {question[:50]}...")
+    
+    book, error = requested_book(data)
+    if error:
+        return error
+    
+    if not book_ready(book):
+        logger.error("Книга не загружена или эмбеддинги не созданы")
+        return jsonify({"error": "Сервер не готов к обработке запросов. Пожалуйста, подождите."}), 503
+    
+    try:
+        client.scheduler.admit()
+    except Overloaded as e:
+        logger.warning(str(e))
+        return overloaded_response(e.retry_after)
+    
+    trace = g.trace
+    
+    def generate():
+        # Сразу отправляем первое событие, чтобы клиент получил заголовки без ожидания API
+        yield sse_event("start", {"question": question, "book_id": book.book_id})
+        relevant_context = find_relevant_contexts(question, book)
+        if relevant_context is None:
+            yield sse_event("error", {"error": "Ошибка при поиске контекста"})
+            return
+        if not relevant_context:
+            logger.warning("Контекст для вопроса не найден: BM25 без совпадений, векторный поиск недоступен")
+            yield sse_event("error", {"error": no_context_message(book), "retry_after": INDEX_REFRESH_INTERVAL})
+            return
+        try:
+            for part in stream_answer(question, relevant_context):
+                yield sse_event("token", {"text": part})
+            # Заголовки уже отправлены, поэтому этапы трассировки передаем в последнем событии
+            done = {"context_tokens": relevant_context.tokens}
+            if trace is not None:
+                done["timings"] = metrics.server_timing(trace)
+            yield sse_event("done", done)
+            logger.info("Альтернативная история успешно сгенерирована")
+        except (Overloaded, RateLimitError) as e:
+            # Заголовки уже отправлены: пауза передается в событии ошибки
+            logger.warning(f"Ответ не сгенерирован: {str(e)}")
+            yield sse_event("error", {"error": "Сервис перегружен. Повторите запрос позже.", "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"Ошибка при потоковой генерации альтернативной истории: {str(e)}")
+            yield sse_event("error", {"error": "Ошибка при генерации ответа"})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/analyze_batch', methods=['POST', 'OPTIONS'])
+def analyze_batch():
+    """Пакетный анализ: вопросы в теле запроса (JSONL), ответы потоком JSONL в том же порядке
+    
+    Результаты сохраняются в BATCH_DIR под batch_id (параметр запроса или хеш тела):
+    повторная отправка того же пакета отдает готовые ответы и догенерирует остальные.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    body = request.get_data(as_text=True)
+    try:
+        items = parse_questions(body.splitlines())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not items:
+        return jsonify({"error": "Вопросы не предоставлены"}), 400
+    
+    book, error = requested_book()
+    if error:
+        return error
+    
+    if not book_ready(book):
+        logger.error("Книга не загружена или эмбеддинги не созданы")
+        return jsonify({"error": "Сервер не готов к обработке запросов. Пожалуйста, подождите."}), 503
+    
+    batch_id = request.args.get('batch_id') or text_hash(f"{book.book_id}\n{body}")[:16]
+    if not batch_id.replace('-', '').replace('_', '').isalnum():
+        return jsonify({"error": "Некорректный batch_id"}), 400
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    output_path = os.path.join(BATCH_DIR, f"{batch_id}.jsonl")
+    logger.info(f"Пакетный анализ {batch_id}: {len(items)} вопросов")
+    
+    def generate():
+        for result in create_batch_runner(book).run(items, output_path):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"X-Batch-Id": batch_id, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/upload_book', methods=['POST', 'OPTIONS'])
+def upload_book():
+    """Загрузка книги: потоковая запись на диск, дедупликация и фоновая индексация"""
+    if request.method == 'OPTIONS':
+        return '', 204
+    
+    try:
+        # Поддерживаем как multipart/form-data, так и тело запроса с самим файлом
+        if 'file' in request.files:
+            upload = request.files['file']
+            stream, filename = upload.stream, upload.filename
+        else:
+            stream, filename = request.stream, request.args.get('filename', 'book.txt')
+        
+        if not filename or not filename.lower().endswith('.txt'):
+            return jsonify({"error": "Поддерживаются только файлы .txt"}), 400
+        
+        book_id, is_new = library.import_upload(stream, filename)
+        book = library.get(book_id)
+        if book is None:
+            text_path, store_path, _ = library.book_paths(book_id)
+            book = new_book(book_id, text_path, store_path, filename)
+            open_book(book)
+            library.add(book)
+        
+        library.activate(book_id)
+        if not book.complete:
+            enqueue_book(book)
+        
+        logger.info(f"Книга {filename} загружена как {book_id}, новая: {is_new}")
+        return jsonify({
+            "status": "success",
+            "book_id": book_id,
+            "duplicate": not is_new,
+            "chunks_count": book.chunks_total,
+            "chunks_indexed": book.chunks_indexed
+        })
+    except UnicodeDecodeError:
+        return jsonify({"error": "Не удалось определить кодировку файла"}), 400
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке книги: {str(e)}")
+        return jsonify({"error": f"Ошибка при загрузке книги: {str(e)}"}), 500
+
 @app.route('/status')
 def status():
     """Проверка статуса сервера"""
+    active = library.active()
     return jsonify({
         "status": "ok",
-        "book_loaded": bool(text and embeddings),
-        "processing_complete": processing_complete
+        "startup": lifecycle.state,
+        "book_loaded": book_ready(),
+        "processing_complete": indexing_complete(),
+        "active_book": active.book_id if active else None,
+        "books": [book.progress() for book in list(library.books.values())],
+        "jobs": job_queue.progress(),
+        # Профиль индексации в этом процессе: время этапов, скорость, паузы после 429
+        "ingestion": {book.book_id: book.profile.summary() for book in list(library.books.values()) if book.profile.started},
+        "upstream": client.scheduler.stats(),
+        "caches": {
+            "query_embeddings": query_cache.stats(),
+            "answers": answer_cache.stats(),
+            "semantic": semantic_cache.stats()
+        }
     })
 
+@app.route('/healthz')
+def healthz():
+    """Проверка живости: процесс отвечает, даже если книги еще загружаются"""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readyz():
+    """Проверка готовности: книги загружены, индекс прогрет; 503 до этого момента"""
+    books = list(library.books.values())
+    total = sum(book.chunks_total for book in books)
+    indexed = sum(book.chunks_indexed for book in books)
+    ready = lifecycle.ready and book_ready()
+    return jsonify({
+        "ready": ready,
+        "startup": lifecycle.snapshot(),
+        "percent_indexed": round(100.0 * indexed / total, 1) if total else 0.0,
+        "chunks_indexed": indexed,
+        "chunks_total": total
+    }), 200 if ready else 503
+
+@app.route('/export_index')
+def export_index():
+    """Бинарный экспорт эмбеддингов книги для реплик: заголовок, таблица чанков и блоки векторов
+    
+    Книга — параметр book_id (по умолчанию активная), dtype=float16 вдвое
+    уменьшает объем. Экспорт отдается потоком, без сжатия: векторы почти не сжимаются.
+    """
+    book, error = requested_book()
+    if error:
+        return error
+    if book is None:
+        return jsonify({"error": "Книга не загружена"}), 404
+    try:
+        size, blocks = book.export_index(request.args.get('dtype', 'float32'))
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    logger.info(f"Экспорт индекса книги {book.book_id}: {size} байт")
+    response = Response(blocks, mimetype='application/octet-stream', direct_passthrough=True)
+    response.headers['Content-Length'] = str(size)
+    response.headers['X-Book-Id'] = book.book_id
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 if __name__ == '__main__':
-    if initialize_book():
-        logger.info("Сервер успешно инициализирован")
-        app.run(debug=True)
-    else:
-        logger.error("Не удалось инициализировать сервер") 
\ No newline at end of file
+    # Перезагрузчик отладочного сервера запускает приложение в дочернем процессе:
+    # книги загружаем только там, где обрабатываются запросы
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        lifecycle.start(initialize_book)
+    # Сервер разработки; для нескольких процессов: gunicorn -c gunicorn.conf.py wsgi:app
+    # Сервер принимает запросы сразу, книги и индекс загружаются в фоне (см. /readyz)
+    # Многопоточный сервер: потоковые ответы не блокируют остальные запросы
+    app.run(debug=True, threaded=True) 
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""Пакетный прогон вопросов из JSONL: python batch.py questions.jsonl -o results.jsonl
+
+Каждая строка входа — JSON с полем "text" (как в POST /analyze) и, по желанию,
+"id". Эмбеддинги вопросов запрашиваются пакетами, контексты ищутся одним
+матричным произведением на пакет, ответы генерируются ограниченным пулом потоков
+с фоновым приоритетом (интерактивные запросы сервера обслуживаются раньше).
+Результаты выводятся в порядке входа. Если файл результатов уже есть, готовые
+ответы берутся из него: прерванный прогон продолжается с места остановки.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from gigachat_client import RateLimitError
+from scheduler import BULK, priority
+
+logger = logging.getLogger(__name__)
+
+BATCH_QUESTIONS = metrics.Counter("batch_questions_total", "Вопросы пакетных прогонов по результату", ["outcome"])
+
+
+def parse_questions(lines):
+    """Вопросы из строк JSONL: [{"id", "text"}]; без id номером вопроса служит номер строки"""
+    items, seen = [], set()
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Строка {number}: некорректный JSON ({str(e)})")
+        if isinstance(data, str):
+            data = {"text": data}
+        text = data.get("text") or data.get("question") if isinstance(data, dict) else None
+        if not text:
+            raise ValueError(f"Строка {number}: нет поля text")
+        item_id = str(data.get("id", number))
+        if item_id in seen:
+            raise ValueError(f"Строка {number}: повторяющийся id {item_id}")
+        seen.add(item_id)
+        items.append({"id": item_id, "text": text})
+    return items
+
+
+def load_results(path):
+    """Успешные результаты прошлого прогона по id (ответы с ошибкой будут получены заново)"""
+    done = {}
+    if not path or not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # Строка, которую не успели дописать при остановке
+                continue
+            if "error" not in result:
+                done[result["id"]] = result
+    return done
+
+
+class BatchRunner:
+    """Прогон списка вопросов окнами по batch_size
+
+    prepare(texts) возвращает контексты всех вопросов окна (пакетные
+    эмбеддинги и поиск), answer(text, context) — ответ модели. Пока пул
+    генерирует ответы одного окна, готовится следующее. Ответ 429 не
+    считается ошибкой: запрос повторяется после паузы.
+    """
+
+    def __init__(self, prepare, answer, concurrency=4, batch_size=64, retries=5):
+        self.prepare = prepare
+        self.answer = answer
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.retries = retries
+
+    def _call(self, fn, *args):
+        with priority(BULK):
+            for attempt in range(self.retries + 1):
+                try:
+                    return fn(*args)
+                except RateLimitError as e:
+                    if attempt == self.retries:
+                        raise
+                    pause = e.retry_after or min(2 ** attempt, 30)
+                    logger.warning(f"Пакетный прогон: превышен лимит запросов, повтор через {pause} с")
+                    time.sleep(pause)
+
+    def _answer(self, item, context):
+        if not context:
+            raise ValueError("Контекст не найден")
+        answer = self._call(self.answer, item["text"], context)
+        return {
+            "id": item["id"],
+            "question": item["text"],
+            "alternative_history": answer,
+            "context_tokens": context.tokens
+        }
+
+    def _submit(self, executor, window):
+        """Подготовка окна и постановка генерации ответов в пул: [(item, future или ошибка)]"""
+        if not window:
+            return []
+        try:
+            contexts = self._call(self.prepare, [item["text"] for item in window])
+        except Exception as e:
+            logger.error(f"Пакетный прогон: ошибка при поиске контекстов: {str(e)}")
+            return [(item, e) for item in window]
+        return [(item, executor.submit(self._answer, item, context)) for item, context in zip(window, contexts)]
+
+    def run(self, items, output_path=None):
+        """Генератор результатов в порядке items; новые результаты дописываются в output_path"""
+        done = load_results(output_path)
+        if done:
+            logger.info(f"Пакетный прогон: {len(done)} из {len(items)} вопросов уже обработаны")
+        output = open(output_path, "a", encoding="utf-8") if output_path else None
+        windows = [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch")
+        try:
+            pending = self._submit(executor, [item for item in windows[0] if item["id"] not in done]) if windows else []
+            for number, window in enumerate(windows):
+                current = {item["id"]: task for item, task in pending}
+                following = windows[number + 1] if number + 1 < len(windows) else []
+                pending = self._submit(executor, [item for item in following if item["id"] not in done])
+                for item in window:
+                    if item["id"] in done:
+                        BATCH_QUESTIONS.inc(outcome="resumed")
+                        yield done[item["id"]]
+                        continue
+                    result = self._result(item, current[item["id"]])
+                    if output is not None:
+                        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                        output.flush()
+                    yield result
+        finally:
+            # Прогон прерван (например, клиент отключился): еще не начатые ответы не запрашиваем
+            executor.shutdown(wait=True, cancel_futures=True)
+            if output is not None:
+                output.close()
+
+    @staticmethod
+    def _result(item, task):
+        try:
+            if isinstance(task, Exception):
+                raise task
+            result = task.result()
+            BATCH_QUESTIONS.inc(outcome="ok")
+            return result
+        except Exception as e:
+            logger.error(f"Пакетный прогон: ошибка для вопроса {item['id']}: {str(e)}")
+            BATCH_QUESTIONS.inc(outcome="error")
+            return {"id": item["id"], "question": item["text"], "error": str(e)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="файл JSONL с вопросами")
+    parser.add_argument("-o", "--output", help="файл JSONL с результатами (без него — stdout, без продолжения)")
+    parser.add_argument("--concurrency", type=int, default=4, help="одновременные запросы ответов")
+    parser.add_argument("--batch-size", type=int, default=64, help="вопросов в одном окне поиска")
+    parser.add_argument("--book-id", help="книга для поиска контекста (по умолчанию — book.txt)")
+    args = parser.parse_args()
+
+    # Импорт после разбора аргументов: загрузка приложения не нужна для --help
+    import app
+
+    with open(args.input, "r", encoding="utf-8") as f:
+        items = parse_questions(f)
+    app.prepare_library()
+    book = app.library.get(args.book_id) if args.book_id else app.library.active()
+    if book is None:
+        logger.error(f"Книга {args.book_id} не найдена")
+        return 2
+    runner = app.create_batch_runner(book, concurrency=args.concurrency, batch_size=args.batch_size)
+
+    started = time.perf_counter()
+    errors = 0
+    for count, result in enumerate(runner.run(items, args.output), 1):
+        errors += "error" in result
+        if args.output is None:
+            print(json.dumps(result, ensure_ascii=False), flush=True)
+        elif count % 10 == 0 or count == len(items):
+            logger.info(f"Пакетный прогон: {count} из {len(items)}")
+    logger.info(f"Пакетный прогон завершен за {time.perf_counter() - started:.1f} с, ошибок: {errors}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
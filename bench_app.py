@@ -0,0 +1,371 @@
+"""Нагрузочный тест приложения против локального мока GigaChat API
+
+Запускает mock_gigachat.py и app.py во временном каталоге, измеряет скорость
+индексации книги, затем нагружает /analyze и /analyze_stream с заданной
+параллельностью. Отчет: p50/p95/p99 задержки, запросов в секунду, чанков
+в секунду при индексации и пиковая память (RSS) процессов.
+
+Пример:
+    python bench_app.py --concurrency 1 8 32 --requests 200 --mock-args="--latency 40 --token-delay 5" --output bench.json
+    python bench_app.py --url http://127.0.0.1:5000 --endpoint analyze   # уже запущенный сервер
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import requests
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_QUESTIONS = [
+    "Что было бы, если бы главный герой принял другое решение в начале книги?",
+    "Как изменилась бы судьба героев, если бы они встретились раньше?",
+    "Что если бы главный конфликт разрешился мирно?",
+    "Как развивались бы события, если бы действие происходило в наши дни?",
+    "Что было бы, если бы второстепенный персонаж стал главным?",
+    "Как изменилась бы развязка, если бы герой узнал правду раньше?"
+]
+
+# Запуск сервера без отладчика и перезагрузчика: один процесс, который можно измерить
+APP_LAUNCHER = (
+    "import sys, app\n"
+    "app.lifecycle.start(app.initialize_book)\n"
+    "app.app.run(host='127.0.0.1', port=int(sys.argv[1]), threaded=True)\n"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_http(url, process=None, timeout=120):
+    """Ожидание, пока сервер начнет отвечать"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Процесс завершился с кодом {process.returncode}, см. журнал")
+        try:
+            requests.get(url, timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise TimeoutError(f"{url} не ответил за {timeout} с")
+
+
+def wait_ready(url, process=None, timeout=120):
+    """Ожидание готовности сервера: книги загружены, индекс прогрет"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Процесс завершился с кодом {process.returncode}, см. журнал")
+        if requests.get(url, timeout=2).status_code == 200:
+            return
+        time.sleep(0.1)
+    raise TimeoutError(f"{url} не ответил готовностью за {timeout} с")
+
+
+def peak_rss_mb(pid):
+    """Пиковый RSS процесса в МБ (Linux); None, если недоступен"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    """Дочерние процессы (Linux), например процессы worker.py"""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def summarize(latencies, wall, errors):
+    latencies = np.array(latencies) * 1000
+    result = {
+        "requests": int(latencies.size + errors),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "rps": round(latencies.size / wall, 2) if wall > 0 else None
+    }
+    if latencies.size:
+        result.update(
+            mean_ms=round(float(latencies.mean()), 2),
+            p50_ms=round(float(np.percentile(latencies, 50)), 2),
+            p95_ms=round(float(np.percentile(latencies, 95)), 2),
+            p99_ms=round(float(np.percentile(latencies, 99)), 2),
+            max_ms=round(float(latencies.max()), 2)
+        )
+    return result
+
+
+class Bench:
+    def __init__(self, base_url, timeout=120):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def session(self):
+        # Своя сессия на поток: requests.Session не потокобезопасна
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def status(self):
+        return self.session().get(f"{self.base_url}/status", timeout=self.timeout).json()
+
+    def analyze(self, question):
+        """Задержка полного ответа /analyze; исключение при ошибке"""
+        response = self.session().post(f"{self.base_url}/analyze", json={"text": question}, timeout=self.timeout)
+        response.raise_for_status()
+        return None
+
+    def analyze_stream(self, question):
+        """Задержка /analyze_stream; возвращает время до первого фрагмента ответа"""
+        start = time.perf_counter()
+        first_token = None
+        with self.session().post(f"{self.base_url}/analyze_stream", json={"text": question},
+                                 timeout=self.timeout, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if line == "event: token" and first_token is None:
+                    first_token = time.perf_counter() - start
+                elif line == "event: error":
+                    raise RuntimeError("Сервер вернул событие error")
+        if first_token is None:
+            raise RuntimeError("Ответ не содержит фрагментов")
+        return first_token
+
+    def wait_indexed(self, timeout, poll=0.2):
+        """Ожидание окончания индексации: (время, число чанков, статус)"""
+        start = time.perf_counter()
+        deadline = start + timeout
+        while True:
+            status = self.status()
+            books, jobs = status.get("books", []), status.get("jobs", {})
+            # В режиме worker индекс сервера догоняет хранилище с задержкой, поэтому ждем все строки
+            indexed = all(b["chunks_total"] and b["chunks_indexed"] >= b["chunks_total"] for b in books)
+            failed = not jobs.get("pending") and not jobs.get("running") and jobs.get("failed")
+            if status.get("book_loaded") and (indexed or failed):
+                break
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Индексация не завершилась за {timeout} с: {status.get('jobs')}")
+            time.sleep(poll)
+        return time.perf_counter() - start, sum(b["chunks_indexed"] for b in status["books"]), status
+
+    def load(self, endpoint, questions, concurrency):
+        """Прогон вопросов с заданной параллельностью"""
+        call = self.analyze_stream if endpoint == "analyze_stream" else self.analyze
+        latencies, first_tokens, errors = [], [], []
+
+        def run(question):
+            start = time.perf_counter()
+            try:
+                first_token = call(question)
+            except Exception as e:
+                errors.append(str(e))
+                return
+            latencies.append(time.perf_counter() - start)
+            if first_token is not None:
+                first_tokens.append(first_token)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(run, questions))
+        wall = time.perf_counter() - start
+
+        result = {"endpoint": endpoint, "concurrency": concurrency, **summarize(latencies, wall, len(errors))}
+        if first_tokens:
+            ttft = summarize(first_tokens, wall, 0)
+            result["first_token"] = {key: ttft[key] for key in ("p50_ms", "p95_ms", "p99_ms")}
+        if errors:
+            result["error_sample"] = errors[0][:200]
+        return result
+
+
+def make_questions(base, count, repeat, offset=0):
+    """Вопросы для нагрузки; без repeat каждый уникален и не попадает в кэш ответов"""
+    if repeat:
+        return [base[i % len(base)] for i in range(count)]
+    return [f"{base[i % len(base)]} (вариант {i})" for i in range(offset, offset + count)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="адрес уже запущенного сервера (мок и сервер тогда не запускаются)")
+    parser.add_argument("--book", default=os.path.join(ROOT, "book.txt"), help="книга для индексации")
+    parser.add_argument("--endpoint", nargs="+", choices=["analyze", "analyze_stream"],
+                        default=["analyze", "analyze_stream"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=100, help="запросов на каждый уровень параллельности")
+    parser.add_argument("--questions", help="файл с вопросами, по одному в строке")
+    parser.add_argument("--repeat", action="store_true", help="повторять вопросы (измерение с кэшем ответов)")
+    parser.add_argument("--mode", choices=["thread", "worker"], default="thread", help="INGESTION_MODE сервера")
+    parser.add_argument("--workers", type=int, default=2, help="процессов worker.py в режиме worker")
+    parser.add_argument("--mock-args", default="", help="аргументы mock_gigachat.py, например \"--latency 50\"")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменные окружения сервера")
+    parser.add_argument("--timeout", type=float, default=600, help="предел ожидания индексации, с")
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочий каталог")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            base_questions = [line.strip() for line in f if line.strip()]
+    else:
+        base_questions = DEFAULT_QUESTIONS
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args)
+        }
+    }
+    processes = {}
+    workdir = None
+    mock_port = None
+    logs = []
+    try:
+        if args.url:
+            base_url = args.url
+        else:
+            workdir = tempfile.mkdtemp(prefix="bench-app-")
+            shutil.copy(args.book, os.path.join(workdir, "book.txt"))
+            shutil.copy(os.path.join(ROOT, "index.html"), os.path.join(workdir, "index.html"))
+
+            def spawn(name, command, env=None):
+                log = open(os.path.join(workdir, f"{name}.log"), "wb")
+                logs.append(log)
+                processes[name] = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+                return processes[name]
+
+            mock_port = free_port()
+            mock = spawn("mock", [sys.executable, os.path.join(ROOT, "mock_gigachat.py"), "--port", str(mock_port),
+                                  *shlex.split(args.mock_args)])
+            wait_http(f"http://127.0.0.1:{mock_port}/mock/stats", mock)
+
+            env = dict(os.environ)
+            env.update({
+                "PYTHONPATH": os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")])),
+                "GIGACHAT_API_URL": f"http://127.0.0.1:{mock_port}/api/v1",
+                "GIGACHAT_AUTH_URL": f"http://127.0.0.1:{mock_port}/oauth",
+                "CLIENT_ID": "bench",
+                "AUTH_KEY": "bench",
+                # Пустые значения не перезаписываются из .env и отключают заранее выданный токен
+                "ACCESS_TOKEN": "",
+                "INGESTION_MODE": args.mode,
+                "BOOKS_DIR": os.path.join(workdir, "books"),
+                "JOBS_DB": os.path.join(workdir, "jobs.db"),
+                "UPSTREAM_STATE_DB": os.path.join(workdir, "upstream.db"),
+                "CACHE_DB": os.path.join(workdir, "cache.db")
+            })
+            for item in args.env:
+                key, _, value = item.partition("=")
+                env[key] = value
+
+            app_port = free_port()
+            base_url = f"http://127.0.0.1:{app_port}"
+            started = time.perf_counter()
+            server = spawn("app", [sys.executable, "-c", APP_LAUNCHER, str(app_port)], env)
+            if args.mode == "worker":
+                spawn("worker", [sys.executable, os.path.join(ROOT, "worker.py"), "--processes", str(args.workers)], env)
+            wait_http(f"{base_url}/healthz", server, timeout=args.timeout)
+            report["startup_s"] = round(time.perf_counter() - started, 3)
+            wait_ready(f"{base_url}/readyz", server, timeout=args.timeout)
+            report["ready_s"] = round(time.perf_counter() - started, 3)
+            print(f"Сервер запущен за {report['startup_s']} с, готов за {report['ready_s']} с, рабочий каталог {workdir}")
+
+        bench = Bench(base_url)
+        elapsed, chunks, status = bench.wait_indexed(args.timeout)
+        if not args.url:
+            # Индексация начинается при запуске сервера, поэтому считаем от запуска процесса
+            elapsed += report["startup_s"]
+        report["ingestion"] = {
+            "chunks": chunks,
+            "seconds": round(elapsed, 3),
+            "chunks_per_s": round(chunks / elapsed, 2) if elapsed > 0 else None,
+            "jobs": status.get("jobs")
+        }
+        print(f"Индексация: {chunks} чанков за {elapsed:.1f} с ({report['ingestion']['chunks_per_s']} чанков/с)")
+
+        report["load"] = []
+        for endpoint in args.endpoint:
+            for concurrency in args.concurrency:
+                # Сквозная нумерация: прогоны не получают ответы из кэша предыдущих
+                questions = make_questions(base_questions, args.requests, args.repeat, len(report["load"]) * args.requests)
+                result = bench.load(endpoint, questions, concurrency)
+                report["load"].append(result)
+                line = (f"{endpoint:<15} c={concurrency:<3} {result['rps']} зап/с  "
+                        f"p50={result.get('p50_ms')} p95={result.get('p95_ms')} p99={result.get('p99_ms')} мс  "
+                        f"ошибок={result['errors']}")
+                if "first_token" in result:
+                    line += f"  первый фрагмент p50={result['first_token']['p50_ms']} мс"
+                print(line)
+
+        report["status"] = bench.status()
+        if mock_port:
+            report["mock"] = requests.get(f"http://127.0.0.1:{mock_port}/mock/stats", timeout=10).json()
+        rss = {name: peak_rss_mb(process.pid) for name, process in processes.items() if name != "mock"}
+        if "worker" in processes:
+            for pid in child_pids(processes["worker"].pid):
+                rss[f"worker-{pid}"] = peak_rss_mb(pid)
+        if rss:
+            report["peak_rss_mb"] = rss
+            print(f"Пиковая память: {rss} МБ")
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        for log in logs:
+            log.close()
+        if processes and any(value is None for value in report.get("peak_rss_mb", {}).values()):
+            # Без /proc берем максимум по дочерним процессам (включая мок)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            report["peak_rss_mb"] = {"children_max": round(children / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)}
+        if workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Сравнение точного и приближенного поиска: полнота (recall@k) против задержки
+
+Для сжатых индексов (float16, int8) также сравнивается память на миллион векторов
+с матрицей float32 и списками Python из старого embeddings.json.
+
+Запросы не входят в корпус: для синтетических данных это новые выборки из той же
+смеси кластеров, для --store — строки хранилища, исключенные из индекса и зашумленные.
+
+Пример: python bench_index.py --n 100000 --dim 1024 --nprobe 1 4 8 16 32 --rescore 5 16 64 256
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+
+from embedding_store import EmbeddingStore
+from vector_index import QUANTIZED_DTYPES, FlatIndex, IVFIndex, QuantizedIndex, normalize_rows
+
+
+def synthetic_vectors(n, dim, queries, clusters=200, spread=1.0, seed=0):
+    """Кластеризованные данные, похожие по структуре на эмбеддинги текста: (корпус, запросы)
+
+    Запросы — независимые выборки из той же смеси кластеров, а не копии строк
+    корпуса, поэтому их ближайшие соседи лежат и в соседних кластерах.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+
+    def draw(count):
+        labels = rng.integers(0, clusters, count)
+        return normalize_rows(centers[labels] + spread * rng.standard_normal((count, dim)).astype(np.float32))
+
+    return draw(n), draw(queries)
+
+
+def held_out_queries(vectors, count, noise=0.5, seed=1):
+    """Запросы из реального хранилища: строки исключаются из корпуса и сильно зашумляются
+
+    noise — норма шума относительно нормы строки (0.5 — около 27 градусов от исходной).
+    """
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(vectors.shape[0], count, replace=False)
+    corpus = np.delete(vectors, picked, axis=0)
+    base = vectors[picked]
+    scale = noise / np.sqrt(base.shape[1])
+    return corpus, normalize_rows(base + scale * rng.standard_normal(base.shape).astype(np.float32))
+
+
+def measure(index, queries, k):
+    latencies, results = [], []
+    for q in queries:
+        start = time.perf_counter()
+        _, ids = index.search(q, k)
+        latencies.append(time.perf_counter() - start)
+        results.append(ids)
+    latencies = np.array(latencies) * 1000
+    return results, {
+        "mean_ms": round(float(latencies.mean()), 3),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 3)
+    }
+
+
+def list_bytes_per_vector(dim, sample=100):
+    """Память на вектор в виде списка float (как в прежней глобальной переменной embeddings)"""
+    rows = np.random.default_rng(2).standard_normal((sample, dim)).tolist()
+    total = sum(sys.getsizeof(row) + sum(sys.getsizeof(x) for x in row) for row in rows)
+    return total / sample
+
+
+def per_million(bytes_per_vector):
+    return round(bytes_per_vector * 1_000_000 / 2 ** 20, 1)
+
+
+def recall(results, truth, k):
+    hits = sum(len(set(r[:k].tolist()) & set(t[:k].tolist())) for r, t in zip(results, truth))
+    return hits / (len(truth) * k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", help="файл embeddings.bin вместо синтетических данных")
+    parser.add_argument("--n", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--rescore", type=int, nargs="+", default=[5, 16, 64, 256],
+                        help="число кандидатов для точной переоценки в сжатых индексах")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    if args.store:
+        store = EmbeddingStore(args.store)
+        if not store.open():
+            raise SystemExit(f"Не удалось открыть {args.store}")
+        vectors, queries = held_out_queries(np.asarray(store.matrix()), min(args.queries, len(store) // 2))
+    else:
+        vectors, queries = synthetic_vectors(args.n, args.dim, args.queries)
+    print(f"Корпус: {vectors.shape[0]} x {vectors.shape[1]}, запросов: {len(queries)}, k={args.k}")
+
+    flat = FlatIndex()
+    flat.load(vectors)
+    truth, flat_stats = measure(flat, queries, args.k)
+    dim = vectors.shape[1]
+    memory = {"python_list": per_million(list_bytes_per_vector(dim)), "float32": per_million(dim * 4)}
+    report = {"n": vectors.shape[0], "dim": dim, "k": args.k,
+              "flat": {**flat_stats, "recall": 1.0, "mb_per_million": memory["float32"]},
+              "python_list": {"mb_per_million": memory["python_list"]}, "ivf": [], "quantized": []}
+    print(f"списки Python: {memory['python_list']} МБ на миллион векторов")
+    print(f"flat          recall=1.000  mean={flat_stats['mean_ms']:.3f} мс  p95={flat_stats['p95_ms']:.3f} мс  "
+          f"{memory['float32']} МБ на миллион векторов")
+
+    for dtype in QUANTIZED_DTYPES:
+        index = QuantizedIndex(dtype=dtype)
+        index.load(vectors)
+        start = time.perf_counter()
+        index.build()
+        build_s = time.perf_counter() - start
+        mb = per_million(index.memory_bytes() / vectors.shape[0])
+        for rescore in args.rescore:
+            index.rescore = rescore
+            results, stats = measure(index, queries, args.k)
+            stats.update(dtype=dtype, rescore=rescore, recall=round(recall(results, truth, args.k), 4),
+                         mb_per_million=mb, build_s=round(build_s, 2))
+            report["quantized"].append(stats)
+            print(f"{dtype:<7} rescore={rescore:<4} recall={stats['recall']:.3f}  mean={stats['mean_ms']:.3f} мс  "
+                  f"p95={stats['p95_ms']:.3f} мс  {mb} МБ на миллион векторов")
+
+    start = time.perf_counter()
+    ivf = IVFIndex(train_size=0)
+    ivf.load(vectors)
+    ivf.build()
+    build_s = time.perf_counter() - start
+    print(f"ivf: {ivf.centroids.shape[0]} списков, построение {build_s:.1f} с")
+
+    for nprobe in args.nprobe:
+        ivf.nprobe = nprobe
+        results, stats = measure(ivf, queries, args.k)
+        stats.update(nprobe=nprobe, recall=round(recall(results, truth, args.k), 4), build_s=round(build_s, 2))
+        report["ivf"].append(stats)
+        print(f"ivf nprobe={nprobe:<3} recall={stats['recall']:.3f}  mean={stats['mean_ms']:.3f} мс  p95={stats['p95_ms']:.3f} мс")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
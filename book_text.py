@@ -0,0 +1,67 @@
+import hashlib
+import logging
+import mmap
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def byte_offsets(text, char_offsets):
+    """Перевод смещений в символах строки text в смещения в байтах ее UTF-8"""
+    codepoints = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    widths = 1 + (codepoints >= 0x80).astype(np.int64) + (codepoints >= 0x800) + (codepoints >= 0x10000)
+    positions = np.zeros(codepoints.shape[0] + 1, dtype=np.int64)
+    np.cumsum(widths, out=positions[1:])
+    return positions[np.asarray(char_offsets, dtype=np.int64)]
+
+
+class BookText:
+    """Текст книги в UTF-8, отображенный в память только для чтения
+
+    Смещения — в байтах файла, text[start:end] декодирует только нужный
+    фрагмент. Страницы файла общие для всех процессов (кэш ОС), поэтому
+    память процесса растет с числом выданных фрагментов, а не с размером
+    библиотеки.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = b""
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            # Пустой файл отобразить нельзя
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b""
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise TypeError("Текст книги читается только срезами по байтовым смещениям")
+        return self._data[key].decode("utf-8", errors="replace")
+
+    def read(self):
+        """Весь текст одной строкой: только для разбиения на чанки, не для обслуживания запросов"""
+        return self._data[:].decode("utf-8", errors="replace")
+
+    def digest(self):
+        """Хеш текста, совпадающий с embedding_store.text_hash от прочитанного файла (читается блоками)"""
+        hasher = hashlib.sha256()
+        with open(self.path, "r", encoding="utf-8") as f:
+            while True:
+                piece = f.read(READ_BLOCK_SIZE)
+                if not piece:
+                    break
+                hasher.update(piece.encode("utf-8"))
+        return hasher.hexdigest()
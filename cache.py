@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text):
+    """Нормализация вопроса для ключа кэша: регистр, ё, пробелы и пунктуация по краям"""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" \t\n.,!?;:…\"'«»")
+
+
+def make_key(*parts):
+    """Ключ кэша из произвольных JSON-сериализуемых частей"""
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """LRU-кэш с ограничением размера, временем жизни и необязательным хранением в SQLite"""
+
+    def __init__(self, name, maxsize=1024, ttl=3600, db_path=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.db_path = db_path
+        if db_path:
+            self._open_db(db_path)
+            # После fork (воркеры gunicorn) открываем свое соединение с базой
+            os.register_at_fork(after_in_child=self._reopen_db)
+
+    def _reopen_db(self):
+        self._lock = threading.Lock()
+        if self._db is not None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+
+    def _open_db(self, db_path):
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS cache_{self.name} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute(f"DELETE FROM cache_{self.name} WHERE created < ?", (time.time() - self.ttl,))
+            rows = self._db.execute(
+                f"SELECT key, value, created FROM cache_{self.name} ORDER BY created DESC LIMIT ?",
+                (self.maxsize,)
+            ).fetchall()
+            self._db.commit()
+            for key, value, created in reversed(rows):
+                self._data[key] = (json.loads(value), created)
+            logger.info(f"Кэш {self.name}: загружено {len(rows)} записей из {db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при открытии кэша {self.name} в {db_path}: {str(e)}")
+            self._db = None
+
+    def get(self, key):
+        """Значение по ключу или None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.time() - item[1] > self.ttl:
+                self._remove(key)
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            created = time.time()
+            self._data[key] = (value, created)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        f"INSERT OR REPLACE INTO cache_{self.name} (key, value, created) VALUES (?, ?, ?)",
+                        (key, json.dumps(value, ensure_ascii=False), created)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка при записи в кэш {self.name}: {str(e)}")
+
+    def _remove(self, key):
+        self._data.pop(key, None)
+        if self._db is not None:
+            try:
+                self._db.execute(f"DELETE FROM cache_{self.name} WHERE key = ?", (key,))
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка при удалении из кэша {self.name}: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            if self._db is not None:
+                self._db.execute(f"DELETE FROM cache_{self.name}")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
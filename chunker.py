@@ -0,0 +1,96 @@
+import re
+
+import numpy as np
+
+# Конец предложения: знаки препинания (с закрывающими кавычками/скобками) и пробел после них
+SENTENCE_END = re.compile(r"[.!?…]+[»\"')\]]*(?=\s)|\n\s*\n")
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+WORD = re.compile(r"\S+")
+
+
+def count_tokens(text):
+    """Грубая оценка числа токенов: слова плюс поправка на длинные слова"""
+    return sum(1 + len(word) // 8 for word in WORD.findall(text))
+
+
+def split_sentences(text):
+    """Границы предложений (start, end) без ведущих и хвостовых пробелов"""
+    spans = []
+    start = 0
+    for match in SENTENCE_END.finditer(text):
+        spans.append((start, match.end()))
+        start = match.end()
+    spans.append((start, len(text)))
+
+    result = []
+    for start, end in spans:
+        segment = text[start:end]
+        stripped = segment.strip()
+        if not stripped:
+            continue
+        lead = len(segment) - len(segment.lstrip())
+        result.append((start + lead, start + lead + len(stripped)))
+    return result
+
+
+def _split_long(text, start, end, max_tokens):
+    """Разбиение слишком длинного предложения по словам"""
+    pieces = []
+    piece_start, tokens, last_end = None, 0, start
+    for word in WORD.finditer(text, start, end):
+        word_tokens = count_tokens(word.group())
+        if piece_start is not None and tokens + word_tokens > max_tokens:
+            pieces.append((piece_start, last_end))
+            piece_start, tokens = None, 0
+        if piece_start is None:
+            piece_start = word.start()
+        tokens += word_tokens
+        last_end = word.end()
+    if piece_start is not None:
+        pieces.append((piece_start, last_end))
+    return pieces
+
+
+def chunk_text(text, max_tokens=200, overlap_tokens=40):
+    """Разбиение текста на чанки по границам предложений и абзацев с перекрытием
+
+    Возвращает массив (n, 2) со смещениями (start, end) каждого чанка в text.
+    Перекрытие набирается из последних целых предложений предыдущего чанка.
+    """
+    sentences = []
+    for start, end in split_sentences(text):
+        tokens = count_tokens(text[start:end])
+        if tokens > max_tokens:
+            sentences.extend((s, e, count_tokens(text[s:e])) for s, e in _split_long(text, start, end, max_tokens))
+        else:
+            sentences.append((start, end, tokens))
+
+    chunks = []
+    current, current_tokens = [], 0
+    for i, (start, end, tokens) in enumerate(sentences):
+        # Абзац закрывает чанк, если тот уже заполнен хотя бы наполовину
+        paragraph_break = current and PARAGRAPH_BREAK.search(text, current[-1][1], start) is not None
+        if current and (current_tokens + tokens > max_tokens or (paragraph_break and current_tokens >= max_tokens // 2)):
+            chunks.append((current[0][0], current[-1][1]))
+            # Переносим хвост предыдущего чанка в начало следующего
+            overlap, overlap_size = [], 0
+            for sentence in reversed(current):
+                if overlap_size + sentence[2] > overlap_tokens or len(overlap) + 1 == len(current):
+                    break
+                overlap.insert(0, sentence)
+                overlap_size += sentence[2]
+            if paragraph_break:
+                overlap, overlap_size = [], 0
+            current, current_tokens = overlap, overlap_size
+        current.append((start, end, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append((current[0][0], current[-1][1]))
+
+    return np.array(chunks, dtype=np.int64).reshape(-1, 2)
+
+
+def fixed_size_offsets(text, size):
+    """Смещения чанков фиксированной длины в символах (прежняя схема разбиения)"""
+    starts = np.arange(0, len(text), size, dtype=np.int64)
+    return np.stack([starts, np.minimum(starts + size, len(text))], axis=1)
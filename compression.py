@@ -0,0 +1,42 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    # Без пакета Brotli ответы сжимаются только gzip
+    brotli = None
+
+# Типы ответов, которые имеет смысл сжимать (JSON, JSONL, HTML, текст метрик)
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "text/")
+
+
+def available_encodings():
+    """Поддерживаемые кодировки в порядке предпочтения сервера"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress_response(response, accept_encodings, min_size=1024, gzip_level=6, brotli_quality=5):
+    """Сжатие готового ответа кодировкой, выбранной по Accept-Encoding клиента
+
+    Потоковые ответы (SSE, JSONL пакетных прогонов, экспорт индекса) и файлы
+    не трогаются: их тело еще не сформировано. Ответы короче min_size
+    отдаются как есть — заголовки сжатия дороже выигрыша.
+    """
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)):
+        return response
+    # Кэши между клиентом и сервером должны различать сжатые и несжатые ответы
+    response.vary.add("Accept-Encoding")
+    encoding = accept_encodings.best_match(available_encodings())
+    if encoding is None or (response.content_length or 0) < min_size:
+        return response
+    data = response.get_data()
+    if encoding == "br":
+        body = brotli.compress(data, quality=brotli_quality)
+    else:
+        body = gzip.compress(data, compresslevel=gzip_level)
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
@@ -0,0 +1,116 @@
+import logging
+
+from chunker import count_tokens, split_sentences
+from lexical_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Доля общих термов, при которой фрагмент считается повтором уже выбранного
+DUPLICATE_THRESHOLD = 0.8
+# Остаток бюджета, меньше которого не имеет смысла обрезать фрагмент по предложениям
+MIN_TRIMMED_TOKENS = 24
+PASSAGE_SEPARATOR = "\n\n"
+
+
+class AssembledContext:
+    """Контекст для промпта: непрерывные фрагменты книги в порядке текста"""
+
+    __slots__ = ("text", "tokens", "spans", "hits", "skipped", "cache_key", "answer")
+
+    def __init__(self, text, tokens, spans, hits, skipped, cache_key=None, answer=None):
+        self.text = text
+        # Оценка числа токенов (chunker.count_tokens) всего контекста
+        self.tokens = tokens
+        # Байтовые смещения (start, end) фрагментов в файле книги
+        self.spans = spans
+        # Сколько найденных чанков вошло в контекст и сколько отброшено (повторы, бюджет)
+        self.hits = hits
+        self.skipped = skipped
+        # Запись семантического кэша с этим контекстом и готовый ответ из нее (если вопрос почти тот же)
+        self.cache_key = cache_key
+        self.answer = answer
+
+    def __bool__(self):
+        return bool(self.text)
+
+    def cached(self, cache_key, answer=None):
+        """Тот же контекст, взятый из записи кэша cache_key"""
+        return AssembledContext(self.text, self.tokens, self.spans, self.hits, self.skipped, cache_key, answer)
+
+
+def merge_spans(text, spans):
+    """Слияние пересекающихся и соседних (разделенных только пробелами) фрагментов"""
+    merged = []
+    for start, end in sorted(spans):
+        if merged and (start <= merged[-1][1] or not text[merged[-1][1]:start].strip()):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def trim_to_budget(text, start, end, budget):
+    """Начало фрагмента из целых предложений, укладывающееся в budget токенов; None, если не влезает ни одно"""
+    segment = text[start:end]
+    last_end, tokens = None, 0
+    for s, e in split_sentences(segment):
+        tokens += count_tokens(segment[s:e])
+        if tokens > budget:
+            break
+        last_end = e
+    if last_end is None:
+        return None
+    # Конец в символах фрагмента переводим обратно в байтовое смещение
+    return start, start + len(segment[:last_end].encode("utf-8"))
+
+
+def _context_tokens(text, spans):
+    return sum(count_tokens(text[start:end]) for start, end in spans)
+
+
+def _similarity(terms, other):
+    if not terms or not other:
+        return 0.0
+    return len(terms & other) / len(terms | other)
+
+
+def assemble_context(text, offsets, ids, token_budget=600, duplicate_threshold=DUPLICATE_THRESHOLD):
+    """Сборка контекста из найденных чанков в пределах token_budget токенов
+
+    text — текст книги (BookText), offsets — таблица чанков в байтах.
+
+    Чанки берутся в порядке релевантности (ids). Почти дословные повторы уже
+    выбранных чанков отбрасываются, пересекающиеся и соседние чанки сливаются
+    в один фрагмент, так что общее перекрытие оплачивается один раз. Чанк, не
+    помещающийся в остаток бюджета, пропускается; если не выбрано еще ничего,
+    он обрезается по границе предложения.
+    """
+    selected, selected_terms, skipped = [], [], 0
+    merged, tokens = [], 0
+    for i in dict.fromkeys(int(i) for i in ids):
+        start, end = (int(x) for x in offsets[i])
+        # Пересекающийся с выбранными чанк не повтор, а продолжение: его сольем
+        overlaps = any(start < e and s < end for s, e in selected)
+        terms = set(tokenize(text[start:end]))
+        if not overlaps and any(_similarity(terms, other) >= duplicate_threshold for other in selected_terms):
+            skipped += 1
+            continue
+
+        candidate = merge_spans(text, selected + [(start, end)])
+        candidate_tokens = _context_tokens(text, candidate)
+        if candidate_tokens > token_budget:
+            remaining = token_budget - tokens
+            trimmed = trim_to_budget(text, start, end, remaining) if not selected and remaining >= MIN_TRIMMED_TOKENS else None
+            if trimmed is None:
+                skipped += 1
+                continue
+            start, end = trimmed
+            candidate = merge_spans(text, selected + [(start, end)])
+            candidate_tokens = _context_tokens(text, candidate)
+
+        selected.append((start, end))
+        selected_terms.append(terms)
+        merged, tokens = candidate, candidate_tokens
+
+    context = PASSAGE_SEPARATOR.join(text[start:end] for start, end in merged)
+    return AssembledContext(context, tokens, merged, len(selected), skipped)
@@ -0,0 +1,81 @@
+import logging
+import threading
+
+import numpy as np
+
+from gigachat_client import get_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCAL_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+
+
+class GigaChatEmbeddings:
+    """Эмбеддинги через GigaChat API (ограничение частоты, повторы после 429)"""
+
+    remote = True
+
+    def __init__(self, model="Embeddings"):
+        self.model = model
+        # Метка хранится в заголовке хранилища: векторы разных моделей не смешиваются
+        self.tag = f"gigachat:{model}"
+
+    def embed(self, texts):
+        return get_client().embeddings(texts, model=self.model)
+
+
+class LocalEmbeddings:
+    """Локальная модель sentence-transformers с пакетным выводом на CPU
+
+    Модель загружается при первом запросе, поэтому без обращений к ней
+    запуск сервера не замедляется. Вывод сериализуется: параллельность
+    обеспечивают потоки torch (threads), а не одновременные вызовы.
+    """
+
+    remote = False
+
+    def __init__(self, model_name=DEFAULT_LOCAL_MODEL, batch_size=32, threads=None, device="cpu"):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.threads = threads
+        self.device = device
+        self.tag = f"local:{model_name}"
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._encode_lock = threading.Lock()
+
+    def model(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError("Для EMBEDDING_PROVIDER=local нужен пакет sentence-transformers") from e
+                    if self.threads:
+                        import torch
+                        torch.set_num_threads(self.threads)
+                    logger.info(f"Загрузка локальной модели эмбеддингов {self.model_name} ({self.device})")
+                    self._model = SentenceTransformer(self.model_name, device=self.device)
+        return self._model
+
+    def embed(self, texts):
+        model = self.model()
+        with self._encode_lock:
+            vectors = model.encode(
+                list(texts),
+                batch_size=self.batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
+            )
+        return np.asarray(vectors, dtype=np.float32)
+
+
+def create_provider(kind="gigachat", **params):
+    """Фабрика поставщиков эмбеддингов: gigachat — удаленный API, local — sentence-transformers"""
+    if kind == "gigachat":
+        return GigaChatEmbeddings(**params)
+    if kind == "local":
+        return LocalEmbeddings(**params)
+    raise ValueError(f"Неизвестный поставщик эмбеддингов: {kind}")
@@ -0,0 +1,252 @@
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+
+import numpy as np
+
+from vector_index import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# Формат файла: заголовок фиксированного размера, затем строки float32 одинаковой длины.
+# Заголовок занимает целую страницу, чтобы строки в mmap были выровнены.
+MAGIC = b"GCEMB\x00"
+FORMAT_VERSION = 1
+HEADER_SIZE = 4096
+_PREFIX = struct.Struct("<6sI")
+
+# Экспорт для передачи готового индекса другому узлу: тот же префикс с заголовком JSON,
+# затем таблица чанков (int64) и строки векторов в EXPORT_DTYPES, все в little-endian
+EXPORT_MAGIC = b"GCIDX\x00"
+EXPORT_VERSION = 1
+EXPORT_DTYPES = {"float32": "<f4", "float16": "<f2"}
+EXPORT_BLOCK_ROWS = 4096
+
+
+def _read_exact(stream, size):
+    """Ровно size байт из потока (ответ HTTP может приходить частями)"""
+    parts, remaining = [], size
+    while remaining:
+        part = stream.read(remaining)
+        if not part:
+            raise ValueError("Экспорт индекса оборван")
+        parts.append(part)
+        remaining -= len(part)
+    return b"".join(parts)
+
+
+def text_hash(text):
+    """Хеш исходного текста, к которому привязаны эмбеддинги"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """Бинарное append-only хранилище эмбеддингов с отображением в память"""
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self._lock = threading.Lock()
+
+    @property
+    def dim(self):
+        return self.header["dim"] if self.header else None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _row_bytes(self):
+        return self.dim * 4
+
+    def read_header(self):
+        """Чтение заголовка; None, если файл отсутствует или поврежден"""
+        if not self.exists():
+            return None
+        with open(self.path, "rb") as f:
+            raw = f.read(HEADER_SIZE)
+        if len(raw) < HEADER_SIZE:
+            return None
+        magic, length = _PREFIX.unpack_from(raw)
+        if magic != MAGIC or length > HEADER_SIZE - _PREFIX.size:
+            return None
+        try:
+            return json.loads(raw[_PREFIX.size:_PREFIX.size + length].decode("utf-8"))
+        except ValueError:
+            return None
+
+    def create(self, dim, **meta):
+        """Создание пустого хранилища с заголовком (перезаписывает существующий файл)"""
+        header = {"version": FORMAT_VERSION, "dim": int(dim), **meta}
+        payload = json.dumps(header).encode("utf-8")
+        if len(payload) > HEADER_SIZE - _PREFIX.size:
+            raise ValueError("Заголовок хранилища эмбеддингов слишком большой")
+        with self._lock:
+            tmp_path = f"{self.path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(_PREFIX.pack(MAGIC, len(payload)))
+                f.write(payload)
+                f.write(b"\x00" * (HEADER_SIZE - _PREFIX.size - len(payload)))
+            os.replace(tmp_path, self.path)
+            self.header = header
+
+    def open(self, **expected):
+        """Открытие существующего хранилища; False, если заголовок не совпадает с ожидаемым"""
+        header = self.read_header()
+        if header is None or header.get("version") != FORMAT_VERSION:
+            return False
+        for key, value in expected.items():
+            if header.get(key) != value:
+                logger.warning(f"Хранилище {self.path} создано для другого {key}: {header.get(key)} != {value}")
+                return False
+        self.header = header
+        self._truncate_partial_row()
+        return True
+
+    def _truncate_partial_row(self):
+        # Если запись строки прервалась, отрезаем недописанный хвост
+        size = os.path.getsize(self.path)
+        extra = (size - HEADER_SIZE) % self._row_bytes()
+        if extra:
+            logger.warning(f"Хранилище {self.path}: отброшена недописанная строка ({extra} байт)")
+            with open(self.path, "r+b") as f:
+                f.truncate(size - extra)
+
+    def __len__(self):
+        if not self.header or not self.exists():
+            return 0
+        return (os.path.getsize(self.path) - HEADER_SIZE) // self._row_bytes()
+
+    def append(self, vectors):
+        """Дописывание строк в конец файла: стоимость не зависит от размера хранилища"""
+        rows = normalize_rows(vectors)
+        if rows.shape[0] == 0:
+            return
+        if rows.shape[1] != self.dim:
+            raise ValueError(f"Размерность эмбеддинга {rows.shape[1]} не совпадает с {self.dim}")
+        self._write(rows)
+
+    def _write(self, rows):
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(rows.tobytes())
+
+    def matrix(self):
+        """Отображение строк в память только для чтения"""
+        count = len(self)
+        if count == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.path, dtype=np.float32, mode="r", offset=HEADER_SIZE, shape=(count, self.dim))
+
+    @property
+    def offsets_path(self):
+        return self.path + ".chunks.npy"
+
+    @property
+    def legacy_offsets_path(self):
+        # Смещения в символах текста, которые хранились до перехода на байтовые
+        return self.path + ".offsets.npy"
+
+    def save_offsets(self, offsets):
+        """Сохранение таблицы чанков: смещения (start, end) в байтах файла книги"""
+        # Временный файл уникален для процесса: книгу могут разбивать несколько воркеров сразу
+        tmp_path = f"{self.offsets_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(offsets, dtype=np.int64))
+        os.replace(tmp_path, self.offsets_path)
+
+    def load_offsets(self):
+        """Байтовые смещения чанков (отображаются в память) или None"""
+        if not os.path.exists(self.offsets_path):
+            return None
+        return np.load(self.offsets_path, mmap_mode="r")
+
+    def load_legacy_offsets(self):
+        """Смещения чанков в символах из прежнего формата или None"""
+        if not os.path.exists(self.legacy_offsets_path):
+            return None
+        return np.load(self.legacy_offsets_path)
+
+    def export(self, offsets, dtype="float32", block_rows=EXPORT_BLOCK_ROWS):
+        """Бинарный экспорт строк и таблицы чанков: (размер в байтах, генератор блоков)
+
+        Строки, дописанные после вызова, в экспорт не попадают. float16 вдвое
+        уменьшает объем; при импорте строки снова становятся float32.
+        """
+        if dtype not in EXPORT_DTYPES:
+            raise ValueError(f"Неизвестный тип экспорта: {dtype}")
+        matrix = self.matrix()
+        offsets = np.ascontiguousarray(offsets, dtype="<i8")
+        header = {
+            "version": EXPORT_VERSION,
+            "dtype": dtype,
+            "rows": int(matrix.shape[0]),
+            "chunks": int(offsets.shape[0]),
+            "store": self.header
+        }
+        payload = json.dumps(header).encode("utf-8")
+        row_bytes = (self.dim or 0) * np.dtype(EXPORT_DTYPES[dtype]).itemsize
+        size = _PREFIX.size + len(payload) + offsets.nbytes + matrix.shape[0] * row_bytes
+
+        def blocks():
+            yield _PREFIX.pack(EXPORT_MAGIC, len(payload)) + payload
+            yield offsets.tobytes()
+            for start in range(0, matrix.shape[0], block_rows):
+                yield np.ascontiguousarray(matrix[start:start + block_rows], dtype=EXPORT_DTYPES[dtype]).tobytes()
+
+        return size, blocks()
+
+    def import_stream(self, stream, block_rows=EXPORT_BLOCK_ROWS, **expected):
+        """Замена хранилища и таблицы чанков экспортом другого узла; возвращает заголовок хранилища
+
+        expected — параметры, которые должны совпасть с заголовком экспорта
+        (хеш текста, поставщик эмбеддингов). Файл собирается рядом и заменяет
+        хранилище только после полного чтения потока.
+        """
+        magic, length = _PREFIX.unpack(_read_exact(stream, _PREFIX.size))
+        if magic != EXPORT_MAGIC:
+            raise ValueError("Поток не является экспортом индекса")
+        header = json.loads(_read_exact(stream, length).decode("utf-8"))
+        meta = header.get("store") or {}
+        if header.get("version") != EXPORT_VERSION or meta.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия экспорта индекса: {header.get('version')}")
+        if header.get("dtype") not in EXPORT_DTYPES:
+            raise ValueError(f"Неизвестный тип экспорта: {header.get('dtype')}")
+        for key, value in expected.items():
+            if meta.get(key) != value:
+                raise ValueError(f"Экспорт индекса создан для другого {key}: {meta.get(key)} != {value}")
+
+        dim, dtype = meta["dim"], EXPORT_DTYPES[header["dtype"]]
+        offsets = np.frombuffer(_read_exact(stream, header["chunks"] * 16), dtype="<i8").reshape(-1, 2)
+        target = EmbeddingStore(f"{self.path}.{os.getpid()}-{threading.get_ident()}.import")
+        try:
+            target.create(dim, **{key: value for key, value in meta.items() if key not in ("version", "dim")})
+            row_bytes = dim * np.dtype(dtype).itemsize
+            for start in range(0, header["rows"], block_rows):
+                count = min(block_rows, header["rows"] - start)
+                rows = np.frombuffer(_read_exact(stream, count * row_bytes), dtype=dtype).reshape(count, dim)
+                # Строки float32 уже нормированы и переносятся бит в бит, float16 нормируем заново
+                target._write(rows.astype(np.float32) if header["dtype"] == "float32" else normalize_rows(rows))
+            with self._lock:
+                os.replace(target.path, self.path)
+                self.save_offsets(offsets)
+                self.header = target.header
+        finally:
+            if os.path.exists(target.path):
+                os.remove(target.path)
+        logger.info(f"Импортировано {header['rows']} эмбеддингов ({header['dtype']}) в {self.path}")
+        return self.header
+
+    def migrate_json(self, json_path, **meta):
+        """Однократный перенос эмбеддингов из старого embeddings.json"""
+        with open(json_path, "r", encoding="utf-8") as f:
+            vectors = json.load(f)
+        if not vectors:
+            return False
+        rows = normalize_rows(vectors)
+        self.create(rows.shape[1], **meta)
+        self.append(rows)
+        logger.info(f"Перенесено {rows.shape[0]} эмбеддингов из {json_path} в {self.path}")
+        return True
@@ -0,0 +1,315 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+import metrics
+import profiler
+from scheduler import INTERACTIVE, SharedBudget, UpstreamScheduler, current_priority
+
+# Загружаем переменные окружения из .env файла
+load_dotenv()
+
+# Отключаем предупреждения о небезопасных запросах
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+logger = logging.getLogger(__name__)
+
+GIGACHAT_API_URL = os.getenv('GIGACHAT_API_URL', "https://gigachat.devices.sberbank.ru/api/v1")
+AUTH_URL = os.getenv('GIGACHAT_AUTH_URL', "https://ngw.devices.sberbank.ru:9443/api/v2/oauth")
+SCOPE = "GIGACHAT_API_PERS"
+
+# Параметры пула соединений и таймауты (соединение, чтение)
+POOL_SIZE = int(os.getenv('GIGACHAT_POOL_SIZE', '32'))
+TIMEOUT = (10, 120)
+
+# Общий планировщик запросов к API: не больше UPSTREAM_CONCURRENCY одновременных запросов
+# и UPSTREAM_RATE запросов в секунду (0 — без ограничения). INTERACTIVE_RESERVE слотов
+# недоступны фоновой индексации; интерактивный запрос, которому пришлось бы ждать слот дольше
+# INTERACTIVE_LATENCY_BUDGET секунд, сразу отклоняется
+UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', '8'))
+UPSTREAM_RATE = float(os.getenv('UPSTREAM_RATE', '0'))
+INTERACTIVE_LATENCY_BUDGET = float(os.getenv('INTERACTIVE_LATENCY_BUDGET', '2'))
+INTERACTIVE_RESERVE = int(os.getenv('INTERACTIVE_RESERVE', '2'))
+# Файл SQLite с общими для веб-воркеров и процессов worker.py паузой после 429 и бюджетом
+# UPSTREAM_RATE (пустое значение — у каждого процесса свои); создается при первом запросе к API
+UPSTREAM_STATE_DB = os.getenv('UPSTREAM_STATE_DB', 'upstream.db')
+# Сколько раз интерактивный запрос повторяется после 429, если пауза укладывается в бюджет
+RATE_LIMIT_RETRIES = 2
+
+# Токен живет 30 минут; обновляем заранее, чтобы запросы не упирались в 401
+DEFAULT_TOKEN_TTL = 30 * 60
+REFRESH_MARGIN = 120
+
+
+UPSTREAM_REQUESTS = metrics.Counter(
+    "gigachat_requests_total", "Запросы к GigaChat API по методу и коду ответа", ["endpoint", "status"]
+)
+RETRIES = metrics.Counter("gigachat_retries_total", "Повторы запросов к GigaChat API по причине", ["reason"])
+TOKEN_REFRESHES = metrics.Counter("gigachat_token_refreshes_total", "Получение нового OAuth-токена")
+
+
+class RateLimitError(Exception):
+    """Ответ 429 от API; retry_after — рекомендованная пауза в секундах"""
+
+    def __init__(self, retry_after=None):
+        super().__init__(f"Превышен лимит запросов (Retry-After: {retry_after})")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value, default=None):
+    """Разбор заголовка Retry-After (поддерживается только число секунд)"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+
+def create_session(pool_size=POOL_SIZE):
+    """Сессия с пулом keep-alive соединений"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = False
+    return session
+
+
+class TokenManager:
+    """Потокобезопасный кэш OAuth-токена с упреждающим обновлением"""
+
+    def __init__(self, session, client_id, auth_key, auth_url=AUTH_URL, refresh_margin=REFRESH_MARGIN):
+        self.session = session
+        self.client_id = client_id
+        self.auth_key = auth_key
+        self.auth_url = auth_url
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def seed(self, token, ttl=DEFAULT_TOKEN_TTL):
+        """Использование заранее полученного токена (например, из .env)"""
+        with self._lock:
+            if self._token is None:
+                self._token = token
+                self._expires_at = time.time() + ttl
+
+    def get_token(self, stale=None):
+        """Текущий токен; stale — токен, получивший 401, его нужно заменить"""
+        # Быстрый путь без блокировки: токен есть и не скоро истечет
+        token, expires_at = self._token, self._expires_at
+        if token and token != stale and time.time() < expires_at - self.refresh_margin:
+            return token
+
+        with self._lock:
+            # Другой поток мог уже обновить токен, пока мы ждали блокировку
+            if self._token and self._token != stale and time.time() < self._expires_at - self.refresh_margin:
+                return self._token
+            self._token, self._expires_at = self._fetch_token()
+            return self._token
+
+    def refresh(self):
+        """Принудительное обновление токена"""
+        return self.get_token(stale=self._token)
+
+    def _fetch_token(self):
+        if not self.client_id or not self.auth_key:
+            raise ValueError("CLIENT_ID или AUTH_KEY не найдены в .env файле")
+
+        TOKEN_REFRESHES.inc()
+        with metrics.span("gigachat_oauth"):
+            response = self.session.post(
+                self.auth_url,
+                headers={
+                    "Authorization": f"Bearer {self.auth_key}",
+                    "RqUID": self.client_id,
+                    "Content-Type": "application/x-www-form-urlencoded"
+                },
+                data={"scope": SCOPE},
+                timeout=TIMEOUT
+            )
+
+        if response.status_code == 401:
+            logger.error("Неверные учетные данные")
+            raise Exception("Неверные учетные данные")
+
+        response.raise_for_status()
+        data = response.json()
+
+        # expires_at приходит в миллисекундах
+        expires_at = data.get("expires_at")
+        expires_at = expires_at / 1000 if expires_at else time.time() + DEFAULT_TOKEN_TTL
+        logger.info("Токен успешно получен")
+        return data["access_token"], expires_at
+
+
+class GigaChatClient:
+    """Общий HTTP-клиент GigaChat API поверх одной сессии"""
+
+    def __init__(self, client_id=None, auth_key=None, api_url=GIGACHAT_API_URL, auth_url=AUTH_URL):
+        self.api_url = api_url
+        self.session = create_session()
+        self.tokens = TokenManager(
+            self.session,
+            client_id or os.getenv('CLIENT_ID'),
+            auth_key or os.getenv('AUTH_KEY'),
+            auth_url
+        )
+        self.shared = SharedBudget(UPSTREAM_STATE_DB, UPSTREAM_RATE, INTERACTIVE_RESERVE) if UPSTREAM_STATE_DB else None
+        self.scheduler = self._create_scheduler()
+        # Токен можно получить в мастер-процессе gunicorn до fork (прогрев при запуске):
+        # соединения пула и блокировки родителя в дочернем процессе не используем
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _create_scheduler(self):
+        return UpstreamScheduler(
+            max_concurrency=UPSTREAM_CONCURRENCY,
+            rate=UPSTREAM_RATE,
+            latency_budget=INTERACTIVE_LATENCY_BUDGET,
+            reserve=INTERACTIVE_RESERVE,
+            shared=self.shared
+        )
+
+    def _after_fork(self):
+        self.session = create_session()
+        self.tokens.session = self.session
+        self.tokens._lock = threading.Lock()
+        self.scheduler = self._create_scheduler()
+
+    def post(self, path, payload):
+        """POST к API через планировщик; ответ уже прочитан, слот освобожден"""
+        with self.request(path, payload) as response:
+            return response
+
+    @contextlib.contextmanager
+    def request(self, path, payload, stream=False):
+        """POST к API через планировщик: слот занят, пока открыт блок (для потокового ответа — до конца чтения)
+
+        Ответ 429 приостанавливает выдачу слотов на Retry-After. Интерактивный
+        запрос повторяется, если пауза укладывается в бюджет задержки, фоновый
+        сразу получает RateLimitError: повторами индексации управляет конвейер.
+        """
+        attempt = 0
+        while True:
+            with contextlib.ExitStack() as slot:
+                with profiler.phase("queue"):
+                    slot.enter_context(self.scheduler.slot())
+                response = self._authorized_post(path, payload, stream)
+                if response.status_code != 429:
+                    try:
+                        response.raise_for_status()
+                        yield response
+                    finally:
+                        response.close()
+                    return
+                response.close()
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            self.scheduler.on_rate_limited(retry_after)
+            if (current_priority() != INTERACTIVE or attempt >= RATE_LIMIT_RETRIES
+                    or (retry_after or 1.0) > self.scheduler.latency_budget):
+                raise RateLimitError(retry_after)
+            attempt += 1
+            RETRIES.inc(reason="429")
+            logger.info(f"Превышен лимит запросов, повтор через {retry_after or 1.0} с")
+
+    def _authorized_post(self, path, payload, stream):
+        """POST с авторизацией и одним повтором после 401"""
+        with metrics.span("token"):
+            token = self.tokens.get_token()
+        response = self._post(path, payload, token, stream)
+
+        if response.status_code == 401:
+            # Токен отозван или истек раньше срока: принудительно обновляем
+            logger.info("Токен истек, получаем новый...")
+            RETRIES.inc(reason="401")
+            response.close()
+            with metrics.span("token"):
+                token = self.tokens.get_token(stale=token)
+            response = self._post(path, payload, token, stream)
+        return response
+
+    def _post(self, path, payload, token, stream):
+        # Для потокового ответа измеряется время до заголовков, а не до конца генерации
+        endpoint = path.strip("/").replace("/", "_")
+        # Сериализуем сами (как requests для json=), чтобы измерить этап и объем запроса
+        with profiler.phase("serialize"):
+            data = json.dumps(payload, allow_nan=False).encode("utf-8")
+        with metrics.span(f"gigachat_{endpoint}"), profiler.phase("network"):
+            response = self.session.post(
+                f"{self.api_url}{path}",
+                headers={
+                    "Authorization": f"Bearer {token}",
+                    "Content-Type": "application/json"
+                },
+                data=data,
+                stream=stream,
+                timeout=TIMEOUT
+            )
+        UPSTREAM_REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+        profiler.add(requests=1, bytes_sent=len(data))
+        return response
+
+    def embeddings(self, texts, model="Embeddings"):
+        """Эмбеддинги для списка текстов в порядке входа"""
+        response = self.post("/embeddings", {
+            "model": model,
+            "input": texts,
+            "encoding_type": "float"
+        })
+        with profiler.phase("decode"):
+            profiler.add(bytes_received=len(response.content))
+            items = response.json()["data"]
+        # Порядок восстанавливаем по полю index, если API его вернул
+        items.sort(key=lambda item: item.get("index", 0))
+        return [item["embedding"] for item in items]
+
+    def chat_completion(self, messages, model="GigaChat", **params):
+        """Ответ чат-модели на список сообщений"""
+        response = self.post("/chat/completions", {
+            "model": model,
+            "messages": messages,
+            **params
+        })
+        return response.json()["choices"][0]["message"]["content"]
+
+    def chat_completion_stream(self, messages, model="GigaChat", **params):
+        """Потоковый ответ чат-модели: генератор фрагментов текста по мере генерации"""
+        # Слот планировщика занят до конца генерации: поток занимает соединение с API
+        with self.request("/chat/completions", {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            **params
+        }, stream=True) as response:
+            # Ответ приходит в формате SSE: строки "data: {...}", завершается "data: [DONE]"
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {})
+                if delta.get("content"):
+                    yield delta["content"]
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Общий экземпляр клиента на процесс"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GigaChatClient()
+    return _client
@@ -1,8 +1,8 @@
 import os
-import requests
 import urllib3
 from dotenv import load_dotenv
 import logging
+from gigachat_client import get_client
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -19,40 +19,33 @@ class GigaChatAPI:
         try:
             self.client_id = os.getenv('CLIENT_ID')
             self.auth_key = os.getenv('AUTH_KEY')
-            self.access_token = os.getenv('ACCESS_TOKEN')
             
             if not self.client_id or not self.auth_key:
                 raise ValueError("CLIENT_ID или AUTH_KEY не найдены в .env файле")
             
-            # Если токен не найден в .env, получаем новый
-            if not self.access_token:
+            # Общий клиент: пул соединений и кэш токена разделяются с app.py
+            self.client = get_client()
+            
+            # Токен из .env используем как начальный; после 401 клиент обновит его сам
+            access_token = os.getenv('ACCESS_TOKEN')
+            if access_token:
+                self.client.tokens.seed(access_token)
+            else:
                 logger.info("Токен не найден в .env файле, получаем новый...")
-                self.access_token = self._get_access_token()
+                self.client.tokens.get_token()
                 logger.info("Новый токен успешно получен")
         except Exception as e:
             logger.error(f"Ошибка при инициализации GigaChatAPI: {str(e)}")
             raise
     
+    @property
+    def access_token(self):
+        return self.client.tokens.get_token()
+    
     def _get_access_token(self):
         """Получение нового токена доступа"""
         try:
-            response = requests.post(
-                "https://ngw.devices.sberbank.ru:9443/api/v2/oauth",
-                headers={
-                    "Authorization": f"Bearer {self.auth_key}",
-                    "RqUID": self.client_id,
-                    "Content-Type": "application/x-www-form-urlencoded"
-                },
-                data={
-                    "scope": "GIGACHAT_API_PERS"
-                },
-                verify=False
-            )
-            
-            if response.status_code != 200:
-                raise ValueError(f"Ошибка при получении токена: {response.text}")
-            
-            return response.json()["access_token"]
+            return self.client.tokens.refresh()
         except Exception as e:
             logger.error(f"Ошибка при получении токена: {str(e)}")
             raise
@@ -60,28 +53,7 @@ class GigaChatAPI:
     def get_embeddings(self, text):
         """Получение эмбеддингов для текста"""
         try:
-            response = requests.post(
-                "https://gigachat.devices.sberbank.ru/api/v1/embeddings",
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "Embeddings",
-                    "input": text,
-                    "encoding_type": "float"
-                },
-                verify=False
-            )
-            
-            if response.status_code == 401:
-                # Если токен истек, получаем новый и пробуем снова
-                logger.info("Токен истек, получаем новый...")
-                self.access_token = self._get_access_token()
-                return self.get_embeddings(text)
-            
-            response.raise_for_status()
-            return response.json()["data"][0]["embedding"]
+            return self.client.embeddings([text])[0]
         except Exception as e:
             logger.error(f"Ошибка при получении эмбеддингов: {str(e)}")
             raise
@@ -89,27 +61,7 @@ class GigaChatAPI:
     def chat_completion(self, messages):
         """Отправка запроса к чат-модели"""
         try:
-            response = requests.post(
-                "https://gigachat.devices.sberbank.ru/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "GigaChat",
-                    "messages": messages
-                },
-                verify=False
-            )
-            
-            if response.status_code == 401:
-                # Если токен истек, получаем новый и пробуем снова
-                logger.info("Токен истек, получаем новый...")
-                self.access_token = self._get_access_token()
-                return self.chat_completion(messages)
-            
-            response.raise_for_status()
-            return response.json()["choices"][0]["message"]["content"]
+            return self.client.chat_completion(messages)
         except Exception as e:
             logger.error(f"Ошибка при отправке запроса к чат-модели: {str(e)}")
-            raise 
\ No newline at end of file
+            raise
@@ -0,0 +1,61 @@
+"""Настройки gunicorn: gunicorn -c gunicorn.conf.py wsgi:app
+
+Мастер-процесс один раз загружает книги и индекс (векторы отображаются в память
+только для чтения) и запускает процессы индексации worker.py. Воркеры создаются
+только после появления индекса активной книги и делят загруженные данные с мастером,
+поэтому память почти не растет с количеством воркеров.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+
+# Веб-процессы только читают индекс; эмбеддинги создают процессы worker.py
+os.environ.setdefault('INGESTION_MODE', 'worker')
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Потоковые ответы (SSE) держат соединение, пока идет генерация, поэтому воркеры многопоточные
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '8'))
+timeout = 180
+graceful_timeout = 30
+keepalive = 5
+# Приложение загружается в мастере до fork: индекс строится один раз
+preload_app = True
+
+# Процессы индексации (0 — запускаются отдельно, например на другой машине)
+INGESTION_PROCESSES = int(os.getenv('INGESTION_PROCESSES', '1'))
+# Сколько ждать индекса активной книги перед запуском воркеров, секунды
+READY_TIMEOUT = int(os.getenv('READY_TIMEOUT', '600'))
+
+_ingestion = None
+
+
+def on_starting(server):
+    global _ingestion
+    import app
+
+    if INGESTION_PROCESSES > 0:
+        worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+        _ingestion = subprocess.Popen([sys.executable, worker_script, '--processes', str(INGESTION_PROCESSES)])
+        server.log.info(f"Запущена индексация: {INGESTION_PROCESSES} процессов, pid {_ingestion.pid}")
+
+    if not app.wait_until_ready(READY_TIMEOUT):
+        server.log.warning(f"Индекс не появился за {READY_TIMEOUT} с, сервер будет отвечать 503 до его создания")
+
+
+def post_fork(server, worker):
+    import app
+
+    # Потоки мастера не наследуются после fork: у каждого воркера свой поток обновления индекса
+    app.start_index_refresh()
+
+
+def on_exit(server):
+    if _ingestion is not None and _ingestion.poll() is None:
+        _ingestion.terminate()
+        try:
+            _ingestion.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            _ingestion.kill()
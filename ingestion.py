@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import profiler
+from gigachat_client import RateLimitError
+
+logger = logging.getLogger(__name__)
+
+CHUNKS_EMBEDDED = metrics.Counter("embedding_chunks_total", "Чанки, для которых получены эмбеддинги")
+BATCH_RETRIES = metrics.Counter("embedding_batch_retries_total", "Повторы пакетов эмбеддингов по причине", ["reason"])
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов, подстраивающийся под ответы 429 (AIMD)"""
+
+    def __init__(self, rate=2.0, capacity=4, min_rate=0.2, max_rate=20.0, increase=0.1):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Блокирующее получение токена на один запрос"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def on_success(self):
+        """Аддитивное увеличение частоты после успешного запроса"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_rate_limited(self, retry_after=None):
+        """Мультипликативное снижение частоты и пауза после ответа 429"""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            pause = retry_after if retry_after is not None else 1.0 / self.rate
+            self._blocked_until = max(self._blocked_until, time.monotonic() + pause)
+        logger.warning(f"Превышен лимит запросов: частота снижена до {self.rate:.2f} запр/с, пауза {pause:.1f} с")
+
+
+class EmbeddingPipeline:
+    """Пакетное параллельное создание эмбеддингов с сохранением порядка чанков
+
+    embed_batch(texts) возвращает список векторов в порядке texts и бросает
+    RateLimitError на 429. commit(start_index, vectors) вызывается строго по
+    возрастанию индексов чанков, независимо от порядка завершения запросов.
+    limiter=None — без ограничения частоты (локальная модель). В profile
+    (profiler.IngestionProfile) записывается время этапов и объем данных.
+    """
+
+    def __init__(self, embed_batch, commit, limiter, batch_size=16, workers=4, max_retries=5, profile=None):
+        self.embed_batch = embed_batch
+        self.commit = commit
+        self.limiter = limiter
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.profile = profile
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next_index = 0
+        self._failed = threading.Event()
+
+    def _embed_with_retry(self, texts):
+        errors = 0
+        rate_limited = False
+        while not self._failed.is_set():
+            if self.limiter is not None:
+                # Ожидание после 429 — потерянное время, обычное ожидание — заданная частота запросов
+                with profiler.phase("backoff" if rate_limited else "throttle"):
+                    self.limiter.acquire()
+            try:
+                vectors = self.embed_batch(texts)
+            except RateLimitError as e:
+                # Повторяем ровно этот пакет, 429 не считается ошибкой
+                BATCH_RETRIES.inc(reason="429")
+                profiler.add(rate_limited=1)
+                if self.limiter is None:
+                    raise
+                self.limiter.on_rate_limited(e.retry_after)
+                rate_limited = True
+                continue
+            except Exception as e:
+                errors += 1
+                if errors > self.max_retries:
+                    raise
+                BATCH_RETRIES.inc(reason="error")
+                logger.warning(f"Ошибка при создании эмбеддингов, попытка {errors}/{self.max_retries}: {str(e)}")
+                with profiler.phase("retry_wait"):
+                    time.sleep(min(2 ** errors, 30))
+                continue
+            if len(vectors) != len(texts):
+                raise ValueError(f"API вернул {len(vectors)} эмбеддингов вместо {len(texts)}")
+            if self.limiter is not None:
+                self.limiter.on_success()
+            CHUNKS_EMBEDDED.inc(len(texts))
+            profiler.add(chunks=len(texts))
+            return vectors
+        return None
+
+    def _process(self, start, texts):
+        with profiler.activate(self.profile), profiler.hot_loop("embedding"):
+            try:
+                vectors = self._embed_with_retry(texts)
+            except Exception:
+                self._failed.set()
+                raise
+            if vectors is None:
+                return
+            with self._lock:
+                self._pending[start] = vectors
+                # Фиксируем непрерывный префикс готовых пакетов
+                while self._next_index in self._pending:
+                    ready = self._pending.pop(self._next_index)
+                    with profiler.phase("persist"):
+                        self.commit(self._next_index, ready)
+                    self._next_index += len(ready)
+
+    def run(self, chunks, start_index=0):
+        """Обработка чанков; возвращает количество зафиксированных эмбеддингов"""
+        self._pending = {}
+        self._next_index = start_index
+        self._failed.clear()
+        batches = [
+            (start_index + i, chunks[i:i + self.batch_size])
+            for i in range(0, len(chunks), self.batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="embedding") as executor:
+            futures = [executor.submit(self._process, start, texts) for start, texts in batches]
+            error = None
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    error = error or e
+        profiler.dump_hot_loops()
+        if error:
+            raise error
+        return self._next_index - start_index
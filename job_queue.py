@@ -0,0 +1,212 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд задача считается занятой воркером без продления
+DEFAULT_LEASE = 300
+MAX_ATTEMPTS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    book_id TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL NOT NULL DEFAULT 0,
+    worker TEXT,
+    error TEXT,
+    updated REAL NOT NULL,
+    UNIQUE (book_id, start)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+CREATE TABLE IF NOT EXISTS chunk_vectors (
+    book_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    vector BLOB NOT NULL,
+    PRIMARY KEY (book_id, idx)
+);
+"""
+
+
+class JobQueue:
+    """Очередь задач индексации в SQLite с контрольными точками по каждому чанку
+
+    Задача — диапазон чанков книги [start, end). Состояния: pending, running,
+    done, failed. Занятая задача с истекшей арендой снова выдается воркерам,
+    поэтому падение процесса не теряет работу, а повторная обработка безопасна:
+    векторы сохраняются по (book_id, idx) и перезаписываются идемпотентно.
+    """
+
+    def __init__(self, path="jobs.db"):
+        self.path = path
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+        # Соединение SQLite нельзя использовать в дочернем процессе после fork
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+    def _db(self):
+        # Отдельное соединение на поток: sqlite3 не разрешает делить его между потоками
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _connect(self):
+        return _Transaction(self._db())
+
+    def enqueue_book(self, book_id, total_chunks, job_size=64, start=0):
+        """Постановка книги в очередь; повторный вызов не создает дублей"""
+        now = time.time()
+        rows = [
+            (book_id, i, min(i + job_size, total_chunks), now)
+            for i in range(start - start % job_size, total_chunks, job_size)
+        ]
+        with self._connect() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO jobs (book_id, start, end, updated) VALUES (?, ?, ?, ?)", rows
+            )
+            # Задачи, исчерпавшие попытки, при повторной постановке возвращаем в работу
+            db.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, updated = ? WHERE book_id = ? AND state = 'failed'",
+                (now, book_id)
+            )
+
+    def reset_book(self, book_id):
+        """Сброс прогресса книги: эмбеддинги создаются заново (например, другой моделью)"""
+        with self._connect() as db:
+            db.execute("DELETE FROM chunk_vectors WHERE book_id = ?", (book_id,))
+            db.execute(
+                "UPDATE jobs SET state = 'pending', attempts = 0, lease_until = 0, error = NULL, updated = ? "
+                "WHERE book_id = ?",
+                (time.time(), book_id)
+            )
+
+    def claim(self, worker, lease=DEFAULT_LEASE):
+        """Выдача следующей задачи воркеру: (id, book_id, start, end) или None"""
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT id, book_id, start, end FROM jobs "
+                "WHERE state = 'pending' OR (state = 'running' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_until = ?, "
+                "worker = ?, updated = ? WHERE id = ?",
+                (now + lease, worker, now, row[0])
+            )
+            return row
+
+    def heartbeat(self, job_id, lease=DEFAULT_LEASE):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET lease_until = ? WHERE id = ?", (time.time() + lease, job_id))
+
+    def complete(self, job_id):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = 'done', error = NULL, updated = ? WHERE id = ?", (time.time(), job_id)
+            )
+
+    def fail(self, job_id, error, max_attempts=MAX_ATTEMPTS):
+        """Ошибка задачи: возврат в очередь или окончательный отказ после max_attempts"""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_until = 0, updated = ? WHERE id = ?",
+                (max_attempts, str(error), time.time(), job_id)
+            )
+
+    def save_vectors(self, book_id, start_index, vectors):
+        """Контрольная точка: векторы чанков сохраняются сразу после получения"""
+        rows = [
+            (book_id, start_index + i, np.asarray(v, dtype=np.float32).tobytes())
+            for i, v in enumerate(vectors)
+        ]
+        with self._connect() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO chunk_vectors (book_id, idx, vector) VALUES (?, ?, ?)", rows
+            )
+
+    def checkpointed_until(self, book_id, start, end):
+        """Первый индекс в [start, end), для которого еще нет сохраненного вектора"""
+        with self._connect() as db:
+            indices = {
+                row[0] for row in db.execute(
+                    "SELECT idx FROM chunk_vectors WHERE book_id = ? AND idx >= ? AND idx < ?",
+                    (book_id, start, end)
+                )
+            }
+        while start < end and start in indices:
+            start += 1
+        return start
+
+    def commit_ready(self, book_id, get_start, write):
+        """Перенос готовых векторов в хранилище строго по порядку чанков
+
+        Выполняется под блокировкой записи базы, поэтому дописывать хранилище
+        одновременно может только один процесс. get_start() возвращает число
+        уже сохраненных в хранилище строк, write(start, vectors) дописывает их.
+        """
+        with self._connect() as db:
+            start = get_start()
+            rows = db.execute(
+                "SELECT idx, vector FROM chunk_vectors WHERE book_id = ? AND idx >= ? ORDER BY idx",
+                (book_id, start)
+            ).fetchall()
+            vectors = []
+            for idx, blob in rows:
+                if idx != start + len(vectors):
+                    break
+                vectors.append(np.frombuffer(blob, dtype=np.float32))
+            if vectors:
+                write(start, vectors)
+            # Перенесенные в хранилище контрольные точки больше не нужны
+            db.execute("DELETE FROM chunk_vectors WHERE book_id = ? AND idx < ?", (book_id, start + len(vectors)))
+            return len(vectors)
+
+    def progress(self, book_id=None):
+        """Количество задач по состояниям"""
+        query = "SELECT state, COUNT(*) FROM jobs"
+        params = ()
+        if book_id is not None:
+            query += " WHERE book_id = ?"
+            params = (book_id,)
+        with self._connect() as db:
+            counts = dict(db.execute(query + " GROUP BY state", params).fetchall())
+        return {state: counts.get(state, 0) for state in ("pending", "running", "done", "failed")}
+
+    def has_work(self):
+        progress = self.progress()
+        return progress["pending"] + progress["running"] > 0
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT: запись блокирует базу сразу, без гонок между процессами"""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
@@ -0,0 +1,202 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+from vector_index import top_k
+
+logger = logging.getLogger(__name__)
+
+# Версия токенизации: при ее изменении сохраненные индексы строятся заново
+TOKENIZER_VERSION = 1
+
+WORD = re.compile(r"[0-9a-zа-я]+")
+
+STOP_WORDS = frozenset("""
+а без более бы был была были было быть в вам вас ведь весь во вот впрочем все всегда всего всех всю вы
+где да даже для до другой его ее ей ему если есть еще же ж за зачем здесь и из или им их к как какая
+какой когда конечно кто куда ли лучше между меня мне много может можно мой моя мы на над надо наконец нас
+не него нее ней нельзя нет ни нибудь никогда ним них ничего но ну о об один он она они опять от перед
+по под после потом потому почти при про раз разве с сам свою себе себя со совсем так такой там тебя тем
+теперь то тогда того тоже только том тот три тут ты у уж уже хоть чего чем через что чтоб чтобы чуть
+эти этого этой этом этот эту я
+""".split())
+
+# Окончания для облегченного стемминга: сначала длинные
+ENDINGS = sorted("""
+иями ями ами ией иям ием иях ого его ому ему ыми ими ешь ете ите ает яет ует ают яют уют ила ыла ено ена
+ая яя ое ее ие ые ой ей ий ый ом ем ам ям ах ях ию ью ия ья ов ев ую юю ть ет ут ют ит ат ят ла ли ло
+а я о е и ы у ю ь й
+""".split(), key=len, reverse=True)
+REFLEXIVE = ("ся", "сь")
+MIN_STEM = 3
+
+
+def stem(word):
+    """Облегченный стемминг русских слов: отбрасывание возвратной частицы и одного окончания"""
+    if len(word) <= MIN_STEM or not ("а" <= word[-1] <= "я"):
+        return word
+    for suffix in REFLEXIVE:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM:
+            word = word[:-len(suffix)]
+            break
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    """Термы текста: нижний регистр, е вместо ё, без стоп-слов, со стеммингом"""
+    words = WORD.findall(text.lower().replace("ё", "е"))
+    return [stem(word) for word in words if word not in STOP_WORDS]
+
+
+class BM25Index:
+    """Инвертированный индекс чанков с ранжированием BM25
+
+    Постинги хранятся в массивах numpy (CSR): для терма t документы
+    doc_ids[offsets[t]:offsets[t + 1]] и частоты tfs в том же диапазоне.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.meta = {}
+        self.terms = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.doc_ids = np.empty(0, dtype=np.int32)
+        self.tfs = np.empty(0, dtype=np.uint16)
+        self.doc_len = np.empty(0, dtype=np.int32)
+        self.idf = np.empty(0, dtype=np.float32)
+        self._norm = np.empty(0, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.doc_len.shape[0]
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def build(self, texts, **meta):
+        """Построение индекса по текстам чанков (номер документа = номер чанка)"""
+        terms = {}
+        term_ids, doc_ids, tfs = [], [], []
+        doc_len = np.zeros(len(texts), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_len[doc] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(terms.setdefault(term, len(terms)))
+                doc_ids.append(doc)
+                tfs.append(min(tf, 65535))
+
+        term_ids = np.array(term_ids, dtype=np.int64)
+        order = np.lexsort((np.array(doc_ids, dtype=np.int64), term_ids))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+        self._set(
+            terms,
+            offsets,
+            np.array(doc_ids, dtype=np.int32)[order],
+            np.array(tfs, dtype=np.uint16)[order],
+            doc_len,
+            {"version": TOKENIZER_VERSION, "k1": self.k1, "b": self.b, "docs": len(texts), **meta}
+        )
+        logger.info(f"BM25-индекс построен: {len(texts)} чанков, {len(terms)} термов, {len(self.doc_ids)} постингов")
+
+    def _set(self, terms, offsets, doc_ids, tfs, doc_len, meta):
+        n_docs = doc_len.shape[0]
+        df = np.diff(offsets).astype(np.float64)
+        idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(doc_len.mean()) if n_docs and doc_len.sum() else 1.0
+        # Знаменатель BM25 без tf зависит только от длины документа: считаем заранее
+        norm = (self.k1 * (1 - self.b + self.b * doc_len / avgdl)).astype(np.float32)
+        with self._lock:
+            self.terms, self.offsets, self.doc_ids, self.tfs = terms, offsets, doc_ids, tfs
+            self.doc_len, self.idf, self._norm, self.meta = doc_len, idf, norm, meta
+
+    def scores(self, query):
+        """Оценки BM25 всех документов для запроса (плотный массив)"""
+        with self._lock:
+            terms, offsets, doc_ids, tfs, idf, norm = (
+                self.terms, self.offsets, self.doc_ids, self.tfs, self.idf, self._norm
+            )
+        scores = np.zeros(norm.shape[0], dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = terms.get(term)
+            if term_id is None:
+                continue
+            start, end = offsets[term_id], offsets[term_id + 1]
+            docs = doc_ids[start:end]
+            tf = tfs[start:end].astype(np.float32)
+            # Внутри постинга документы уникальны, поэтому сложение по индексам корректно
+            scores[docs] += idf[term_id] * tf * (self.k1 + 1) / (tf + norm[docs])
+        return scores
+
+    def search(self, query, k=5):
+        """Поиск k лучших документов: (scores, ids); документы без совпадений не возвращаются"""
+        scores = self.scores(query)
+        ids = top_k(scores, k)
+        ids = ids[scores[ids] > 0]
+        return scores[ids], ids
+
+    def save(self, path):
+        terms = sorted(self.terms, key=self.terms.get)
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                meta=np.frombuffer(json.dumps(self.meta).encode("utf-8"), dtype=np.uint8),
+                terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype=np.uint8),
+                offsets=self.offsets,
+                doc_ids=self.doc_ids,
+                tfs=self.tfs,
+                doc_len=self.doc_len
+            )
+        os.replace(tmp_path, path)
+
+    def restore(self, path, **expected):
+        """Загрузка индекса из файла; False, если файла нет или он построен для других данных"""
+        if not os.path.exists(path):
+            return False
+        try:
+            with np.load(path) as data:
+                meta = json.loads(data["meta"].tobytes().decode("utf-8"))
+                expected = {"version": TOKENIZER_VERSION, "k1": self.k1, "b": self.b, **expected}
+                if any(meta.get(key) != value for key, value in expected.items()):
+                    logger.warning(f"BM25-индекс {path} построен для других данных, будет построен заново")
+                    return False
+                raw_terms = data["terms"].tobytes().decode("utf-8")
+                terms = {term: i for i, term in enumerate(raw_terms.split("\n"))} if raw_terms else {}
+                self._set(terms, data["offsets"], data["doc_ids"], data["tfs"], data["doc_len"], meta)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Ошибка при загрузке BM25-индекса {path}: {str(e)}")
+            return False
+        return True
+
+
+def fuse(vector_scores, lexical_scores, alpha=0.5):
+    """Взвешенная сумма оценок, приведенных к [0, 1] по набору кандидатов
+
+    alpha — вес векторной близости, 1 - alpha — вес BM25. Отсутствующие
+    оценки (NaN) считаются минимальными.
+    """
+    def normalize(scores):
+        scores = np.asarray(scores, dtype=np.float32)
+        present = ~np.isnan(scores)
+        if not present.any():
+            return np.zeros_like(scores)
+        low, high = scores[present].min(), scores[present].max()
+        result = np.zeros_like(scores)
+        if high > low:
+            result[present] = (scores[present] - low) / (high - low)
+        else:
+            result[present] = 1.0 if high > 0 else 0.0
+        return result
+
+    return alpha * normalize(vector_scores) + (1 - alpha) * normalize(lexical_scores)
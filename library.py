@@ -0,0 +1,511 @@
+import codecs
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+import numpy as np
+
+from book_text import BookText, byte_offsets
+from chunker import chunk_text, fixed_size_offsets
+from embedding_store import EmbeddingStore
+from lexical_index import BM25Index, fuse
+from profiler import IngestionProfile
+from vector_index import create_index, normalize_rows
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при потоковой записи загружаемого файла
+UPLOAD_BLOCK_SIZE = 64 * 1024
+# Поставщик эмбеддингов в хранилищах, созданных до появления метки provider
+DEFAULT_PROVIDER = "gigachat:Embeddings"
+
+
+class ContentHasher:
+    """Хеш текста без учета пробельных различий (BOM, переносы строк, отступы)
+
+    Книги из разных источников часто отличаются только пробелами, поэтому
+    хешируется последовательность слов, а не байты файла.
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._carry = ""
+
+    def update(self, piece):
+        piece = self._carry + piece.lstrip("\ufeff")
+        words = piece.split()
+        # Последнее слово может продолжиться в следующем блоке
+        if words and not piece[-1].isspace():
+            self._carry = words.pop()
+        else:
+            self._carry = ""
+        for word in words:
+            self._hash.update(word.encode("utf-8") + b" ")
+
+    def hexdigest(self):
+        if self._carry:
+            self._hash.update(self._carry.encode("utf-8") + b" ")
+            self._carry = ""
+        return self._hash.hexdigest()
+
+
+def hash_file(path, encoding="utf-8"):
+    """Идентификатор книги по содержимому файла (читается блоками)"""
+    hasher = ContentHasher()
+    with open(path, "r", encoding=encoding) as f:
+        while True:
+            piece = f.read(UPLOAD_BLOCK_SIZE)
+            if not piece:
+                break
+            hasher.update(piece)
+    return hasher.hexdigest()[:16]
+
+
+class Book:
+    """Книга: текст, разбиение на чанки, хранилище и индекс эмбеддингов"""
+
+    def __init__(self, book_id, text_path, store_path, title=None,
+                 chunk_tokens=160, chunk_overlap=32, index_kind="flat", index_params=None,
+                 provider=DEFAULT_PROVIDER):
+        self.book_id = book_id
+        self.provider = provider
+        self.title = title or os.path.basename(text_path)
+        self.text_path = text_path
+        self.store = EmbeddingStore(store_path)
+        self.index = create_index(index_kind, **(index_params or {}))
+        # Вспомогательные структуры индекса: списки IVF или сжатые векторы
+        self.index_path = os.path.splitext(store_path)[0] + f".{index_kind}.npz"
+        self.lexical = BM25Index()
+        self.lexical_path = os.path.splitext(store_path)[0] + ".bm25.npz"
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        # Текст отображается в память, фрагменты декодируются по запросу: text[start:end]
+        self.text = BookText(text_path)
+        self.text_digest = None
+        # Таблица чанков: смещения (start, end) в байтах файла; i-я строка соответствует i-му эмбеддингу
+        self.offsets = np.empty((0, 2), dtype=np.int64)
+        self.status = "new"
+        # Векторы хранилища нельзя использовать (другой поставщик, нет таблицы чанков):
+        # прогресс книги в очереди нужно сбросить
+        self.reindex = False
+        # Время этапов индексации в этом процессе и скорость роста индекса (для ETA)
+        self.profile = IngestionProfile(book_id)
+        self._lock = threading.Lock()
+
+    @property
+    def chunks_total(self):
+        return len(self.offsets)
+
+    @property
+    def chunks_indexed(self):
+        return len(self.index)
+
+    @property
+    def complete(self):
+        return self.chunks_total > 0 and self.chunks_indexed >= self.chunks_total
+
+    def load_text(self):
+        """Отображение текста книги в память (файл не читается в память процесса целиком)"""
+        self.text.close()
+        self.text.open()
+        self.text_digest = self.text.digest()
+        logger.info(f"Книга {self.book_id} загружена из {self.text_path}")
+
+    def store_metadata(self):
+        """Параметры, к которым привязано хранилище эмбеддингов"""
+        return {"text_hash": self.text_digest, "book_id": self.book_id, "provider": self.provider}
+
+    def load_embeddings(self, legacy_json=None, legacy_chunk_size=150):
+        """Загрузка эмбеддингов и смещений чанков из хранилища (с миграцией из JSON)"""
+        meta = self.store_metadata()
+        if self.store.open(text_hash=meta["text_hash"]):
+            provider = self.store.header.get("provider", DEFAULT_PROVIDER)
+            if provider != self.provider:
+                # Векторы другой модели несравнимы с векторами вопросов: индексируем заново
+                logger.warning(f"Эмбеддинги книги {self.book_id} созданы {provider}, а не {self.provider}, будут созданы заново")
+                self.reset_embeddings()
+                self.reindex = True
+                return False
+            # Смещения берем из хранилища: они соответствуют уже созданным векторам
+            offsets = self.store.load_offsets()
+            if offsets is None:
+                offsets = self._convert_legacy_offsets(self.store.load_legacy_offsets())
+            if offsets is None:
+                logger.warning(f"Смещения чанков книги {self.book_id} не найдены, эмбеддинги будут созданы заново")
+                self.reset_embeddings()
+                self.reindex = True
+                return False
+        else:
+            if not legacy_json or not os.path.exists(legacy_json):
+                return False
+            if not self.store.migrate_json(legacy_json, chunker={"chunk_size": legacy_chunk_size}, **meta):
+                return False
+            text = self.text.read()
+            offsets = byte_offsets(text, fixed_size_offsets(text, legacy_chunk_size))
+            self.store.save_offsets(offsets)
+
+        self.offsets = offsets
+        self.load_lexical()
+        self.index.load(self.store.matrix())
+        self.index.restore(self.index_path, provider=self.provider)
+        if self.complete:
+            self.status = "ready"
+        logger.info(f"Книга {self.book_id}: загружено {self.chunks_indexed} из {self.chunks_total} эмбеддингов")
+        return self.chunks_indexed > 0
+
+    def _open_store(self):
+        """Открытие хранилища, только если его строки годятся для книги: тот же текст, поставщик и таблица чанков"""
+        if not self.store.open(text_hash=self.text_digest):
+            return False
+        offsets = self.store.load_offsets()
+        if (self.store.header.get("provider", DEFAULT_PROVIDER) != self.provider
+                or offsets is None or not np.array_equal(offsets, self.offsets)):
+            # Строки другого поставщика или другого разбиения на чанки подключать нельзя
+            self.store.header = None
+            return False
+        return True
+
+    def reset_embeddings(self):
+        """Удаление векторов, которые нельзя использовать: хранилище и индекс создаются с первого чанка"""
+        with self._lock:
+            self.store.header = None
+            for path in [self.store.path] + glob.glob(glob.escape(self.index_path) + "*"):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.index.load(np.empty((0, 0), dtype=np.float32))
+        logger.info(f"Книга {self.book_id}: прежние эмбеддинги удалены")
+
+    def refresh(self):
+        """Подхват строк, дописанных в хранилище другим процессом"""
+        if self.store.header is None and not self._open_store():
+            return 0
+        count = len(self.store)
+        self.profile.observe(count)
+        if count > self.chunks_indexed:
+            self.index.refresh(self.store.matrix())
+            if self.complete:
+                self.status = "ready"
+        return count
+
+    def _convert_legacy_offsets(self, char_offsets):
+        """Перевод смещений прежнего формата (в символах) в байтовые; None, если это невозможно"""
+        if char_offsets is None:
+            return None
+        text = self.text.read()
+        if "\r" in text:
+            # Прежние смещения отсчитаны от текста, где \r\n заменены на \n: точно их не перевести
+            return None
+        offsets = byte_offsets(text, char_offsets)
+        self.store.save_offsets(offsets)
+        logger.info(f"Книга {self.book_id}: смещения чанков переведены в байты")
+        return offsets
+
+    def plan_chunks(self):
+        """Разбиение книги на чанки и сохранение таблицы чанков рядом с эмбеддингами"""
+        # Текст целиком декодируется только здесь, на время разбиения
+        with self.profile.phase("chunking"):
+            text = self.text.read()
+            self.offsets = byte_offsets(text, chunk_text(text, self.chunk_tokens, self.chunk_overlap))
+            del text
+        self.store.save_offsets(self.offsets)
+        logger.info(f"Книга {self.book_id} разбита на {self.chunks_total} чанков")
+        self.load_lexical()
+
+    def load_lexical(self):
+        """BM25-индекс по всем чанкам: доступен сразу, еще до создания эмбеддингов"""
+        expected = {"text_hash": self.text_digest, "docs": self.chunks_total}
+        if self.lexical.restore(self.lexical_path, **expected):
+            return
+        self.lexical.build(self.get_chunks(), **expected)
+        self.lexical.save(self.lexical_path)
+
+    def get_chunks(self, start=0, end=None):
+        """Тексты чанков по их смещениям"""
+        return [self.text[s:e] for s, e in self.offsets[start:end]]
+
+    def save_embeddings(self, start_index, vectors):
+        """Дописывание пакета эмбеддингов в индекс и в хранилище по индексу чанка"""
+        with self._lock:
+            if start_index != len(self.index):
+                raise ValueError(f"Эмбеддинг чанка {start_index} не совпадает с позицией в индексе {len(self.index)}")
+            if self.store.header is None or start_index == 0:
+                chunker = {"chunk_tokens": self.chunk_tokens, "chunk_overlap": self.chunk_overlap}
+                self.store.create(len(vectors[0]), chunker=chunker, **self.store_metadata())
+            if self.index.in_memory:
+                self.index.add(vectors)
+                self.store.append(vectors)
+            else:
+                # Индекс читает строки из хранилища: исходные векторы не копируются в память
+                self.store.append(vectors)
+                self.index.refresh(self.store.matrix())
+            self.profile.observe(len(self.index))
+
+    def export_index(self, dtype="float32"):
+        """Эмбеддинги и таблица чанков для другого узла: (размер в байтах, генератор блоков)"""
+        if self.store.header is None:
+            raise LookupError(f"Эмбеддинги книги {self.book_id} еще не созданы")
+        return self.store.export(self.offsets, dtype)
+
+    def import_index(self, stream):
+        """Эмбеддинги, созданные другим узлом: хранилище заменяется, индексы строятся заново
+
+        Экспорт принимается, только если он сделан для того же текста и того
+        же поставщика эмбеддингов. Вызывается при запуске, до обслуживания запросов.
+        """
+        with self._lock:
+            self.store.import_stream(stream, text_hash=self.text_digest, provider=self.provider)
+            # Сохраненные структуры индекса (списки IVF, сжатые строки) относятся к прежним строкам
+            for path in glob.glob(glob.escape(self.index_path) + "*"):
+                os.remove(path)
+        self.reindex = False
+        if not self.load_embeddings():
+            raise ValueError(f"Импортированные эмбеддинги книги {self.book_id} не загрузились")
+        self.save_index()
+        return self.chunks_indexed
+
+    def save_index(self):
+        with self.profile.phase("persist"):
+            self.index.save(self.index_path, provider=self.provider)
+
+    def search(self, question, query_vector=None, k=5, alpha=0.5, candidates=50):
+        """Гибридный поиск чанков: BM25 и векторная близость с весом alpha
+
+        Без query_vector (или при alpha=0) поиск только лексический, при alpha=1
+        только векторный. Кандидаты обоих поисков переоцениваются обоими способами.
+        Если BM25 ничего не нашел, а query_vector есть, ищутся ближайшие из уже
+        проиндексированных чанков; пустой результат — ни того, ни другого нет.
+        """
+        vector_ready = query_vector is not None and self.chunks_indexed > 0 and alpha > 0
+        if not vector_ready:
+            ids = self.lexical.search(question, k)[1] if self.lexical else np.empty(0, dtype=np.int64)
+            if len(ids) == 0 and query_vector is not None and self.chunks_indexed:
+                # В вопросе нет ни одного слова книги: ищем по уже готовым эмбеддингам
+                return self.index.search(query_vector, k)[1]
+            return ids
+        if alpha >= 1 or not self.lexical:
+            return self.index.search(query_vector, k)[1]
+
+        _, vector_ids = self.index.search(query_vector, candidates)
+        return self._fuse(question, query_vector, vector_ids, k, alpha, candidates)
+
+    def search_batch(self, questions, query_vectors=None, k=5, alpha=0.5, candidates=50):
+        """Гибридный поиск для нескольких вопросов
+
+        Векторные кандидаты всех вопросов находятся одним матрично-матричным
+        произведением, оценки BM25 и слияние считаются для каждого вопроса.
+        """
+        vector_ready = query_vectors is not None and self.chunks_indexed > 0 and alpha > 0
+        if not vector_ready:
+            return [self.search(question, None, k, alpha, candidates) for question in questions]
+        query_vectors = normalize_rows(query_vectors)
+        vector_only = alpha >= 1 or not self.lexical
+        _, vector_ids = self.index.search_batch(query_vectors, k if vector_only else candidates)
+        if vector_only:
+            return vector_ids
+        return [
+            self._fuse(question, query_vector, ids, k, alpha, candidates)
+            for question, query_vector, ids in zip(questions, query_vectors, vector_ids)
+        ]
+
+    def _fuse(self, question, query_vector, vector_ids, k, alpha, candidates):
+        lexical_scores = self.lexical.scores(question)
+        lexical_ids = np.argpartition(-lexical_scores, min(candidates, len(lexical_scores)) - 1)[:candidates]
+        lexical_ids = lexical_ids[lexical_scores[lexical_ids] > 0]
+        ids = np.union1d(vector_ids, lexical_ids).astype(np.int64)
+
+        # Чанки без эмбеддинга (индексация еще идет) получают минимальную векторную оценку
+        matrix = self.index.vectors()
+        vector_scores = np.full(ids.shape[0], np.nan, dtype=np.float32)
+        embedded = ids < matrix.shape[0]
+        vector_scores[embedded] = matrix[ids[embedded]] @ normalize_rows(query_vector)[0]
+        fused = fuse(vector_scores, lexical_scores[ids], alpha)
+        return ids[np.argsort(-fused, kind="stable")[:k]]
+
+    def warm(self):
+        """Пробный поиск: страницы отображенных в память векторов и BM25 читаются до первого запроса"""
+        self.lexical.scores(self.title)
+        if self.chunks_indexed:
+            self.index.search(np.ones(self.index.dim, dtype=np.float32), 1)
+
+    def progress(self):
+        return {
+            "book_id": self.book_id,
+            "title": self.title,
+            "status": self.status,
+            "chunks_total": self.chunks_total,
+            "chunks_indexed": self.chunks_indexed,
+            "eta_s": self._eta()
+        }
+
+    def _eta(self):
+        eta = self.profile.eta(self.chunks_indexed, self.chunks_total)
+        return round(eta, 1) if eta is not None else None
+
+
+class Library:
+    """Набор книг с дедупликацией по содержимому; одна из книг активна
+
+    Выбор активной книги хранится в файле active каталога библиотеки: его
+    подхватывают остальные процессы сервера и сам сервер после перезапуска.
+    """
+
+    def __init__(self, books_dir="books"):
+        self.books_dir = books_dir
+        self.active_path = os.path.join(books_dir, "active")
+        self.books = {}
+        self.active_id = None
+        self._lock = threading.Lock()
+        self._chunk_maps = {}
+
+    def add(self, book, activate=False):
+        with self._lock:
+            self.books[book.book_id] = book
+            if activate or self.active_id is None:
+                self.active_id = book.book_id
+
+    def get(self, book_id):
+        return self.books.get(book_id)
+
+    def active(self):
+        return self.books.get(self.active_id)
+
+    def activate(self, book_id):
+        """Смена активной книги во всех процессах"""
+        with self._lock:
+            os.makedirs(self.books_dir, exist_ok=True)
+            tmp_path = f"{self.active_path}-{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(book_id)
+            os.replace(tmp_path, self.active_path)
+            self.active_id = book_id
+
+    def load_active(self):
+        """Подхват активной книги, выбранной другим процессом или до перезапуска
+
+        Выбор применяется, только когда книга уже зарегистрирована в этом процессе.
+        """
+        try:
+            with open(self.active_path, "r", encoding="utf-8") as f:
+                book_id = f.read().strip()
+        except FileNotFoundError:
+            return
+        with self._lock:
+            if book_id in self.books and book_id != self.active_id:
+                self.active_id = book_id
+                logger.info(f"Активная книга: {book_id}")
+
+    def _chunk_map(self, book):
+        # Карта "хеш текста чанка -> строка" по уже проиндексированным чанкам книги.
+        # Пока индекс растет, хешируются только новые строки; заново карта строится,
+        # когда книга разбита на чанки заново или ее индекс сброшен
+        indexed = book.chunks_indexed
+        offsets = book.offsets
+        cached = self._chunk_maps.get(book.book_id)
+        if cached is None or cached[0] is not offsets or cached[1] > indexed:
+            cached = (offsets, 0, {})
+        done, mapping = cached[1], cached[2]
+        if done < indexed:
+            for row, chunk in enumerate(book.get_chunks(done, indexed), done):
+                mapping.setdefault(hashlib.sha1(chunk.encode("utf-8")).digest(), row)
+        self._chunk_maps[book.book_id] = (offsets, indexed, mapping)
+        return mapping
+
+    def reusable_vectors(self, texts, exclude=None, provider=DEFAULT_PROVIDER):
+        """Готовые векторы для чанков, совпадающих с чанками других книг (или None)
+
+        Почти одинаковые книги (другое оформление, приписка в конце) дают
+        одинаковые чанки, и их эмбеддинги не нужно запрашивать повторно.
+        """
+        result = [None] * len(texts)
+        books = [
+            b for b in list(self.books.values())
+            if b.book_id != exclude and b.provider == provider and b.chunks_indexed
+        ]
+        if not books:
+            return result
+        keys = [hashlib.sha1(t.encode("utf-8")).digest() for t in texts]
+        for book in books:
+            mapping = self._chunk_map(book)
+            matrix = book.index.vectors()
+            for i, key in enumerate(keys):
+                if result[i] is None and key in mapping:
+                    result[i] = np.array(matrix[mapping[key]])
+        return result
+
+    def book_paths(self, book_id):
+        """Пути к тексту, хранилищу и метаданным загруженной книги"""
+        base = os.path.join(self.books_dir, book_id)
+        return base + ".txt", base + ".bin", base + ".json"
+
+    def uploaded_books(self):
+        """Метаданные ранее загруженных книг: (book_id, title)"""
+        if not os.path.isdir(self.books_dir):
+            return []
+        result = []
+        for name in sorted(os.listdir(self.books_dir)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self.books_dir, name), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            result.append((meta["book_id"], meta.get("title")))
+        return result
+
+    def import_upload(self, stream, filename):
+        """Потоковая запись загруженной книги на диск с вычислением идентификатора
+
+        Возвращает (book_id, is_new). Если книга с таким содержимым уже есть,
+        новый файл удаляется, а существующие эмбеддинги используются повторно.
+        """
+        os.makedirs(self.books_dir, exist_ok=True)
+        tmp_path = os.path.join(self.books_dir, f"upload-{uuid.uuid4().hex}.tmp")
+        hasher = ContentHasher()
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        encoding = "utf-8"
+        try:
+            with open(tmp_path, "wb") as f:
+                while True:
+                    block = stream.read(UPLOAD_BLOCK_SIZE)
+                    if not block:
+                        break
+                    f.write(block)
+                    if encoding == "utf-8":
+                        try:
+                            hasher.update(decoder.decode(block))
+                        except UnicodeDecodeError:
+                            # Русские .txt часто в cp1251: перекодируем после записи
+                            encoding = "cp1251"
+            if encoding == "utf-8":
+                hasher.update(decoder.decode(b"", final=True))
+                book_id = hasher.hexdigest()[:16]
+            else:
+                book_id = hash_file(tmp_path, encoding)
+
+            text_path, _, meta_path = self.book_paths(book_id)
+            if book_id in self.books or os.path.exists(text_path):
+                logger.info(f"Книга {filename} совпадает с уже загруженной {book_id}")
+                return book_id, False
+
+            if encoding == "utf-8":
+                os.replace(tmp_path, text_path)
+            else:
+                self._transcode(tmp_path, text_path, encoding)
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump({"book_id": book_id, "title": filename}, f, ensure_ascii=False)
+            logger.info(f"Книга {filename} сохранена как {book_id}")
+            return book_id, True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @staticmethod
+    def _transcode(src, dst, encoding):
+        with open(src, "r", encoding=encoding) as fin, open(dst, "w", encoding="utf-8") as fout:
+            while True:
+                piece = fin.read(UPLOAD_BLOCK_SIZE)
+                if not piece:
+                    break
+                fout.write(piece)
@@ -0,0 +1,92 @@
+import contextlib
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+STARTUP_PHASE_SECONDS = metrics.Histogram(
+    "startup_phase_seconds", "Длительность этапов запуска сервера", ["phase", "outcome"]
+)
+
+STARTING = "starting"
+READY = "ready"
+FAILED = "failed"
+
+
+class Lifecycle:
+    """Состояние запуска процесса: этапы с замером времени и готовность к запросам
+
+    Этапы выполняются в фоне, пока HTTP-сервер уже отвечает на /healthz и
+    /readyz. Ошибка обязательного этапа переводит процесс в failed,
+    необязательного — только записывается в лог.
+    """
+
+    def __init__(self):
+        self.state = STARTING
+        self.phase_name = None
+        self.phases = []
+        self.error = None
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, required=True):
+        """Этап запуска: время попадает в лог, /readyz и метрику startup_phase_seconds"""
+        with self._lock:
+            self.phase_name = name
+        logger.info(f"Запуск: этап {name}")
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except Exception as e:
+            outcome = "error"
+            logger.error(f"Запуск: этап {name} завершился ошибкой: {str(e)}")
+            if required:
+                raise
+        finally:
+            elapsed = time.perf_counter() - start
+            STARTUP_PHASE_SECONDS.observe(elapsed, phase=name, outcome=outcome)
+            with self._lock:
+                self.phases.append({"phase": name, "seconds": round(elapsed, 3), "outcome": outcome})
+                self.phase_name = None
+            if outcome == "ok":
+                logger.info(f"Запуск: этап {name} занял {elapsed:.2f} с")
+
+    def run(self, startup):
+        """Выполнение startup() в текущем потоке; True, если процесс готов"""
+        try:
+            if startup() is False:
+                raise RuntimeError("Инициализация не выполнена")
+        except Exception as e:
+            with self._lock:
+                self.state, self.error = FAILED, str(e)
+            logger.error(f"Не удалось инициализировать сервер: {str(e)}")
+            return False
+        with self._lock:
+            self.state = READY
+        logger.info(f"Сервер готов за {time.time() - self.started_at:.2f} с")
+        return True
+
+    def start(self, startup):
+        """Запуск startup() в фоновом потоке"""
+        thread = threading.Thread(target=self.run, args=(startup,), name="startup", daemon=True)
+        thread.start()
+        return thread
+
+    @property
+    def ready(self):
+        return self.state == READY
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "phase": self.phase_name,
+                "phases": list(self.phases),
+                "error": self.error,
+                "uptime_s": round(time.time() - self.started_at, 3)
+            }
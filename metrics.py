@@ -0,0 +1,197 @@
+"""Метрики в формате Prometheus и трассировка отдельных запросов
+
+Счетчики и гистограммы хранятся в памяти процесса и отдаются через /metrics.
+span(name) измеряет участок кода: время попадает в гистограмму span_seconds и,
+если для текущего запроса включена трассировка, в список его этапов.
+При METRICS_ENABLED=0 span() возвращает общий пустой контекст, а счетчики
+ничего не делают.
+"""
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+
+ENABLED = os.getenv('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no', 'off')
+
+# Границы корзин гистограмм задержки, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+# Этапы трассируемого запроса: список (имя, секунды) или None, если трассировка выключена
+_trace = contextvars.ContextVar("trace", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Монотонный счетчик с метками"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def inc(self, value=1, **labels):
+        if not ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram:
+    """Гистограмма с накопительными корзинами, суммой и количеством наблюдений"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Счетчики по корзинам (последняя — +Inf), сумма, количество
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def register_collector(collect):
+    """Функция collect() -> [(имя, тип, описание, {метки: значение})], вызывается при выдаче /metrics"""
+    with _registry_lock:
+        _collectors.append(collect)
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    with _registry_lock:
+        metrics, collectors = list(_registry), list(_collectors)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    for collect in collectors:
+        for name, kind, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples.items():
+                lines.append(f"{name}{_format_labels([k for k, _ in labels], [v for _, v in labels])} {value}")
+    return "\n".join(lines) + "\n"
+
+
+SPAN_SECONDS = Histogram("span_seconds", "Длительность этапов обработки запроса", ["span"])
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        SPAN_SECONDS.observe(elapsed, span=self.name)
+        trace = _trace.get()
+        if trace is not None:
+            trace.append((self.name, elapsed))
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name):
+    """Контекст измерения участка кода"""
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(name)
+
+
+def start_trace():
+    """Включение трассировки этапов для текущего запроса"""
+    trace = []
+    _trace.set(trace)
+    return trace
+
+
+def stop_trace():
+    _trace.set(None)
+
+
+def server_timing(trace):
+    """Заголовок Server-Timing из этапов трассировки (одинаковые этапы суммируются)"""
+    totals = {}
+    for name, elapsed in trace:
+        totals[name] = totals.get(name, 0.0) + elapsed
+    return ", ".join(f"{name.replace(' ', '_')};dur={elapsed * 1000:.2f}" for name, elapsed in totals.items())
@@ -0,0 +1,249 @@
+"""Локальная замена GigaChat API для разработки и нагрузочных тестов
+
+Поддерживает OAuth, /embeddings и /chat/completions (в том числе stream=True).
+Задержки, ответы 429 и отзыв токенов (401) настраиваются, а эмбеддинги
+детерминированы: одинаковый текст всегда дает одинаковый вектор, а тексты
+с общими словами — близкие векторы, поэтому поиск по книге работает осмысленно.
+
+Пример:
+    python mock_gigachat.py --port 9099 --latency 50 --rate-limit 0.05
+    GIGACHAT_API_URL=http://127.0.0.1:9099/api/v1 GIGACHAT_AUTH_URL=http://127.0.0.1:9099/oauth python app.py
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+from flask import Flask, Response, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"\w+")
+
+app = Flask(__name__)
+
+# Параметры мока; меняются аргументами командной строки или configure()
+config = {
+    "dim": 1024,
+    # Задержка ответа в миллисекундах и ее случайный разброс (доля)
+    "latency": 0.0,
+    "embedding_latency_per_text": 0.0,
+    "chat_latency": 0.0,
+    "token_delay": 0.0,
+    "jitter": 0.2,
+    # Вероятности ответа 429 и отзыва токена с ответом 401
+    "rate_limit": 0.0,
+    "retry_after": 1.0,
+    "unauthorized": 0.0,
+    "token_ttl": 1800,
+    "answer_tokens": 60,
+    "seed": 0
+}
+
+_tokens = {}
+_stats = {"oauth": 0, "embeddings": 0, "embedded_texts": 0, "chat": 0, "chat_stream": 0,
+          "rate_limited": 0, "unauthorized": 0}
+_lock = threading.Lock()
+_random = random.Random(0)
+
+
+def configure(**params):
+    unknown = set(params) - set(config)
+    if unknown:
+        raise ValueError(f"Неизвестные параметры мока: {', '.join(sorted(unknown))}")
+    config.update(params)
+    _random.seed(config["seed"])
+
+
+def _count(name, value=1):
+    with _lock:
+        _stats[name] += value
+
+
+def _chance(probability):
+    with _lock:
+        return _random.random() < probability
+
+
+def _sleep(ms):
+    if ms > 0:
+        with _lock:
+            factor = 1 + _random.uniform(-config["jitter"], config["jitter"])
+        time.sleep(ms * factor / 1000)
+
+
+def _word_vector(word, dim):
+    # Хеширование слова в несколько координат со знаком (feature hashing)
+    digest = hashlib.blake2b(word.encode("utf-8"), digest_size=16).digest()
+    vector = np.zeros(dim, dtype=np.float32)
+    for i in range(0, 16, 4):
+        position = int.from_bytes(digest[i:i + 3], "little") % dim
+        vector[position] += 1.0 if digest[i + 3] & 1 else -1.0
+    return vector
+
+
+def embed(text, dim=None):
+    """Детерминированный нормированный вектор текста"""
+    dim = dim or config["dim"]
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD.findall(text.lower()):
+        vector += _word_vector(word, dim)
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+    return (vector / norm).tolist()
+
+
+def answer_tokens(messages):
+    """Детерминированный ответ чат-модели, разбитый на фрагменты"""
+    question = messages[-1].get("content", "") if messages else ""
+    words = WORD.findall(question)[:10] or ["вопрос"]
+    count = config["answer_tokens"]
+    return [f"{words[i % len(words)]} " for i in range(count)]
+
+
+def _check_request():
+    """Общие проверки API: авторизация и ограничение частоты запросов"""
+    header = request.headers.get("Authorization", "")
+    token = header[len("Bearer "):] if header.startswith("Bearer ") else None
+    with _lock:
+        expires_at = _tokens.get(token)
+    if expires_at is None or expires_at < time.time():
+        _count("unauthorized")
+        return jsonify({"status": 401, "message": "Token has expired"}), 401
+    if _chance(config["unauthorized"]):
+        # Досрочный отзыв токена: клиент должен получить новый
+        with _lock:
+            _tokens.pop(token, None)
+        _count("unauthorized")
+        return jsonify({"status": 401, "message": "Token has expired"}), 401
+    if _chance(config["rate_limit"]):
+        _count("rate_limited")
+        response = jsonify({"status": 429, "message": "Too Many Requests"})
+        response.headers["Retry-After"] = str(config["retry_after"])
+        return response, 429
+    return None
+
+
+@app.route("/oauth", methods=["POST"])
+@app.route("/api/v2/oauth", methods=["POST"])
+def oauth():
+    if not request.headers.get("Authorization") or not request.headers.get("RqUID"):
+        return jsonify({"code": 6, "message": "credentials doesn't match db data"}), 401
+    _count("oauth")
+    _sleep(config["latency"])
+    token = uuid.uuid4().hex
+    expires_at = time.time() + config["token_ttl"]
+    with _lock:
+        _tokens[token] = expires_at
+    return jsonify({"access_token": token, "expires_at": int(expires_at * 1000)})
+
+
+@app.route("/api/v1/embeddings", methods=["POST"])
+def embeddings():
+    error = _check_request()
+    if error:
+        return error
+    texts = request.get_json()["input"]
+    if isinstance(texts, str):
+        texts = [texts]
+    _count("embeddings")
+    _count("embedded_texts", len(texts))
+    _sleep(config["latency"] + config["embedding_latency_per_text"] * len(texts))
+    return jsonify({
+        "object": "list",
+        "model": "Embeddings",
+        "data": [
+            {"object": "embedding", "index": i, "embedding": embed(text), "usage": {"prompt_tokens": len(text.split())}}
+            for i, text in enumerate(texts)
+        ]
+    })
+
+
+@app.route("/api/v1/chat/completions", methods=["POST"])
+def chat_completions():
+    error = _check_request()
+    if error:
+        return error
+    data = request.get_json()
+    parts = answer_tokens(data.get("messages", []))
+    model = data.get("model", "GigaChat")
+
+    if not data.get("stream"):
+        _count("chat")
+        _sleep(config["latency"] + config["chat_latency"] + config["token_delay"] * len(parts))
+        return jsonify({
+            "model": model,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(parts)}}],
+            "usage": {"completion_tokens": len(parts)}
+        })
+
+    _count("chat_stream")
+
+    def generate():
+        _sleep(config["latency"] + config["chat_latency"])
+        for part in parts:
+            _sleep(config["token_delay"])
+            chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": part}}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return Response(generate(), mimetype="text/event-stream")
+
+
+@app.route("/mock/stats")
+def stats():
+    with _lock:
+        return jsonify(dict(_stats))
+
+
+@app.route("/mock/config", methods=["GET", "POST"])
+def mock_config():
+    """Просмотр и изменение параметров мока во время теста"""
+    if request.method == "POST":
+        try:
+            configure(**(request.get_json() or {}))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9099)
+    parser.add_argument("--dim", type=int, default=config["dim"], help="размерность эмбеддингов")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка каждого ответа, мс")
+    parser.add_argument("--embedding-latency-per-text", type=float, default=0.0, help="доп. задержка на текст, мс")
+    parser.add_argument("--chat-latency", type=float, default=0.0, help="доп. задержка до первого токена ответа, мс")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="задержка на фрагмент ответа, мс")
+    parser.add_argument("--jitter", type=float, default=config["jitter"], help="случайный разброс задержек (доля)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="вероятность ответа 429")
+    parser.add_argument("--retry-after", type=float, default=config["retry_after"], help="Retry-After для 429, с")
+    parser.add_argument("--unauthorized", type=float, default=0.0, help="вероятность отзыва токена (401)")
+    parser.add_argument("--token-ttl", type=int, default=config["token_ttl"], help="время жизни токена, с")
+    parser.add_argument("--answer-tokens", type=int, default=config["answer_tokens"], help="длина ответа в фрагментах")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    params = vars(args)
+    host, port = params.pop("host"), params.pop("port")
+    configure(**params)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    print(f"Мок GigaChat API: http://{host}:{port}/api/v1, OAuth: http://{host}:{port}/oauth")
+    app.run(host=host, port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Профиль индексации: на что уходит время создания эмбеддингов
+
+Конвейер и клиент API отмечают этапы (разбиение на чанки, сериализация
+запроса, ожидание сети, паузы ограничителя частоты, разбор JSON, запись в
+хранилище); для каждого этапа суммируются время по часам и процессорное
+время потока. Профиль книги доступен в /status вместе с оценкой оставшегося
+времени и выводится в лог по окончании индексации.
+
+INGESTION_CPROFILE_DIR — каталог, куда горячие циклы индексации сохраняют
+профили cProfile (файл на цикл и поток, накапливается за время работы
+процесса), для snakeviz или pstats.
+Для py-spy потоки конвейера называются embedding-N, а этапы — отдельные
+функции, так что их видно на flame graph без дополнительных настроек.
+"""
+import contextlib
+import contextvars
+import cProfile
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+CPROFILE_DIR = os.getenv('INGESTION_CPROFILE_DIR')
+# Окно, по которому оценивается текущая скорость индексации для ETA (секунды)
+RATE_WINDOW = 120
+
+# Профиль, в который пишут этапы текущего потока (устанавливает конвейер)
+_active = contextvars.ContextVar("ingestion_profile", default=None)
+
+
+class IngestionProfile:
+    """Накопленное время этапов, объем данных и скорость индексации одной книги"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.phases = {}
+        self.chunks = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._samples = deque()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Этап: время по часам и процессорное время текущего потока"""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def record(self, name, wall, cpu=0.0):
+        with self._lock:
+            if self.started is None:
+                self.started = time.time() - wall
+            totals = self.phases.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    def add(self, chunks=0, requests=0, rate_limited=0, bytes_sent=0, bytes_received=0):
+        with self._lock:
+            if self.started is None:
+                self.started = time.time()
+            self.chunks += chunks
+            self.requests += requests
+            self.rate_limited += rate_limited
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+
+    def observe(self, indexed):
+        """Отметка прогресса книги (чанков в индексе): по ней считается ETA в любом процессе"""
+        now = time.monotonic()
+        with self._lock:
+            if self._samples and indexed < self._samples[-1][1]:
+                # Индекс создается заново
+                self._samples.clear()
+            self._samples.append((now, indexed))
+            while len(self._samples) > 2 and now - self._samples[1][0] > RATE_WINDOW:
+                self._samples.popleft()
+
+    def eta(self, indexed, total):
+        """Оставшееся время индексации в секундах или None, если скорость еще неизвестна"""
+        if indexed >= total:
+            return 0.0
+        with self._lock:
+            if len(self._samples) < 2:
+                return None
+            (first_time, first), (last_time, last) = self._samples[0], self._samples[-1]
+        if last <= first or last_time <= first_time:
+            return None
+        return (total - indexed) / ((last - first) / (last_time - first_time))
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self.started if self.started is not None else 0.0
+            phases = {
+                name: {"calls": calls, "wall_s": round(wall, 3), "cpu_s": round(cpu, 3)}
+                for name, (calls, wall, cpu) in self.phases.items()
+            }
+            return {
+                "elapsed_s": round(elapsed, 3),
+                "chunks": self.chunks,
+                "chunks_per_s": round(self.chunks / elapsed, 2) if elapsed > 0 else None,
+                "requests": self.requests,
+                "rate_limited": self.rate_limited,
+                "backoff_s": phases.get("backoff", {}).get("wall_s", 0.0),
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "phases": phases
+            }
+
+    def report(self):
+        """Сводка для лога: скорость, потери на 429 и таблица этапов"""
+        summary = self.summary()
+        lines = [
+            f"Профиль индексации {self.name}: {summary['chunks']} чанков за {summary['elapsed_s']:.1f} с "
+            f"({summary['chunks_per_s'] or 0:.1f} чанк/с), запросов {summary['requests']}, "
+            f"ответов 429 {summary['rate_limited']}, пауз после 429 {summary['backoff_s']:.1f} с, "
+            f"отправлено {summary['bytes_sent'] / 1e6:.2f} МБ, получено {summary['bytes_received'] / 1e6:.2f} МБ",
+            f"{'этап':<12} {'вызовы':>8} {'время, с':>10} {'CPU, с':>10}"
+        ]
+        for name, phase in sorted(summary["phases"].items(), key=lambda item: -item[1]["wall_s"]):
+            lines.append(f"{name:<12} {phase['calls']:>8} {phase['wall_s']:>10.3f} {phase['cpu_s']:>10.3f}")
+        return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def activate(profile):
+    """Этапы текущего потока (в том числе в клиенте API) записываются в profile"""
+    token = _active.set(profile)
+    try:
+        yield
+    finally:
+        _active.reset(token)
+
+
+def phase(name):
+    """Этап активного профиля потока; без профиля (запросы пользователей) ничего не измеряет"""
+    profile = _active.get()
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.phase(name)
+
+
+def add(**amounts):
+    """Счетчики активного профиля потока (байты, запросы)"""
+    profile = _active.get()
+    if profile is not None:
+        profile.add(**amounts)
+
+
+_cprofiles = {}
+_cprofiles_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def hot_loop(name):
+    """Горячий цикл: при INGESTION_CPROFILE_DIR профилируется cProfile
+
+    Профиль копится по имени потока, а не по самому потоку: пулы конвейера
+    создаются заново для каждой задачи, но их потоки называются одинаково.
+    """
+    if not CPROFILE_DIR:
+        yield
+        return
+    with _cprofiles_lock:
+        profile = _cprofiles.setdefault((name, threading.current_thread().name), cProfile.Profile())
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+
+
+def dump_hot_loops():
+    """Сохранение накопленных профилей cProfile (файлы перезаписываются с данными за все время)"""
+    with _cprofiles_lock:
+        profiles = list(_cprofiles.items())
+    if not profiles:
+        return
+    os.makedirs(CPROFILE_DIR, exist_ok=True)
+    for (name, thread), profile in profiles:
+        profile.dump_stats(os.path.join(CPROFILE_DIR, f"{name}-{os.getpid()}-{thread}.prof"))
+    logger.debug(f"Профили cProfile ({len(profiles)}) сохранены в {CPROFILE_DIR}")
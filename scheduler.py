@@ -0,0 +1,362 @@
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: чем меньше число, тем раньше запрос получает слот
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+QUEUE_WAIT = metrics.Histogram("upstream_queue_wait_seconds", "Ожидание слота для запроса к API", ["priority"])
+SHED = metrics.Counter("upstream_shed_total", "Запросы, отклоненные из-за перегрузки очереди к API", ["priority"])
+
+# Сколько секунд после интерактивного запроса фоновым недоступен резерв общего бюджета
+INTERACTIVE_HOLD = 5.0
+# Как часто процесс перечитывает общую паузу (секунды)
+SHARED_POLL = 0.2
+# Сколько ждать блокировки общей базы другим процессом, прежде чем продолжить без нее
+SHARED_TIMEOUT = 1.0
+
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS upstream (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    paused_until REAL NOT NULL,
+    interactive_until REAL NOT NULL
+)
+"""
+
+_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(value):
+    """Приоритет запросов к API внутри блока (по умолчанию — интерактивный)"""
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+class Overloaded(Exception):
+    """Очередь к API не уложится в допустимую задержку; retry_after — рекомендуемая пауза"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Сервис перегружен, повторите через {retry_after} с")
+        self.retry_after = retry_after
+
+
+class SharedBudget:
+    """Общие для всех процессов пауза после 429 и бюджет частоты запросов к API
+
+    Веб-воркеры и процессы worker.py работают с одним файлом SQLite: ответ 429
+    в любом процессе приостанавливает запросы во всех, а токены частоты rate
+    (0 — без ограничения) расходуются из одного ведра. Интерактивные запросы
+    отмечают себя в общем состоянии; пока отметка свежее hold секунд, фоновым
+    запросам недоступны reserve токенов ведра. Без ограничения частоты запросы
+    только читают снимок паузы (не чаще раза в SHARED_POLL секунд).
+
+    Файл создается при первом обращении. Ошибка базы не останавливает запросы:
+    процесс продолжает со своей паузой и ограничением частоты.
+    """
+
+    def __init__(self, path, rate=0.0, reserve=2, hold=INTERACTIVE_HOLD):
+        self.path = path
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.reserve = min(reserve, self.capacity - 1)
+        self.hold = hold
+        # (время чтения, конец паузы, токены) — последнее известное общее состояние
+        self._snapshot = (0.0, 0.0, 0.0)
+        self._local = threading.local()
+        # Соединение SQLite нельзя использовать в дочернем процессе после fork
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=SHARED_TIMEOUT, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(SHARED_SCHEMA)
+            self._local.db = db
+        return db
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Строку создает первая запись: чтению (и новому соединению) блокировка записи не нужна
+            db.execute("INSERT OR IGNORE INTO upstream VALUES (0, 0, 0, 0, 0)")
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _read(self, db):
+        row = db.execute(
+            "SELECT tokens, updated, paused_until, interactive_until FROM upstream WHERE id = 0"
+        ).fetchone()
+        return row or (0.0, 0.0, 0.0, 0.0)
+
+    def poll(self):
+        """Обновление снимка общего состояния, если он старше SHARED_POLL"""
+        now = time.time()
+        if now - self._snapshot[0] <= SHARED_POLL:
+            return
+        try:
+            tokens, updated, paused_until, _ = self._read(self._db())
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка чтения общего состояния запросов к API {self.path}: {str(e)}")
+            self._snapshot = (now,) + self._snapshot[1:]
+            return
+        if self.rate > 0:
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+        self._snapshot = (now, paused_until, tokens)
+
+    def take(self, priority_class):
+        """Разрешение на один запрос: 0 — можно отправлять, иначе сколько подождать (секунды)"""
+        if self.rate <= 0:
+            # Общей частоты нет: писать в базу нечего, достаточно снимка паузы
+            self.poll()
+            return self.paused()
+        now = time.time()
+        try:
+            with self._transaction() as db:
+                tokens, updated, paused_until, interactive_until = self._read(db)
+                if priority_class == INTERACTIVE:
+                    interactive_until = max(interactive_until, now + self.hold)
+                wait = max(0.0, paused_until - now)
+                tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+                reserved = self.reserve if priority_class != INTERACTIVE and now < interactive_until else 0
+                if wait == 0 and tokens < reserved + 1:
+                    wait = (reserved + 1 - tokens) / self.rate
+                if wait == 0:
+                    tokens -= 1
+                db.execute(
+                    "UPDATE upstream SET tokens = ?, updated = ?, interactive_until = ? WHERE id = 0",
+                    (tokens, now, interactive_until)
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка общего бюджета запросов к API {self.path}: {str(e)}")
+            return 0.0
+        self._snapshot = (now, paused_until, tokens)
+        return wait
+
+    def on_rate_limited(self, pause):
+        """Ответ 429 в любом процессе: запросы всех процессов приостанавливаются на pause секунд"""
+        now = time.time()
+        try:
+            with self._transaction() as db:
+                db.execute(
+                    "UPDATE upstream SET tokens = 0, updated = ?, paused_until = MAX(paused_until, ?) WHERE id = 0",
+                    (now, now + pause)
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи паузы запросов к API {self.path}: {str(e)}")
+        self._snapshot = (now, max(self._snapshot[1], now + pause), 0.0)
+
+    def estimated_wait(self, ahead=0):
+        """Оценка ожидания по снимку общей паузы и ведра (без обращения к базе), секунды"""
+        now = time.time()
+        read_at, paused_until, tokens = self._snapshot
+        wait = max(0.0, paused_until - now)
+        if self.rate > 0:
+            tokens = min(self.capacity, tokens + max(0.0, now - read_at) * self.rate)
+            wait = max(wait, (ahead + 1 - tokens) / self.rate)
+        return wait
+
+    def paused(self):
+        """Остаток общей паузы после 429 по снимку, секунды"""
+        return max(0.0, self._snapshot[1] - time.time())
+
+
+class UpstreamScheduler:
+    """Общая очередь запросов к GigaChat API с приоритетами
+
+    Ограничивает число одновременных запросов (max_concurrency) и частоту
+    (rate запросов в секунду, 0 — без ограничения). Слоты выдаются по
+    приоритету, фоновым запросам недоступны reserve слотов, оставленных для
+    интерактивных. Интерактивный запрос отклоняется сразу (Overloaded), если
+    ожидаемое ожидание больше latency_budget секунд.
+
+    Очередь и слоты принадлежат процессу. С shared (SharedBudget) пауза после
+    429 и ограничение частоты общие для всех процессов, а собственное
+    ограничение частоты планировщика не используется. К базе shared процесс
+    обращается, не удерживая блокировку очереди: освобождение слотов и
+    статистика не ждут другие процессы.
+    """
+
+    def __init__(self, max_concurrency=8, rate=0.0, latency_budget=2.0, reserve=2, shared=None):
+        self.max_concurrency = max_concurrency
+        self.shared = shared
+        self.rate = rate if shared is None else 0.0
+        self.latency_budget = latency_budget
+        self.reserve = min(reserve, max_concurrency - 1)
+        self.in_flight = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._tokens = float(max(1.0, rate))
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Скользящее среднее длительности запроса: основа оценки ожидания
+        self._service_time = 0.5
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _limit(self, priority_class):
+        return self.max_concurrency - (self.reserve if priority_class != INTERACTIVE else 0)
+
+    def _waiting_before(self, priority_class):
+        return sum(1 for entry in self._waiting if entry[0] <= priority_class)
+
+    def estimated_wait(self, priority_class=INTERACTIVE):
+        """Оценка ожидания нового запроса с данным приоритетом, секунды"""
+        if self.shared is not None:
+            self.shared.poll()
+        with self._cond:
+            return self._estimate(priority_class, time.monotonic())
+
+    def _estimate(self, priority_class, now):
+        ahead = self._waiting_before(priority_class)
+        wait = max(0.0, self._paused_until - now)
+        busy = self.in_flight + ahead + 1 - self._limit(priority_class)
+        if busy > 0:
+            wait += math.ceil(busy / self._limit(priority_class)) * self._service_time
+        if self.rate > 0:
+            self._refill(now)
+            wait = max(wait, (ahead + 1 - self._tokens) / self.rate)
+        if self.shared is not None:
+            wait = max(wait, self.shared.estimated_wait(ahead))
+        return wait
+
+    def admit(self, priority_class=INTERACTIVE):
+        """Быстрая проверка перед началом обработки запроса: Overloaded при перегрузке"""
+        if priority_class != INTERACTIVE:
+            return
+        wait = self.estimated_wait(priority_class)
+        if wait > self.latency_budget:
+            SHED.inc(priority=PRIORITY_NAMES[priority_class])
+            raise Overloaded(max(1, math.ceil(wait)))
+
+    def on_rate_limited(self, retry_after=None):
+        """Ответ 429: новые запросы не отправляются retry_after секунд"""
+        with self._cond:
+            pause = retry_after if retry_after is not None else 1.0
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self._tokens = 0.0
+            self._cond.notify_all()
+        if self.shared is not None:
+            self.shared.on_rate_limited(pause)
+
+    @contextlib.contextmanager
+    def slot(self, priority_class=None):
+        """Слот для одного запроса к API: занят до выхода из блока"""
+        priority_class = current_priority() if priority_class is None else priority_class
+        started = time.monotonic()
+        self._acquire(priority_class, started)
+        granted = time.monotonic()
+        QUEUE_WAIT.observe(granted - started, priority=PRIORITY_NAMES[priority_class])
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._service_time = 0.8 * self._service_time + 0.2 * (time.monotonic() - granted)
+                self._cond.notify_all()
+
+    def _acquire(self, priority_class, started):
+        interactive = priority_class == INTERACTIVE
+        if self.shared is not None:
+            self.shared.poll()
+        with self._cond:
+            if interactive:
+                wait = self._estimate(priority_class, started)
+                if wait > self.latency_budget:
+                    SHED.inc(priority=PRIORITY_NAMES[priority_class])
+                    raise Overloaded(max(1, math.ceil(wait)))
+            entry = (priority_class, next(self._counter))
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    timeout = None
+                    if self._waiting[0] == entry and self.in_flight < self._limit(priority_class):
+                        if now < self._paused_until:
+                            timeout = self._paused_until - now
+                        elif self.rate > 0 and self._tokens < 1:
+                            timeout = (1 - self._tokens) / self.rate
+                        elif self.shared is None:
+                            if self.rate > 0:
+                                self._tokens -= 1
+                            self.in_flight += 1
+                            return
+                        else:
+                            # Пауза после 429 и частота, общие с другими процессами. Слот занимается
+                            # заранее, а база читается без блокировки очереди
+                            self.in_flight += 1
+                            granted = False
+                            self._cond.release()
+                            try:
+                                shared_wait = self.shared.take(priority_class)
+                                granted = shared_wait <= 0
+                            finally:
+                                self._cond.acquire()
+                                if not granted:
+                                    self.in_flight -= 1
+                            if granted:
+                                return
+                            timeout = shared_wait
+                    if interactive:
+                        remaining = self.latency_budget - (now - started)
+                        if remaining <= 0:
+                            SHED.inc(priority=PRIORITY_NAMES[priority_class])
+                            raise Overloaded(max(1, math.ceil(self._service_time)))
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                    self._cond.wait(timeout)
+            finally:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                # Следующий в очереди мог стать первым
+                self._cond.notify_all()
+
+    def stats(self):
+        if self.shared is not None:
+            self.shared.poll()
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "max_concurrency": self.max_concurrency,
+                "waiting": len(self._waiting),
+                "service_time_s": round(self._service_time, 3),
+                "paused_s": round(max(self._paused_until - time.monotonic(),
+                                      self.shared.paused() if self.shared is not None else 0.0, 0.0), 3)
+            }
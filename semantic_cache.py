@@ -0,0 +1,129 @@
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """Кэш результатов по близости эмбеддингов вопросов: перефразированный вопрос находит прошлый
+
+    Хранит до maxsize записей (LRU) в памяти процесса: нормированный вектор
+    вопроса, найденный контекст и, когда он получен, ответ модели. При
+    косинусной близости не ниже threshold вопрос получает готовый контекст, не
+    ниже answer_threshold — еще и готовый ответ. Записи привязаны к книге и
+    к версии ее индекса: когда индекс книги меняется, ее записи сбрасываются.
+    """
+
+    def __init__(self, name, maxsize=512, threshold=0.92, answer_threshold=0.97):
+        self.name = name
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.answer_threshold = answer_threshold
+        self.hits = 0
+        self.misses = 0
+        self.answer_hits = 0
+        self._vectors = None
+        # Книга каждой строки матрицы векторов (None — строка свободна)
+        self._books = np.full(maxsize, None, dtype=object)
+        self._row_keys = [None] * maxsize
+        # Ключ записи -> запись; порядок — от давно использованных к недавним
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, book_id, vector, version=None):
+        """Ближайшая запись книги: (ключ, контекст, ответ или None, близость) или None"""
+        if self.maxsize <= 0:
+            return None
+        query = self._normalize(vector)
+        with self._lock:
+            self._check_version(book_id, version)
+            rows = np.flatnonzero(self._books == book_id) if self._vectors is not None else []
+            if len(rows) == 0 or self._vectors.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            scores = self._vectors[rows] @ query
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            if similarity < self.threshold:
+                self.misses += 1
+                return None
+            row = int(rows[best])
+            key = self._row_keys[row]
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            answer = entry["answer"] if similarity >= self.answer_threshold else None
+            if answer is not None:
+                self.answer_hits += 1
+            return key, entry["context"], answer, similarity
+
+    def add(self, book_id, vector, context, version=None):
+        """Новая запись с контекстом вопроса; возвращает ее ключ (для set_answer)"""
+        if self.maxsize <= 0:
+            return None
+        vector = self._normalize(vector)
+        with self._lock:
+            self._check_version(book_id, version)
+            if self._vectors is None or self._vectors.shape[1] != vector.shape[0]:
+                # Размерность сменилась только вместе с поставщиком эмбеддингов: старые записи несравнимы
+                self._vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=np.float32)
+                self._books[:] = None
+                self._entries.clear()
+            if len(self._entries) >= self.maxsize:
+                _, evicted = self._entries.popitem(last=False)
+                self._books[evicted["row"]] = None
+            row = int(np.flatnonzero(self._books == None)[0])  # noqa: E711 — поэлементное сравнение
+            self._vectors[row] = vector
+            self._books[row] = book_id
+            key = self._row_keys[row] = self._next_key
+            self._next_key += 1
+            self._entries[key] = {"row": row, "context": context, "answer": None}
+            return key
+
+    def set_answer(self, key, answer):
+        """Ответ модели для записи (если она еще не вытеснена)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["answer"] = answer
+
+    def invalidate(self, book_id):
+        """Удаление всех записей книги"""
+        with self._lock:
+            self._drop(book_id)
+
+    def _check_version(self, book_id, version):
+        if version is None:
+            return
+        if self._versions.get(book_id, version) != version:
+            # Индекс книги изменился: прежние результаты поиска могли устареть
+            self._drop(book_id)
+        self._versions[book_id] = version
+
+    def _drop(self, book_id):
+        dropped = [key for key, entry in self._entries.items() if self._books[entry["row"]] == book_id]
+        for key in dropped:
+            self._books[self._entries.pop(key)["row"]] = None
+        self._versions.pop(book_id, None)
+        if dropped:
+            logger.info(f"Кэш {self.name}: сброшено {len(dropped)} записей книги {book_id}")
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "answer_hits": self.answer_hits
+            }
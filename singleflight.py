@@ -0,0 +1,80 @@
+import logging
+import threading
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FLIGHT_CALLS = metrics.Counter(
+    "singleflight_calls_total", "Вызовы через single-flight: leader выполняет запрос, follower ждет его результат",
+    ["flight", "role"]
+)
+SAVED_CALLS = metrics.Counter(
+    "singleflight_saved_calls_total", "Запросы к API, которые не понадобились благодаря объединению", ["flight"]
+)
+FLIGHT_FAILURES = metrics.Counter(
+    "singleflight_failures_total", "Ожидающие вызовы, завершившиеся ошибкой лидера или таймаутом", ["flight", "reason"]
+)
+
+
+class FlightTimeout(TimeoutError):
+    """Результат одинакового запроса не получен за отведенное время"""
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Объединение одновременных одинаковых вызовов в один
+
+    Первый вызов с ключом (лидер) выполняет функцию, остальные ждут его
+    результат не дольше timeout секунд. Если лидер завершился ошибкой,
+    ожидающие сразу получают ее же, а ключ освобождается: следующий вызов
+    начнет новый запрос.
+    """
+
+    def __init__(self, name, timeout=60):
+        self.name = name
+        self.timeout = timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            FLIGHT_CALLS.inc(flight=self.name, role="leader")
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.done.set()
+            return call.result
+
+        FLIGHT_CALLS.inc(flight=self.name, role="follower")
+        if not call.done.wait(self.timeout if timeout is None else timeout):
+            FLIGHT_FAILURES.inc(flight=self.name, reason="timeout")
+            raise FlightTimeout(f"Не дождались результата одинакового запроса ({self.name})")
+        if call.error is not None:
+            FLIGHT_FAILURES.inc(flight=self.name, reason="leader_failed")
+            raise call.error
+        SAVED_CALLS.inc(flight=self.name)
+        return call.result
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
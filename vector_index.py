@@ -0,0 +1,534 @@
+import json
+import logging
+import os
+import threading
+from array import array
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_rows(vectors):
+    """Нормировка строк матрицы до единичной длины (для косинусного сходства)"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Индексы k наибольших значений, отсортированные по убыванию"""
+    n = scores.shape[0]
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores)
+    # argpartition выбирает top-k за O(n), сортируем только найденные k
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+class FlatIndex:
+    """Точный поиск по непрерывной матрице float32 с нормированными строками"""
+
+    # Индекс держит собственную копию векторов в памяти: строки добавляются через add()
+    in_memory = True
+
+    def __init__(self, dim=None, capacity=1024):
+        self.dim = dim
+        self._capacity = capacity
+        self._matrix = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        return self._size > 0
+
+    def vectors(self):
+        """Представление матрицы без копирования (только заполненные строки)"""
+        with self._lock:
+            if self._matrix is None:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            return self._matrix[:self._size]
+
+    def add(self, vectors):
+        """Добавление эмбеддингов в конец матрицы"""
+        rows = normalize_rows(vectors)
+        if rows.shape[0] == 0:
+            return
+        with self._lock:
+            if self.dim is None:
+                self.dim = rows.shape[1]
+            elif rows.shape[1] != self.dim:
+                raise ValueError(f"Размерность эмбеддинга {rows.shape[1]} не совпадает с {self.dim}")
+
+            needed = self._size + rows.shape[0]
+            if self._matrix is None or needed > self._matrix.shape[0]:
+                self._grow(needed)
+
+            # Сначала пишем строки, потом увеличиваем размер: читатели видят только готовые данные
+            self._matrix[self._size:needed] = rows
+            self._size = needed
+
+    def _grow(self, needed):
+        capacity = max(self._capacity, needed)
+        if self._matrix is not None:
+            capacity = max(capacity, self._matrix.shape[0] * 2)
+        matrix = np.empty((capacity, self.dim), dtype=np.float32)
+        if self._matrix is not None:
+            matrix[:self._size] = self._matrix[:self._size]
+        # Старая матрица остается валидной для поисков, которые уже идут
+        self._matrix = matrix
+
+    def load(self, matrix):
+        """Подключение готовой матрицы (например, mmap) без копирования"""
+        with self._lock:
+            if matrix.shape[0] == 0:
+                self._matrix = None
+                self._size = 0
+                return
+            self.dim = matrix.shape[1]
+            self._matrix = matrix
+            self._size = matrix.shape[0]
+
+    def refresh(self, matrix):
+        """Подключение матрицы, которая содержит текущие строки и, возможно, новые"""
+        self.load(matrix)
+
+    def clear(self):
+        with self._lock:
+            self._matrix = None
+            self._size = 0
+
+    def save(self, path, **meta):
+        """Точному индексу нечего сохранять кроме самих векторов"""
+
+    def restore(self, path, **expected):
+        """Загрузка вспомогательных структур индекса из файла"""
+        return False
+
+    def search(self, query, k=5):
+        """Поиск k ближайших строк: возвращает (scores, ids)"""
+        matrix = self.vectors()
+        if matrix.shape[0] == 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        q = normalize_rows(query)[0]
+        scores = matrix @ q
+        ids = top_k(scores, k)
+        return scores[ids], ids
+
+    def search_batch(self, queries, k=5, block=256):
+        """Поиск для нескольких запросов матрично-матричным произведением: списки scores и ids"""
+        matrix = self.vectors()
+        queries = normalize_rows(queries)
+        if matrix.shape[0] == 0:
+            empty = (np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64))
+            return [empty[0]] * queries.shape[0], [empty[1]] * queries.shape[0]
+        all_scores, all_ids = [], []
+        # Запросы блоками: матрица оценок не больше block x n
+        for start in range(0, queries.shape[0], block):
+            for scores in queries[start:start + block] @ matrix.T:
+                ids = top_k(scores, k)
+                all_scores.append(scores[ids])
+                all_ids.append(ids)
+        return all_scores, all_ids
+
+
+def kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """Сферический k-means по нормированным векторам; возвращает центроиды"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=n_clusters)
+        # Пустые кластеры переинициализируем случайными точками
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(vectors.shape[0], int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex(FlatIndex):
+    """Приближенный поиск: инвертированные списки по центроидам k-means
+
+    Пока векторов меньше train_size, поиск точный. Затем центроиды обучаются
+    один раз, а новые векторы добавляются в списки ближайших центроидов.
+    Поиск просматривает только nprobe ближайших списков.
+    """
+
+    def __init__(self, dim=None, capacity=1024, n_lists=None, nprobe=8, train_size=4096):
+        super().__init__(dim, capacity)
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.centroids = None
+        self._lists = []
+        self._assigned = 0
+        self._ivf_lock = threading.Lock()
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def add(self, vectors):
+        super().add(vectors)
+        self._update_lists()
+
+    def load(self, matrix):
+        """Подключение матрицы; списки строятся в restore (из файла или заново)"""
+        super().load(matrix)
+        with self._ivf_lock:
+            self.centroids = None
+            self._lists = []
+            self._assigned = 0
+
+    def refresh(self, matrix):
+        """Новые строки распределяются по уже обученным спискам без перестройки"""
+        FlatIndex.load(self, matrix)
+        with self._ivf_lock:
+            if self._assigned > matrix.shape[0]:
+                self.centroids = None
+                self._lists = []
+                self._assigned = 0
+        self._update_lists()
+
+    def build(self):
+        """Обучение центроидов (если векторов достаточно) и распределение строк"""
+        self._update_lists()
+
+    def clear(self):
+        super().clear()
+        with self._ivf_lock:
+            self.centroids = None
+            self._lists = []
+            self._assigned = 0
+
+    def _update_lists(self):
+        with self._ivf_lock:
+            matrix = self.vectors()
+            if not self.trained:
+                if matrix.shape[0] < self.train_size:
+                    return
+                self._train(matrix)
+            self._assign(matrix, self._assigned)
+
+    def _train(self, matrix):
+        n_lists = self.n_lists or int(np.clip(4 * np.sqrt(matrix.shape[0]), 8, 4096))
+        rng = np.random.default_rng(0)
+        sample_size = min(matrix.shape[0], n_lists * 64)
+        sample = matrix[np.sort(rng.choice(matrix.shape[0], sample_size, replace=False))]
+        self.centroids = kmeans(np.asarray(sample), n_lists)
+        self._lists = [array("q") for _ in range(n_lists)]
+        self._assigned = 0
+        logger.info(f"IVF-индекс обучен: {n_lists} списков по {sample_size} векторам")
+
+    def _assign(self, matrix, start, block=8192):
+        for offset in range(start, matrix.shape[0], block):
+            rows = matrix[offset:offset + block]
+            labels = np.argmax(rows @ self.centroids.T, axis=1)
+            for row, label in enumerate(labels, offset):
+                self._lists[label].append(row)
+        self._assigned = matrix.shape[0]
+
+    def search(self, query, k=5):
+        q = normalize_rows(query)[0]
+
+        # Матрица и списки читаются вместе: индексация может добавить строки между ними
+        with self._ivf_lock:
+            matrix = self.vectors()
+            if matrix.shape[0] == 0:
+                return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+            if not self.trained:
+                candidates = None
+            else:
+                probe = top_k(self.centroids @ q, self.nprobe)
+                parts = [np.array(self._lists[i], dtype=np.int64) for i in probe]
+                # Строки, еще не распределенные по спискам, проверяем точно
+                parts.append(np.arange(self._assigned, matrix.shape[0], dtype=np.int64))
+                candidates = np.concatenate(parts)
+                # refresh подключает укороченную матрицу раньше, чем сбрасывает списки
+                candidates = candidates[candidates < matrix.shape[0]]
+
+        if candidates is None:
+            scores = matrix @ q
+            ids = top_k(scores, k)
+            return scores[ids], ids
+
+        scores = matrix[candidates] @ q
+        best = top_k(scores, k)
+        return scores[best], candidates[best]
+
+    def search_batch(self, queries, k=5, block=256):
+        """Каждый запрос просматривает свои списки, поэтому запросы обрабатываются по одному"""
+        results = [self.search(q, k) for q in normalize_rows(queries)]
+        return [scores for scores, _ in results], [ids for _, ids in results]
+
+    def save(self, path, **meta):
+        """Сохранение центроидов и распределения строк по спискам (meta — метки, например поставщик)"""
+        with self._ivf_lock:
+            if not self.trained:
+                return
+            labels = np.full(self._assigned, -1, dtype=np.int32)
+            for label, rows in enumerate(self._lists):
+                labels[np.array(rows, dtype=np.int64)] = label
+            centroids = self.centroids
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=centroids, labels=labels, meta=np.array(json.dumps(meta)))
+        os.replace(tmp_path, path)
+
+    def restore(self, path, **expected):
+        """Загрузка сохраненных списков; недостающие строки распределяются заново"""
+        if not os.path.exists(path):
+            self.build()
+            return False
+        with np.load(path) as data:
+            centroids, labels = data["centroids"], data["labels"]
+            meta = json.loads(str(data["meta"])) if "meta" in data else {}
+        matrix = self.vectors()
+        mismatch = any(meta.get(key, value) != value for key, value in expected.items())
+        if mismatch or labels.shape[0] > matrix.shape[0] or centroids.shape[1] != matrix.shape[1]:
+            logger.warning(f"IVF-индекс {path} не соответствует эмбеддингам, будет построен заново")
+            self.build()
+            return False
+        with self._ivf_lock:
+            self.centroids = centroids
+            order = np.argsort(labels, kind="stable")
+            bounds = np.searchsorted(labels[order], np.arange(centroids.shape[0] + 1))
+            self._lists = [array("q", order[bounds[i]:bounds[i + 1]].tolist()) for i in range(centroids.shape[0])]
+            self._assign(matrix, labels.shape[0])
+        return True
+
+
+QUANTIZED_DTYPES = ("float16", "int8")
+
+
+def quantize(vectors, dtype="int8"):
+    """Сжатие нормированных строк: (codes, scales)
+
+    float16 — половинная точность без масштаба (scales = None), int8 — строка,
+    деленная на свой масштаб max|x| / 127 и округленная.
+    """
+    rows = np.asarray(vectors, dtype=np.float32)
+    if dtype == "float16":
+        return rows.astype(np.float16), None
+    if dtype != "int8":
+        raise ValueError(f"Неизвестный тип сжатия: {dtype}")
+    scales = np.abs(rows).max(axis=1) / 127 if rows.shape[0] else np.empty(0, dtype=np.float32)
+    scales[scales == 0] = 1.0
+    codes = np.rint(rows / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedIndex(FlatIndex):
+    """Поиск по сжатой копии векторов (float16 или int8) с точной переоценкой
+
+    Грубый проход считает сходство по сжатым строкам, затем rescore лучших
+    кандидатов переоцениваются по исходной матрице float32. Исходная матрица
+    подключается через mmap и в память читаются только строки кандидатов.
+    Сжатые строки сохраняются в файл (codes.npy отображается в память и
+    общий для процессов), строки сверх сохраненных сжимаются в памяти.
+
+    float16 только экономит память: numpy переводит float16 в float32 без
+    векторных инструкций, и грубый проход примерно в 10 раз медленнее точного
+    поиска по float32. Для ускорения поиска нужен int8.
+    """
+
+    # Строки берутся из хранилища (refresh), а не копируются в память через add()
+    in_memory = False
+
+    def __init__(self, dim=None, capacity=1024, dtype="int8", rescore=64, block=None, save_growth=1.1):
+        if dtype not in QUANTIZED_DTYPES:
+            raise ValueError(f"Неизвестный тип сжатия: {dtype}")
+        super().__init__(dim, capacity)
+        self.dtype = dtype
+        self.rescore = rescore
+        # int8 быстрее небольшими блоками (временная матрица в кэше процессора), float16 — крупными:
+        # там время уходит на само преобразование, а не на обращения к памяти
+        self.block = block or (256 if dtype == "int8" else 8192)
+        # Файл перезаписывается целиком, поэтому сохраняем, только когда строк стало заметно больше
+        self.save_growth = save_growth
+        # Части сжатой матрицы: (codes, scales, из файла); сохраненная часть и хвост в памяти
+        self._segments = []
+        self._quantized = 0
+        self._saved = 0
+        self._q_lock = threading.Lock()
+
+    def add(self, vectors):
+        super().add(vectors)
+        self._update_codes()
+
+    def load(self, matrix):
+        """Подключение матрицы; сжатые строки загружаются в restore (из файла или заново)"""
+        super().load(matrix)
+        self._reset()
+
+    def refresh(self, matrix):
+        """Сжимаются только новые строки"""
+        FlatIndex.load(self, matrix)
+        if self._quantized > matrix.shape[0]:
+            self._reset()
+        self._update_codes()
+
+    def build(self):
+        self._update_codes()
+
+    def clear(self):
+        super().clear()
+        self._reset()
+
+    def _reset(self):
+        with self._q_lock:
+            self._segments = []
+            self._quantized = 0
+
+    def _update_codes(self):
+        with self._q_lock:
+            matrix = self.vectors()
+            if matrix.shape[0] <= self._quantized:
+                return
+            codes, scales = quantize(matrix[self._quantized:], self.dtype)
+            if self._segments and not self._segments[-1][2]:
+                # Хвост в памяти один: дописываем к нему
+                tail_codes, tail_scales, _ = self._segments[-1]
+                codes = np.concatenate([tail_codes, codes])
+                scales = None if scales is None else np.concatenate([tail_scales, scales])
+                self._segments[-1] = (codes, scales, False)
+            else:
+                self._segments.append((codes, scales, False))
+            self._quantized = matrix.shape[0]
+
+    def memory_bytes(self):
+        """Размер сжатых строк и масштабов (без исходной матрицы float32)"""
+        with self._q_lock:
+            return sum(codes.nbytes + (0 if scales is None else scales.nbytes) for codes, scales, _ in self._segments)
+
+    def _coarse_scores(self, segments, q):
+        """Приближенные оценки всех сжатых строк; q — вектор (d,) или матрица запросов (d, m)"""
+        parts = []
+        for codes, scales, _ in segments:
+            for offset in range(0, codes.shape[0], self.block):
+                # Преобразование блоками: временная матрица float32 не больше block строк
+                scores = codes[offset:offset + self.block].astype(np.float32) @ q
+                if scales is not None:
+                    block_scales = scales[offset:offset + self.block]
+                    scores *= block_scales if scores.ndim == 1 else block_scales[:, None]
+                parts.append(scores)
+        if not parts:
+            return np.empty((0,) + q.shape[1:], dtype=np.float32)
+        return np.concatenate(parts)
+
+    def search(self, query, k=5):
+        q = normalize_rows(query)[0]
+        # Матрица и сжатые строки читаются вместе: индексация может добавить строки между ними
+        with self._q_lock:
+            matrix = self.vectors()
+            segments, quantized = list(self._segments), self._quantized
+        if matrix.shape[0] == 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        return self._rescore(matrix, q, self._coarse_scores(segments, q), quantized, k)
+
+    def search_batch(self, queries, k=5, block=256):
+        """Грубый проход по сжатым строкам один на блок запросов, переоценка — для каждого запроса"""
+        queries = normalize_rows(queries)
+        with self._q_lock:
+            matrix = self.vectors()
+            segments, quantized = list(self._segments), self._quantized
+        if matrix.shape[0] == 0:
+            return super().search_batch(queries, k)
+        all_scores, all_ids = [], []
+        for start in range(0, queries.shape[0], block):
+            batch = queries[start:start + block]
+            coarse = self._coarse_scores(segments, batch.T)
+            for column, q in enumerate(batch):
+                scores, ids = self._rescore(matrix, q, coarse[:, column], quantized, k)
+                all_scores.append(scores)
+                all_ids.append(ids)
+        return all_scores, all_ids
+
+    def _rescore(self, matrix, q, coarse, quantized, k):
+        # refresh подключает укороченную матрицу раньше, чем сбрасывает сжатые строки
+        candidates = top_k(coarse[:matrix.shape[0]], max(k, self.rescore))
+        # Строки, еще не сжатые, проверяем точно
+        candidates = np.concatenate([candidates, np.arange(quantized, matrix.shape[0], dtype=np.int64)])
+        # По возрастанию номеров строки mmap читаются последовательно
+        candidates.sort()
+        scores = np.asarray(matrix[candidates]) @ q
+        best = top_k(scores, k)
+        return scores[best], candidates[best]
+
+    @staticmethod
+    def codes_path(path):
+        return path + ".codes.npy"
+
+    def save(self, path, **meta):
+        """Сохранение сжатых строк (codes.npy) и масштабов с метками (npz)"""
+        with self._q_lock:
+            if not self._quantized or self._quantized < self._saved * self.save_growth:
+                return
+            segments, rows = list(self._segments), self._quantized
+        codes = np.concatenate([segment[0] for segment in segments])
+        scales = None if segments[0][1] is None else np.concatenate([segment[1] for segment in segments])
+        meta = {"dtype": self.dtype, "rows": rows, **meta}
+        suffix = f"{os.getpid()}-{threading.get_ident()}.tmp"
+        # Сначала строки, потом файл с метками: по нему restore проверяет, что строки полные
+        with open(f"{self.codes_path(path)}.{suffix}", "wb") as f:
+            np.save(f, codes)
+        os.replace(f"{self.codes_path(path)}.{suffix}", self.codes_path(path))
+        with open(f"{path}.{suffix}", "wb") as f:
+            arrays = {"meta": np.array(json.dumps(meta))}
+            if scales is not None:
+                arrays["scales"] = scales
+            np.savez(f, **arrays)
+        os.replace(f"{path}.{suffix}", path)
+        with self._q_lock:
+            self._saved = rows
+
+    def restore(self, path, **expected):
+        """Подключение сохраненных сжатых строк через mmap; недостающие строки сжимаются заново"""
+        if not os.path.exists(path) or not os.path.exists(self.codes_path(path)):
+            self.build()
+            return False
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data["meta"]))
+                scales = data["scales"] if "scales" in data else None
+            codes = np.load(self.codes_path(path), mmap_mode="r")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Ошибка при загрузке сжатого индекса {path}: {str(e)}")
+            self.build()
+            return False
+        matrix = self.vectors()
+        expected = {"dtype": self.dtype, **expected}
+        mismatch = any(meta.get(key) != value for key, value in expected.items())
+        if (mismatch or codes.shape[0] != meta.get("rows") or codes.shape[0] > matrix.shape[0]
+                or codes.shape[1] != matrix.shape[1]):
+            logger.warning(f"Сжатый индекс {path} не соответствует эмбеддингам, будет построен заново")
+            self.build()
+            return False
+        with self._q_lock:
+            self._segments = [(codes, scales, True)]
+            self._quantized = self._saved = codes.shape[0]
+        self._update_codes()
+        return True
+
+
+def create_index(kind="flat", **params):
+    """Фабрика индексов: flat — точный поиск, ivf — приближенный, float16 и int8 — по сжатым векторам"""
+    if kind == "flat":
+        return FlatIndex()
+    if kind == "ivf":
+        return IVFIndex(**params)
+    if kind in QUANTIZED_DTYPES:
+        return QuantizedIndex(dtype=kind, **params)
+    raise ValueError(f"Неизвестный тип индекса: {kind}")
@@ -0,0 +1,57 @@
+"""Воркер индексации книг: обрабатывает задачи из очереди jobs.db
+
+Веб-сервер при INGESTION_MODE=worker только ставит задачи в очередь и читает
+готовый индекс, а эмбеддинги создают отдельные процессы:
+
+    python worker.py --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+
+
+def run_worker(number, processes, exit_when_idle):
+    # Импорт внутри процесса: у каждого воркера свой клиент, пул соединений и база очереди
+    import app
+
+    # Общий лимит запросов к API делится между процессами
+    if app.embedding_limiter is not None:
+        app.embedding_limiter.rate /= processes
+        app.embedding_limiter.max_rate /= processes
+
+    if app.load_library() is None:
+        logging.getLogger(__name__).error("Не удалось загрузить книги")
+        return
+    app.run_indexing_worker(f"{socket.gethostname()}-{os.getpid()}-{number}", exit_when_idle=exit_when_idle)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=1, help="количество процессов-воркеров")
+    parser.add_argument("--exit-when-idle", action="store_true", help="завершиться, когда очередь опустеет")
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        run_worker(0, 1, args.exit_when_idle)
+        return
+
+    # spawn: процессы не наследуют потоки и соединения родителя
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(i, args.processes, args.exit_when_idle), daemon=False)
+        for i in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+"""Точка входа WSGI для рабочего сервера
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+С preload_app модуль загружается в мастер-процессе gunicorn до создания
+воркеров, поэтому поток обновления индекса запускается в каждом воркере
+отдельно (post_fork в gunicorn.conf.py). Для серверов без fork подойдет
+фабрика app:create_app.
+"""
+from app import create_app
+
+app = create_app(start_refresh=False)